@@ -0,0 +1,166 @@
+"""
+ФЕЙКОВЫЙ BOT API
+Локальная замена api.telegram.org для нагрузочных тестов и стенда: принимает
+любые методы, записывает вызовы и отвечает правдоподобными объектами с
+заданной задержкой.
+
+Запуск отдельно (бот в режиме polling на этом API):
+    python benchmarks/fake_bot_api.py --port 8081 --latency 30
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py --mode polling
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# Методы, которые возвращают отправленное/измененное сообщение
+MESSAGE_METHODS = {
+    "sendMessage", "editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+    "sendPhoto", "sendDocument", "sendVideo", "sendAnimation", "copyMessage", "forwardMessage",
+}
+
+
+class FakeBotAPI:
+    """Bot API, отвечающий без сети; вызовы считаются по методам"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, flood_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.calls = Counter()
+        self.recorded = []
+        self.record = False
+        self.updates = []
+        self.message_ids = itertools.count(1000)
+        self._window = (0, 0)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    def reset(self):
+        self.calls.clear()
+        self.recorded.clear()
+
+    def flooded(self) -> bool:
+        """Имитация flood control: больше flood_rate запросов в секунду получают 429"""
+        if not self.flood_rate:
+            return False
+        second = int(time.monotonic())
+        start, count = self._window
+        if start != second:
+            start, count = second, 0
+        self._window = (start, count + 1)
+        return count >= self.flood_rate
+
+    @staticmethod
+    async def params(request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        data = await request.post()
+        return {key: value for key, value in data.items() if isinstance(value, str)}
+
+    def message(self, params: dict) -> dict:
+        chat_id = params.get("chat_id") or 1
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            pass
+        message = {
+            "message_id": int(params.get("message_id") or next(self.message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "Shop"},
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if params.get("reply_markup"):
+            message["reply_markup"] = json.loads(params["reply_markup"])
+        if "document" in params:
+            message["document"] = {"file_id": f"DOC{message['message_id']}", "file_unique_id": "doc"}
+        if "photo" in params:
+            message["photo"] = [{"file_id": f"PHOTO{message['message_id']}", "file_unique_id": "photo",
+                                 "width": 512, "height": 512}]
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self.params(request)
+        self.calls[method] += 1
+        if self.record:
+            self.recorded.append((method, params))
+
+        if method == "getUpdates":
+            return await self.get_updates(params)
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+
+        if self.flooded():
+            return web.json_response(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                 "parameters": {"retry_after": 1}},
+                status=429
+            )
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Shop", "username": "fake_shop_bot",
+                      "supports_inline_queries": True}
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": len(self.updates)}
+        elif method in MESSAGE_METHODS:
+            result = self.message(params)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, params: dict) -> web.Response:
+        """Отдача апдейтов из self.updates (для прогона бота в режиме polling)"""
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            await asyncio.sleep(min(float(params.get("timeout") or 0), 1.0))
+        return web.json_response({"ok": True, "result": self.updates[:limit]})
+
+
+async def serve(args):
+    api = FakeBotAPI(latency=args.latency / 1000, jitter=args.jitter / 1000, flood_rate=args.flood_rate)
+    await api.start(args.host, args.port)
+    print(f"Fake Bot API on http://{args.host}:{args.port}")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            if api.calls:
+                print(", ".join(f"{method}: {count}" for method, count in api.calls.most_common()))
+    finally:
+        print(dict(api.calls))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальный фейковый Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Случайная добавка к задержке, мс")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Запросов/с до ответов 429 (0 - без ограничения)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -3,37 +3,64 @@ TELEGRAM SHOP BOT v2.0 - ПРОФЕССИОНАЛЬНАЯ СИСТЕМА АВТ
 Автоматизация цифровых продаж с AI-ассистентом
 """
 
+import argparse
 import asyncio
+import bisect
+import contextvars
+import functools
+import heapq
+import html
 import logging
+import multiprocessing
+import os
+import socket
 import json
 import hashlib
+import re
+import secrets
+import signal
 import datetime
+import time
 import uuid
-from decimal import Decimal
+import weakref
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
 from typing import Dict, List, Optional, Any
 from enum import Enum
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, 
     InlineKeyboardButton, WebAppInfo, LabeledPrice,
     PreCheckoutQuery, SuccessfulPayment, ShippingQuery,
-    InputFile, FSInputFile, URLInputFile
+    InputFile, FSInputFile, URLInputFile, TelegramObject,
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent, Update
 )
+from aiogram.dispatcher.flags import get_flag
 from aiogram.filters import Command, StateFilter
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import AnswerCallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.utils.markdown import hbold, hlink, hcode
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 import aiohttp
 import redis.asyncio as redis
-from sqlalchemy import create_engine, Column, String, Integer, Float, Boolean, JSON, DateTime, Text, BigInteger
+from sqlalchemy import Column, String, Integer, Float, Numeric, Boolean, JSON, DateTime, Date, Text, BigInteger, Index
+from sqlalchemy import select, insert, update, func, case, or_, bindparam, tuple_, literal
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import CollectorRegistry, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 import qrcode
 from io import BytesIO
 import smtplib
@@ -49,13 +76,17 @@ class Config:
     """Конфигурация бота"""
     
     # Telegram
-    BOT_TOKEN = ""
+    BOT_TOKEN = os.getenv("BOT_TOKEN", "")
     ADMIN_IDS = []  # ID администраторов
-    SUPPORT_CHAT_ID = -  # Чат техподдержки
+    SUPPORT_CHAT_ID = 0  # Чат техподдержки
     
     # Базы данных
-    REDIS_URL = "redis://localhost:6379/0"
-    DATABASE_URL = "sqlite:///shop_bot.db"  # Или PostgreSQL
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///shop_bot.db")  # Или postgresql+asyncpg://...
+    DB_POOL_SIZE = 20        # Постоянных соединений в пуле
+    DB_MAX_OVERFLOW = 30     # Дополнительных соединений при пиковой нагрузке
+    DB_POOL_TIMEOUT = 10     # Ожидание свободного соединения, сек
+    DB_POOL_RECYCLE = 1800   # Пересоздание соединений, сек
     
     # Платежные системы
     YOOKASSA_SHOP_ID = "your_shop_id"
@@ -63,6 +94,38 @@ class Config:
     CRYPTOBOT_TOKEN = "your_cryptobot_token"
     STRIPE_API_KEY = "your_stripe_key"
     
+    # Запуск
+    RUN_MODE = os.getenv("RUN_MODE", "webhook")   # webhook / polling (локально и на стенде, без nginx)
+    TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Свой Bot API сервер, например фейковый для нагрузочных тестов
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "YOUR_SECRET_TOKEN")
+    WEBHOOK_MAX_CONNECTIONS = 100  # Параллельных запросов от Telegram к webhook (максимум API)
+    DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"  # По умолчанию накопленные апдейты обрабатываются
+    HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "256"))  # Апдейтов в обработке на процесс
+    POLLING_TIMEOUT = 25     # Long polling, сек
+    POLLING_LIMIT = 100      # Апдейтов за один getUpdates
+    SHUTDOWN_TIMEOUT = 30    # Дожидание начатых апдейтов при остановке, сек
+    UPDATE_DEDUP_TTL = 86400 # Сколько помнить обработанные update_id (Telegram хранит апдейты сутки), сек
+    UPDATE_PENDING_TTL = 120 # Апдейт "в обработке": дубли в это время пропускаются, после падения процесса - нет, сек
+    UPDATE_RETRIES = 2       # Повторов апдейта, хэндлер которого упал (ответ webhook уже отправлен)
+    UPDATE_RETRY_DELAY = 1   # Пауза перед повтором, сек (растет вдвое)
+    PURCHASE_IDEMPOTENCY_TTL = 600  # Повторное нажатие "Купить" на той же карточке - без второго списания, сек
+    CALLBACK_DEBOUNCE = 0.7  # Повторные нажатия той же кнопки в течение N сек после обработки схлопываются
+    
+    # Процессы
+    WORKERS = int(os.getenv("WORKERS", "1"))  # Процессов с webhook-сервером на одном порту (SO_REUSEPORT)
+    WORKER_ID = 0                             # Номер процесса, задается супервизором; 0 ведет фоновые задачи
+    ID_NODE = int(os.getenv("ID_NODE", "0"))  # Номер хоста для генератора ID (0-31), уникален при нескольких хостах
+    WEB_HOST = "0.0.0.0"
+    WEB_PORT = 8080
+    USER_LOCK_SHARED = os.getenv("USER_LOCK_SHARED", "1" if WORKERS > 1 else "0") == "1"  # Блокировка пользователя через Redis
+    USER_LOCK_TTL = 30       # TTL блокировки пользователя (продлевается, пока идет обработка), сек
+    USER_LOCK_WAIT = 10      # Ожидание блокировки, после - апдейт отбрасывается с сообщением пользователю, сек
+    WORKER_RESTART_DELAY = 1 # Пауза перед перезапуском упавшего процесса, сек
+    
+    # Мониторинг
+    METRICS_PATH = "/metrics"     # Эндпоинт Prometheus на том же aiohttp-сервере
+    METRICS_QUEUE_INTERVAL = 15   # Опрос длины очередей, сек
+    
     # WebApp
     WEBAPP_URL = "https://ваш-домен.рф/webapp"
     WEBHOOK_URL = "https://ваш-домен.рф/webhook"
@@ -71,11 +134,62 @@ class Config:
     # Настройки
     REFERRAL_PERCENT = 15  # Процент от покупки рефереру
     REFERRAL_LEVELS = 3    # Уровни реферальной системы
+    REFERRAL_LEVEL_PERCENTS = (REFERRAL_PERCENT, REFERRAL_PERCENT // 2, REFERRAL_PERCENT // 4)  # 15% / 7% / 3%
     MIN_WITHDRAW = 500     # Минимальная сумма вывода
     SUPPORT_RATE_LIMIT = 5 # Сообщений в минуту
+    TICKET_PAGE_SIZE = 10  # Сообщений тикета на странице истории
+    TICKET_QUEUE_PAGE_SIZE = 10  # Тикетов на странице очереди админа
+    TICKET_LIST_LIMIT = 10  # Последних тикетов в "Мои тикеты"
+    TICKET_PREVIEW_LENGTH = 300  # Символов сообщения в истории (длиннее - обрезаются)
+    
+    # Защита от флуда: (запросов, за сек)
+    FLOOD_LIMIT = (20, 5)  # Все апдейты пользователя; лишние отбрасываются до сессии БД и хэндлеров
+    RATE_LIMITS = {        # Лимиты хэндлеров (flags={"rate_limit": имя}) и роутеров (ROUTER_RATE_LIMITS)
+        "support": (SUPPORT_RATE_LIMIT, 60),
+        "purchase": (10, 60),
+        "payment": (10, 60),
+    }
+    ROUTER_RATE_LIMITS = {"payment": "payment"}  # Роутер -> лимит его хэндлеров без своего флага
+    RATE_LIMIT_SHARED = os.getenv("RATE_LIMIT_SHARED", "1" if WORKERS > 1 else "0") == "1"  # Общий счет процессов в Redis
+    RATE_LIMIT_WARN_INTERVAL = 10  # Предупреждение "слишком часто" не чаще раза в N сек
+    
+    # Леджер
+    LEDGER_SNAPSHOT_INTERVAL = 300  # Свертка проводок в снимки балансов, сек
+    LEDGER_SNAPSHOT_BATCH = 50000   # Проводок за одну свертку
+    BALANCE_CACHE_TTL = 3600        # Баланс в Redis, сек
+    
+    # Очередь доставки
+    DELIVERY_WORKERS = 4          # Воркеров доставки на процесс
+    DELIVERY_MAX_ATTEMPTS = 5     # Попыток доставки до передачи в поддержку
+    DELIVERY_RETRY_DELAY = 5      # Базовая задержка повтора, сек (растет экспоненциально)
+    DELIVERY_CLAIM_IDLE = 120     # Через сколько сек забирать зависшие у упавшего воркера задачи
+    DELIVERY_RECOVERY_AGE = 300   # Оплаченные, но не попавшие в очередь заказы старше N сек...
+    DELIVERY_RECOVERY_WINDOW = 3600  # ...и моложе N сек
+    
+    # Исходящие сообщения и рассылки
+    TELEGRAM_GLOBAL_RATE = 30     # Лимит Telegram, сообщений/сек на бота
+    TELEGRAM_CHAT_RATE = 1        # Лимит Telegram, сообщений/сек в один чат
+    BROADCAST_RATE = 25           # Скорость рассылки (запас для обычного трафика)
+    BROADCAST_BATCH_SIZE = 500    # Получателей за один запрос к БД
+    BROADCAST_PROGRESS_INTERVAL = 5  # Обновление прогресса у админа, сек
+    NOTIFICATION_FLUSH_INTERVAL = 1.0  # Окно объединения уведомлений, сек
+    STATS_ROLLUP_INTERVAL = 300   # Перенос счетчиков статистики в daily_stats, сек
     
     # Кэш
     CACHE_TTL = 3600  # Время жизни кэша в секундах
+    LOCAL_CACHE_SIZE = 2048  # Записей в in-process LRU
+    LOCAL_CACHE_TTL = 30     # Время жизни in-process записей, сек
+    CATEGORY_PAGE_SIZE = 10  # Товаров на странице категории
+    CATEGORY_PAGE_TTL = 300  # Страница категории в Redis (сортировка по продажам устаревает)
+    KEYBOARD_CACHE_SIZE = 4096  # Готовых параметризованных клавиатур в памяти
+    USER_CACHE_TTL = 600     # Снимок пользователя в Redis, сек
+    USER_CACHE_LOCAL_TTL = 5 # ...и в памяти процесса (баланс меняют и другие процессы)
+    ACTIVITY_FLUSH_INTERVAL = 60  # Пакетная запись last_activity, сек
+    
+    # Поиск
+    SEARCH_RESULTS_LIMIT = 10     # Результатов в ответе на сообщение
+    SEARCH_INLINE_LIMIT = 20      # Результатов в inline-режиме
+    SEARCH_REBUILD_INTERVAL = 600 # Полная пересборка индекса, сек
 
 # ==================== БАЗА ДАННЫХ ====================
 Base = declarative_base()
@@ -89,9 +203,7 @@ class User(Base):
     first_name = Column(String(255))
     last_name = Column(String(255))
     language_code = Column(String(10))
-    balance = Column(Float, default=0.0)
-    total_spent = Column(Float, default=0.0)
-    total_earned = Column(Float, default=0.0)
+    total_spent = Column(Numeric(14, 2), default=0)  # Баланс - в леджере (Ledger), заработок - сумма referrals.earned
     referral_code = Column(String(50), unique=True)
     referred_by = Column(BigInteger)  # user_id того, кто пригласил
     registration_date = Column(DateTime, default=datetime.datetime.utcnow)
@@ -104,6 +216,13 @@ class User(Base):
     orders_count = Column(Integer, default=0)
     messages_count = Column(Integer, default=0)
     successful_refs = Column(Integer, default=0)
+    bot_blocked = Column(Boolean, default=False)  # Пользователь заблокировал бота
+    
+    __table_args__ = (
+        Index("ix_users_last_activity", "last_activity"),
+        Index("ix_users_registration_date", "registration_date"),
+        Index("ix_users_referred_by", "referred_by"),
+    )
 
 class Product(Base):
     __tablename__ = 'products'
@@ -131,6 +250,14 @@ class Product(Base):
     total_revenue = Column(Float, default=0.0)
     rating = Column(Float, default=5.0)
     reviews_count = Column(Integer, default=0)
+    
+    __table_args__ = (
+        # Страницы категории: WHERE category = ? AND is_active ORDER BY <сортировка>, id
+        Index("ix_products_category_new", "category", "is_active", "created_at", "id"),
+        Index("ix_products_category_popular", "category", "is_active", "sales_count", "id"),
+        Index("ix_products_category_price", "category", "is_active", "price", "id"),
+        Index("ix_products_category_rating", "category", "is_active", "rating", "id"),
+    )
 
 class Order(Base):
     __tablename__ = 'orders'
@@ -140,7 +267,7 @@ class Order(Base):
     user_id = Column(BigInteger, nullable=False)
     product_id = Column(Integer, nullable=False)
     quantity = Column(Integer, default=1)
-    total_amount = Column(Float, nullable=False)
+    total_amount = Column(Numeric(14, 2), nullable=False)
     status = Column(String(50), default='pending')  # pending, paid, delivered, cancelled, refunded
     payment_method = Column(String(50))
     payment_id = Column(String(100))  # ID платежа в платежной системе
@@ -155,6 +282,12 @@ class Order(Base):
     # Реферальная система
     referral_bonus_paid = Column(Boolean, default=False)
     referral_user_id = Column(BigInteger)  # Кому начислен бонус
+    
+    __table_args__ = (
+        Index("ix_orders_user_status_created", "user_id", "status", "created_at"),
+        Index("ix_orders_created_at", "created_at"),
+        Index("ix_orders_status_created", "status", "created_at"),
+    )
 
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -162,23 +295,68 @@ class Transaction(Base):
     id = Column(Integer, primary_key=True)
     transaction_id = Column(String(50), unique=True, nullable=False)
     user_id = Column(BigInteger, nullable=False)
-    amount = Column(Float, nullable=False)
+    amount = Column(Numeric(14, 2), nullable=False)
     type = Column(String(50))  # deposit, withdraw, purchase, refund, referral, bonus
     status = Column(String(50), default='pending')  # pending, completed, failed
     description = Column(Text)
-    metadata = Column(JSON, default={})
+    meta = Column("metadata", JSON, default={})  # имя metadata зарезервировано в SQLAlchemy
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_transactions_user_created", "user_id", "created_at"),
+    )
+
+class LedgerPosting(Base):
+    """Проводка леджера: строки только добавляются (меняется лишь отметка свертки), сумма проводок записи равна нулю"""
+    __tablename__ = 'ledger_postings'
+    
+    id = Column(Integer, primary_key=True)
+    entry_id = Column(String(64), nullable=False)  # Запись (операция): ORDER_..., REF_..., BONUS_...
+    account = Column(String(64), nullable=False)   # user:<user_id> или system:<назначение>
+    amount = Column(Numeric(14, 2), nullable=False)  # + приход, - расход
+    kind = Column(String(30), nullable=False)  # purchase, referral, bonus, opening
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    folded = Column(Boolean, nullable=False, default=False)  # Учтена в снимке счета
+    
+    __table_args__ = (
+        # Повтор записи упирается в ключ, а не проводится дважды
+        Index("ix_ledger_postings_entry_account", "entry_id", "account", unique=True),
+        # История счета
+        Index("ix_ledger_postings_account_id", "account", "id"),
+        # Хвост счета после снимка и очередь свертки: только несвернутые проводки
+        Index("ix_ledger_postings_unfolded_account", "account",
+              postgresql_where=(folded == False), sqlite_where=(folded == False)),
+        Index("ix_ledger_postings_unfolded_id", "id",
+              postgresql_where=(folded == False), sqlite_where=(folded == False)),
+    )
+
+class BalanceSnapshot(Base):
+    """Свертка проводок счета; баланс = снимок + несвернутые проводки"""
+    __tablename__ = 'balance_snapshots'
+    
+    account = Column(String(64), primary_key=True)
+    balance = Column(Numeric(14, 2), nullable=False, default=0)
+    last_posting_id = Column(Integer, nullable=False, default=0)  # Последняя свернутая проводка (для отладки)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
 
 class Referral(Base):
+    """Closure table: строка на каждого предка пользователя до Config.REFERRAL_LEVELS"""
     __tablename__ = 'referrals'
     
     id = Column(Integer, primary_key=True)
-    referrer_id = Column(BigInteger, nullable=False)
-    referred_id = Column(BigInteger, nullable=False, unique=True)
-    level = Column(Integer, default=1)  # Уровень в реферальной системе
-    earned = Column(Float, default=0.0)
+    referrer_id = Column(BigInteger, nullable=False)  # Предок
+    referred_id = Column(BigInteger, nullable=False)  # Приглашенный (прямо или через цепочку)
+    level = Column(Integer, default=1)  # Расстояние от предка: 1 - пригласил сам
+    earned = Column(Numeric(14, 2), default=0)
     status = Column(String(50), default='active')
     registered_at = Column(DateTime, default=datetime.datetime.utcnow)
+    
+    __table_args__ = (
+        # Цепочка предков при выплате
+        Index("ix_referrals_referred_level", "referred_id", "level", unique=True),
+        # Статистика по уровням: GROUP BY level по индексу
+        Index("ix_referrals_referrer_level", "referrer_id", "level"),
+    )
 
 class SupportTicket(Base):
     __tablename__ = 'support_tickets'
@@ -192,8 +370,29 @@ class SupportTicket(Base):
     priority = Column(String(20), default='normal')  # low, normal, high, critical
     admin_id = Column(BigInteger)  # Кто взял тикет
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
-    messages = Column(JSON, default=[])  # История переписки
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)  # Последнее сообщение
+    messages_count = Column(Integer, default=0)  # История переписки - в ticket_messages
+    
+    __table_args__ = (
+        Index("ix_support_tickets_user_status", "user_id", "status"),
+        # Очередь админов: ждущие ответа тикеты (свободные или одного админа) по времени ожидания
+        Index("ix_support_tickets_status_admin_updated", "status", "admin_id", "updated_at"),
+    )
+
+class TicketMessage(Base):
+    __tablename__ = 'ticket_messages'
+    
+    id = Column(Integer, primary_key=True)
+    ticket_id = Column(Integer, nullable=False)  # support_tickets.id
+    author = Column(String(10), nullable=False)  # user, admin
+    sender_id = Column(BigInteger, nullable=False)
+    text = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    
+    __table_args__ = (
+        # Страница истории тикета по ключу (время, id) без OFFSET
+        Index("ix_ticket_messages_ticket_created", "ticket_id", "created_at", "id"),
+    )
 
 class Notification(Base):
     __tablename__ = 'notifications'
@@ -206,6 +405,10 @@ class Notification(Base):
     is_read = Column(Boolean, default=False)
     data = Column(JSON, default={})
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_notifications_user_created", "user_id", "created_at"),
+    )
 
 class PromoCode(Base):
     __tablename__ = 'promo_codes'
@@ -222,6 +425,17 @@ class PromoCode(Base):
     valid_until = Column(DateTime)
     created_by = Column(BigInteger)  # admin id
 
+class DailyStats(Base):
+    __tablename__ = 'daily_stats'
+    
+    date = Column(Date, primary_key=True)
+    orders = Column(Integer, default=0)
+    paid_orders = Column(Integer, default=0)
+    revenue = Column(Float, default=0.0)
+    new_users = Column(Integer, default=0)
+    active_users = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
 # ==================== ИНИЦИАЛИЗАЦИЯ ====================
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -231,37 +445,338 @@ redis_client = redis.from_url(Config.REDIS_URL)
 storage = RedisStorage(redis=redis_client)
 
 # База данных
-engine = create_engine(Config.DATABASE_URL)
-SessionLocal = sessionmaker(bind=engine)
-Base.metadata.create_all(bind=engine)
+def make_async_database_url(url: str) -> str:
+    """Подстановка асинхронного драйвера в URL базы данных"""
+    drivers = {
+        "postgresql://": "postgresql+asyncpg://",
+        "postgres://": "postgresql+asyncpg://",
+        "sqlite://": "sqlite+aiosqlite://",
+    }
+    for prefix, async_prefix in drivers.items():
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+DATABASE_URL = make_async_database_url(Config.DATABASE_URL)
+
+engine_options = {"pool_pre_ping": True}
+if not DATABASE_URL.startswith("sqlite"):
+    engine_options.update(
+        pool_size=Config.DB_POOL_SIZE,
+        max_overflow=Config.DB_MAX_OVERFLOW,
+        pool_timeout=Config.DB_POOL_TIMEOUT,
+        pool_recycle=Config.DB_POOL_RECYCLE,
+    )
+
+engine = create_async_engine(DATABASE_URL, **engine_options)
+SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+def upsert(table):
+    """INSERT с поддержкой ON CONFLICT для текущей БД"""
+    return (postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert)(table)
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Одна сессия БД на апдейт, передается в хэндлеры как db"""
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        # Соединение из пула берется только при первом запросе
+        async with SessionLocal() as db:
+            data["db"] = db
+            return await handler(event, data)
+
+class UpdateDedupMiddleware(BaseMiddleware):
+    """Повторная доставка апдейта (ретрай webhook, рестарт до подтверждения offset) пропускается
+    
+    Отметка в две фазы: на время обработки - ключ pending с коротким TTL (дубль, пришедший в это время,
+    пропускается), после успеха - бит "обработан". update_id идут подряд, поэтому обработанные хранятся
+    битовыми картами по 2^20 id (128 КБ на миллион апдейтов). Если хэндлер упал, pending удаляется
+    и повтор апдейта обрабатывается заново
+    """
+    
+    KEY = "updates:seen:{bucket}"
+    PENDING_KEY = "updates:pending:{update_id}"
+    BUCKET_SIZE = 2 ** 20
+    # 0 - можно обрабатывать (pending поставлен), 1 - уже обработан, 2 - обрабатывается сейчас
+    BEGIN_SCRIPT = """
+    if redis.call("getbit", KEYS[1], ARGV[1]) == 1 then
+        return 1
+    end
+    if not redis.call("set", KEYS[2], 1, "NX", "PX", ARGV[2]) then
+        return 2
+    end
+    return 0
+    """
+    
+    def __init__(self):
+        self.begin_script = redis_client.register_script(self.BEGIN_SCRIPT)
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        bucket, offset = divmod(event.update_id, self.BUCKET_SIZE)
+        key = self.KEY.format(bucket=bucket)
+        pending_key = self.PENDING_KEY.format(update_id=event.update_id)
+        try:
+            state = await self.begin_script(keys=[key, pending_key], args=[offset, Config.UPDATE_PENDING_TTL * 1000])
+        except Exception as e:
+            logger.warning(f"Update dedup check failed: {e}")
+            return await handler(event, data)
+        
+        if state:
+            Metrics.DUPLICATE_UPDATES.inc()
+            logger.info(f"Skipping duplicate update {event.update_id}")
+            return None
+        
+        try:
+            result = await handler(event, data)
+        except BaseException:
+            try:
+                await redis_client.delete(pending_key)
+            except Exception as e:
+                logger.warning(f"Update dedup release failed: {e}")
+            raise
+        
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.setbit(key, offset, 1)
+                pipe.expire(key, Config.UPDATE_DEDUP_TTL)
+                pipe.delete(pending_key)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Update dedup mark failed: {e}")
+        return result
 
 # Aiogram
-session = AiohttpSession()
+session = AiohttpSession(
+    api=TelegramAPIServer.from_base(Config.TELEGRAM_API_URL) if Config.TELEGRAM_API_URL else PRODUCTION
+)
 bot = Bot(
     token=Config.BOT_TOKEN,
     default=DefaultBotProperties(parse_mode="HTML"),
     session=session
 )
 dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(UpdateDedupMiddleware())
+dp.update.outer_middleware(DbSessionMiddleware())
 
 # Роутеры
-main_router = Router()
-admin_router = Router()
-payment_router = Router()
+main_router = Router(name="main")
+admin_router = Router(name="admin")
+payment_router = Router(name="payment")
 dp.include_routers(main_router, admin_router, payment_router)
 
+# ==================== МЕТРИКИ ====================
+class Metrics:
+    """Метрики Prometheus, отдаются на Config.METRICS_PATH"""
+    
+    UPDATES = Counter("bot_updates_total", "Обработанные апдейты", ["type"])
+    UPDATE_LATENCY = Histogram("bot_update_duration_seconds", "Время обработки апдейта", ["type"])
+    DEBOUNCED_CALLBACKS = Counter("bot_debounced_callbacks_total", "Схлопнутые повторные нажатия кнопок")
+    DUPLICATE_UPDATES = Counter("bot_duplicate_updates_total", "Пропущенные повторные апдейты")
+    RATE_LIMITED = Counter("bot_rate_limited_total", "Отброшенные по лимиту частоты апдейты", ["scope"])
+    UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Апдейты в обработке", multiprocess_mode="livesum")
+    HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Время работы хэндлера", ["router", "handler"])
+    HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хэндлерах", ["router", "handler"])
+    DB_QUERIES = Counter("bot_db_queries_total", "Запросы к БД")
+    DB_QUERIES_PER_UPDATE = Histogram(
+        "bot_db_queries_per_update", "Запросов к БД на один апдейт",
+        buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+    )
+    TELEGRAM_LATENCY = Histogram("bot_telegram_api_duration_seconds", "Время запроса к Bot API", ["method"])
+    TELEGRAM_ERRORS = Counter("bot_telegram_api_errors_total", "Ошибки Bot API", ["method", "error"])
+    TELEGRAM_RETRY_AFTER = Counter("bot_telegram_retry_after_total", "Ответы RetryAfter (flood control)", ["method"])
+    # Очереди общие для всех процессов, при сборе из нескольких процессов берется максимум
+    DELIVERY_QUEUE = Gauge("bot_delivery_queue_depth", "Задачи доставки", ["queue"], multiprocess_mode="max")
+    BROADCASTS_ACTIVE = Gauge("bot_broadcasts_active", "Активные рассылки", multiprocess_mode="max")
+    
+    # Счетчик запросов к БД текущего апдейта (список, чтобы менять его из событий SQLAlchemy)
+    db_queries_in_update: contextvars.ContextVar = contextvars.ContextVar("db_queries_in_update", default=None)
+    
+    @staticmethod
+    async def run_queue_loop():
+        """Периодический опрос длины очередей в Redis"""
+        while True:
+            try:
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    pipe.xlen(DeliveryQueue.STREAM_KEY)
+                    pipe.zcard(DeliveryQueue.RETRY_KEY)
+                    pipe.xlen(DeliveryQueue.DEAD_KEY)
+                    pipe.scard(Broadcaster.ACTIVE_KEY)
+                    stream, retry, dead, broadcasts = await pipe.execute()
+                
+                Metrics.DELIVERY_QUEUE.labels("stream").set(stream)
+                Metrics.DELIVERY_QUEUE.labels("retry").set(retry)
+                Metrics.DELIVERY_QUEUE.labels("dead").set(dead)
+                Metrics.BROADCASTS_ACTIVE.set(broadcasts)
+            except Exception as e:
+                logger.warning(f"Queue metrics update failed: {e}")
+            
+            await asyncio.sleep(Config.METRICS_QUEUE_INTERVAL)
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def count_db_query(conn, cursor, statement, parameters, context, executemany):
+    """Подсчет запросов к БД"""
+    Metrics.DB_QUERIES.inc()
+    counter = Metrics.db_queries_in_update.get()
+    if counter is not None:
+        counter[0] += 1
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Время обработки и число запросов к БД на апдейт"""
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        event_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        counter = [0]
+        token = Metrics.db_queries_in_update.set(counter)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            Metrics.UPDATE_LATENCY.labels(event_type).observe(time.perf_counter() - started)
+            Metrics.UPDATES.labels(event_type).inc()
+            Metrics.DB_QUERIES_PER_UPDATE.observe(counter[0])
+            Metrics.db_queries_in_update.reset(token)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы конкретного хэндлера с меткой роутера"""
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        router = data["event_router"].name if data.get("event_router") else "unknown"
+        name = data["handler"].callback.__name__ if data.get("handler") else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            Metrics.HANDLER_ERRORS.labels(router, name).inc()
+            raise
+        finally:
+            Metrics.HANDLER_LATENCY.labels(router, name).observe(time.perf_counter() - started)
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Время, ошибки и RetryAfter запросов к Bot API"""
+    
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            Metrics.TELEGRAM_RETRY_AFTER.labels(name).inc()
+            Metrics.TELEGRAM_ERRORS.labels(name, "TelegramRetryAfter").inc()
+            raise
+        except Exception as e:
+            Metrics.TELEGRAM_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            Metrics.TELEGRAM_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+class CacheMetricsCollector:
+    """Попадания в кэши, читаются из счетчиков кэшей в момент сбора метрик"""
+    
+    def describe(self):
+        # Кэши создаются ниже по модулю, поэтому не даем реестру вызвать collect при регистрации
+        return []
+    
+    def collect(self):
+        requests = CounterMetricFamily("bot_cache_requests", "Обращения к кэшам", labels=["cache", "result"])
+        entries = GaugeMetricFamily("bot_cache_entries", "Записей в in-process кэшах", labels=["cache"])
+        
+        levels = {
+            "catalog_local": (catalog_cache.local.hits, catalog_cache.local.misses),
+            "catalog_redis": (catalog_cache.redis_hits, catalog_cache.redis_misses),
+            "user_local": (user_cache.local.hits, user_cache.local.misses),
+            "user_redis": (user_cache.redis_hits, user_cache.db_loads),
+        }
+        for name, keyboard in keyboard_registry.stats().items():
+            levels[f"keyboard_{name}"] = (keyboard["hits"], keyboard["misses"])
+        
+        for cache, (hits, misses) in levels.items():
+            requests.add_metric([cache, "hit"], hits)
+            requests.add_metric([cache, "miss"], misses)
+        
+        entries.add_metric(["catalog_local"], len(catalog_cache.local))
+        entries.add_metric(["user_local"], len(user_cache.local))
+        entries.add_metric(["search_index"], len(search_index.docs))
+        
+        yield requests
+        yield entries
+
+REGISTRY.register(CacheMetricsCollector())
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Эндпоинт для Prometheus"""
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Несколько процессов: метрики всех воркеров из общего каталога,
+        # счетчики кэшей - только процесса, ответившего на запрос
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(CacheMetricsCollector())
+    return web.Response(body=generate_latest(registry), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+for event_name, observer in dp.observers.items():
+    if event_name not in ("update", "error"):
+        observer.middleware(HandlerMetricsMiddleware())
+session.middleware(TelegramRequestMetrics())
+
 # ==================== УТИЛИТЫ ====================
+class IdGenerator:
+    """Snowflake-ID без обращений к БД/Redis: миллисекунды, шард процесса, счетчик в пределах миллисекунды"""
+    
+    EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+    NODE_BITS = 5
+    WORKER_BITS = 5
+    SEQUENCE_BITS = 12
+    WIDTH = 13  # Знаков base36 для 63 бит: строки одной длины сортируются как числа
+    ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    
+    def __init__(self):
+        self.last_ms = 0
+        self.sequence = 0
+    
+    @property
+    def shard(self) -> int:
+        """Хост и процесс; читается при каждом вызове - WORKER_ID задается уже после fork"""
+        if not 0 <= Config.ID_NODE < 1 << self.NODE_BITS or not 0 <= Config.WORKER_ID < 1 << self.WORKER_BITS:
+            raise ValueError(f"ID shard out of range: node {Config.ID_NODE}, worker {Config.WORKER_ID}")
+        return Config.ID_NODE << self.WORKER_BITS | Config.WORKER_ID
+    
+    def next_int(self) -> int:
+        now = int(time.time() * 1000) - self.EPOCH_MS
+        if now > self.last_ms:
+            self.last_ms, self.sequence = now, 0
+        else:
+            # Та же миллисекунда или часы ушли назад: ID продолжают расти от последнего,
+            # при переполнении счетчика - за счет следующей миллисекунды
+            self.sequence = (self.sequence + 1) & ((1 << self.SEQUENCE_BITS) - 1)
+            if self.sequence == 0:
+                self.last_ms += 1
+        return (self.last_ms << (self.NODE_BITS + self.WORKER_BITS) | self.shard) << self.SEQUENCE_BITS | self.sequence
+    
+    def new(self, prefix: str) -> str:
+        """ID вида PREFIX_<13 знаков base36>, возрастающий в пределах процесса"""
+        value, digits = self.next_int(), []
+        while value:
+            value, digit = divmod(value, 36)
+            digits.append(self.ALPHABET[digit])
+        return f"{prefix}_{''.join(reversed(digits)).rjust(self.WIDTH, '0')}"
+    
+    @classmethod
+    def created_at(cls, id_: str) -> datetime.datetime:
+        """Время создания из ID (для поддержки и отладки)"""
+        value = int(id_.rsplit("_", 1)[-1], 36)
+        ms = (value >> (cls.NODE_BITS + cls.WORKER_BITS + cls.SEQUENCE_BITS)) + cls.EPOCH_MS
+        return datetime.datetime.utcfromtimestamp(ms / 1000)
+
+ids = IdGenerator()
+
 class Utils:
     """Утилиты для работы бота"""
     
     @staticmethod
-    async def get_db() -> Session:
+    async def get_db() -> AsyncSession:
         """Получение сессии БД"""
-        db = SessionLocal()
-        try:
+        async with SessionLocal() as db:
             yield db
-        finally:
-            db.close()
     
     @staticmethod
     def generate_referral_code(user_id: int) -> str:
@@ -275,32 +790,41 @@ class Utils:
     
     @staticmethod
     async def send_notification(user_id: int, title: str, message: str, notification_type: str = "system"):
-        """Отправка уведомления пользователю"""
-        try:
-            await bot.send_message(
-                user_id,
-                f"🔔 <b>{title}</b>\n\n{message}",
-                disable_notification=False
-            )
-            
-            # Сохранение в БД
-            async with SessionLocal() as db:
-                notification = Notification(
-                    user_id=user_id,
-                    type=notification_type,
-                    title=title,
-                    message=message
-                )
-                db.add(notification)
-                await db.commit()
-                
-        except Exception as e:
-            logger.error(f"Failed to send notification: {e}")
+        """Отправка уведомления пользователю (через буфер NotificationService)"""
+        notifications.push(user_id, title, message, notification_type)
+    
+    @staticmethod
+    def render_product_card(product: Product) -> dict:
+        """Карточка товара для показа пользователю"""
+        description = f"<b>{product.name}</b>\n\n"
+        description += f"{product.description}\n\n" if product.description else ""
+        description += f"💵 <b>Цена:</b> {product.price:.2f} ₽\n"
+        
+        if product.stock >= 0:
+            description += f"📦 <b>В наличии:</b> {product.stock} шт.\n"
+        else:
+            description += "📦 <b>В наличии:</b> ∞\n"
+        
+        description += f"⭐ <b>Рейтинг:</b> {product.rating}/5 ({product.reviews_count} отзывов)\n"
+        description += f"🛒 <b>Продано:</b> {product.sales_count} шт.\n\n"
+        
+        if product.attributes:
+            description += "<b>Характеристики:</b>\n"
+            for key, value in product.attributes.items():
+                description += f"• {key}: {value}\n"
+        
+        return {
+            "id": product.id,
+            "category": product.category,
+            "text": description,
+            "image_url": product.image_url,
+            "in_stock": product.stock != 0
+        }
     
     @staticmethod
     async def create_order_invoice(product, user_id: int, quantity: int = 1) -> dict:
         """Создание счета на оплату"""
-        order_id = f"ORDER_{int(datetime.datetime.now().timestamp())}_{user_id}"
+        order_id = ids.new("ORDER")
         total = product.price * quantity
         
         return {
@@ -312,117 +836,2130 @@ class Utils:
             "description": f"Покупка: {product.name} x{quantity}"
         }
 
-# ==================== КЛАВИАТУРЫ ====================
-class Keyboards:
-    """Клавиатуры бота"""
+# ==================== КАТЕГОРИИ ====================
+class Categories:
+    """Категории товаров: один агрегирующий запрос и стабильные ID для callback_data"""
     
     @staticmethod
-    def main_menu() -> InlineKeyboardMarkup:
-        """Главное меню"""
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text="🛒 Каталог", callback_data="catalog"),
-            InlineKeyboardButton(text="👤 Профиль", callback_data="profile"),
-        )
-        builder.row(
-            InlineKeyboardButton(text="💰 Пополнить баланс", callback_data="deposit"),
-            InlineKeyboardButton(text="📦 Мои покупки", callback_data="my_orders"),
-        )
-        builder.row(
-            InlineKeyboardButton(text="👥 Реферальная система", callback_data="referral"),
-            InlineKeyboardButton(text="🆘 Поддержка", callback_data="support"),
-        )
-        builder.row(
-            InlineKeyboardButton(text="⚙️ Настройки", callback_data="settings"),
-            InlineKeyboardButton(text="ℹ️ О боте", callback_data="about"),
-        )
-        return builder.as_markup()
+    def make_id(name: str) -> str:
+        """Стабильный ID категории (не зависит от порядка и количества категорий)"""
+        return hashlib.md5(name.encode()).hexdigest()[:8]
     
     @staticmethod
-    def catalog_menu(categories: list) -> InlineKeyboardMarkup:
-        """Меню каталога"""
-        builder = InlineKeyboardBuilder()
-        
-        for category in categories:
-            builder.button(text=f"📁 {category['name']}", callback_data=f"category_{category['id']}")
-        
-        builder.row(
-            InlineKeyboardButton(text="🔍 Поиск товара", callback_data="search"),
-            InlineKeyboardButton(text="🎁 Акции", callback_data="promotions"),
+    def load_query():
+        """Категории с количеством активных товаров одним GROUP BY"""
+        return (
+            select(Product.category, func.count(Product.id))
+            .where(Product.category.isnot(None), Product.is_active == True)
+            .group_by(Product.category)
+            .order_by(Product.category)
         )
-        builder.row(
-            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
-        )
-        
-        return builder.as_markup()
     
     @staticmethod
-    def product_menu(product_id: int, in_stock: bool = True) -> InlineKeyboardMarkup:
-        """Меню товара"""
-        builder = InlineKeyboardBuilder()
+    async def load(db: AsyncSession) -> list:
+        """Список категорий для меню"""
+        rows = (await db.execute(Categories.load_query())).all()
         
-        if in_stock:
-            builder.button(text="🛒 Купить сейчас", callback_data=f"buy_{product_id}")
-            builder.button(text="💰 Купить с баланса", callback_data=f"buy_balance_{product_id}")
+        return [
+            {"id": Categories.make_id(name), "name": name, "count": count}
+            for name, count in rows
+        ]
+    
+    # Режимы сортировки: код в callback_data -> (колонка, по убыванию, подпись)
+    SORTS = {
+        "n": (Product.created_at, True, "🆕 Новые"),
+        "p": (Product.sales_count, True, "🔥 Популярные"),
+        "c": (Product.price, False, "💰 Дешевле"),
+        "r": (Product.rating, True, "⭐ Рейтинг"),
+    }
+    
+    @staticmethod
+    def encode_cursor(product_id: int) -> str:
+        """Компактный курсор для callback_data (base36)"""
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+        encoded = ""
+        while True:
+            product_id, rest = divmod(product_id, 36)
+            encoded = digits[rest] + encoded
+            if not product_id:
+                return encoded
+    
+    @staticmethod
+    def decode_cursor(cursor: str) -> int:
+        return int(cursor, 36)
+    
+    @staticmethod
+    def page_query(category_name: str, sort: str = "n", direction: str = "f", cursor: int = 0):
+        """Запрос страницы категории по ключу (колонка сортировки, id) без OFFSET
         
-        builder.button(text="📋 Описание", callback_data=f"desc_{product_id}")
-        builder.button(text="⭐ Отзывы", callback_data=f"reviews_{product_id}")
+        direction: f - первая страница, n - после товара cursor, p - перед ним
+        """
+        column, descending, _ = Categories.SORTS[sort]
+        # Идем по индексу по убыванию, если сортировка убывающая и листаем вперед (или наоборот)
+        walk_desc = descending == (direction != "p")
         
-        builder.row(
-            InlineKeyboardButton(text="🔙 Назад в каталог", callback_data="catalog"),
-            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
+        query = select(Product.id, Product.name, Product.price).where(
+            Product.category == category_name,
+            Product.is_active == True
         )
+        if cursor:
+            # Значение колонки у граничного товара берем подзапросом: в курсоре только id
+            boundary = tuple_(
+                select(column).where(Product.id == cursor).scalar_subquery(),
+                literal(cursor)
+            )
+            key = tuple_(column, Product.id)
+            query = query.where(key < boundary if walk_desc else key > boundary)
         
-        return builder.as_markup()
+        order = (column.desc(), Product.id.desc()) if walk_desc else (column.asc(), Product.id.asc())
+        return query.order_by(*order).limit(Config.CATEGORY_PAGE_SIZE + 1)
     
     @staticmethod
-    def payment_methods() -> InlineKeyboardMarkup:
-        """Методы оплаты"""
-        builder = InlineKeyboardBuilder()
+    async def load_page(db: AsyncSession, category_name: str, sort: str = "n",
+                        direction: str = "f", cursor: int = 0) -> dict:
+        """Страница категории и признаки наличия соседних страниц"""
+        forward = direction != "p"
+        rows = (await db.execute(Categories.page_query(category_name, sort, direction, cursor))).all()
         
-        builder.row(
-            InlineKeyboardButton(text="💳 Банковская карта", callback_data="pay_card"),
-            InlineKeyboardButton(text="🥝 ЮMoney", callback_data="pay_yoomoney"),
-        )
-        builder.row(
-            InlineKeyboardButton(text="🔶 ЮKassa", callback_data="pay_yookassa"),
-            InlineKeyboardButton(text="₿ Криптовалюта", callback_data="pay_crypto"),
-        )
-        builder.row(
-            InlineKeyboardButton(text="📱 QIWI", callback_data="pay_qiwi"),
-            InlineKeyboardButton(text="🌐 СБП", callback_data="pay_sbp"),
-        )
-        builder.row(
-            InlineKeyboardButton(text="🔙 Назад", callback_data="deposit_back"),
-            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
-        )
+        more = len(rows) > Config.CATEGORY_PAGE_SIZE
+        rows = rows[:Config.CATEGORY_PAGE_SIZE]
+        if not forward:
+            rows.reverse()
         
-        return builder.as_markup()
+        return {
+            "items": [{"id": p.id, "name": p.name, "price": p.price} for p in rows],
+            "has_next": more if forward else True,
+            "has_prev": more if not forward else direction == "n",
+        }
     
     @staticmethod
-    def profile_menu(user_data: dict) -> InlineKeyboardMarkup:
-        """Меню профиля"""
-        builder = InlineKeyboardBuilder()
-        
-        builder.row(
-            InlineKeyboardButton(text="💰 Баланс: {:.2f} ₽".format(user_data['balance']), callback_data="balance_info"),
-        )
-        builder.row(
-            InlineKeyboardButton(text="📊 Статистика", callback_data="stats"),
-            InlineKeyboardButton(text="🎁 Промокод", callback_data="promo_activate"),
-        )
-        builder.row(
-            InlineKeyboardButton(text="📱 Контакты", callback_data="contacts"),
-            InlineKeyboardButton(text="✏️ Изменить данные", callback_data="edit_profile"),
-        )
-        builder.row(
-            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
-        )
-        
-        return builder.as_markup()
+    async def resolve(db: AsyncSession, category_id: str) -> Optional[dict]:
+        """Категория (id, name, count) по ID из callback_data"""
+        categories = await catalog_cache.categories(db)
+        return next((cat for cat in categories if cat["id"] == category_id), None)
+
+# ==================== КЭШ ====================
+class LRUCache:
+    """In-process LRU кэш с ограничением размера и TTL"""
+    
+    def __init__(self, maxsize: int = Config.LOCAL_CACHE_SIZE, ttl: Optional[float] = Config.LOCAL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+    
+    def get(self, key, default=None):
+        """Получение значения (None если нет или устарело)"""
+        item = self._data.get(key)
+        if item is None or (item[1] is not None and item[1] < time.monotonic()):
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+    
+    def set(self, key, value):
+        """Сохранение значения с вытеснением самых старых записей"""
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def delete(self, key):
+        """Удаление значения"""
+        self._data.pop(key, None)
+    
+    def clear(self):
+        """Очистка кэша"""
+        self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+class CacheBus:
+    """Сброс in-process кэшей в остальных процессах через Redis pub/sub"""
+    
+    CHANNEL = "cache:invalidate"
+    
+    def __init__(self):
+        self.handlers: Dict[str, Any] = {}
+        self.resets: List[Any] = []
     
     @staticmethod
-    def referral_menu(ref_code: str) -> InlineKeyboardMarkup:
+    def origin() -> str:
+        # pid берется при каждом вызове: экземпляр создается до fork воркеров
+        return f"{socket.gethostname()}-{os.getpid()}"
+    
+    def on(self, kind: str, handler, reset=None):
+        """Обработчик сообщений kind; reset - полный сброс, если сообщения могли быть потеряны"""
+        self.handlers[kind] = handler
+        if reset:
+            self.resets.append(reset)
+    
+    async def publish(self, kind: str, *args):
+        """Рассылка сброса другим процессам (свой процесс сбрасывает кэш сам)"""
+        try:
+            await redis_client.publish(self.CHANNEL, json.dumps({"origin": self.origin(), "kind": kind, "args": args}))
+        except Exception as e:
+            logger.warning(f"Cache invalidation publish failed: {e}")
+    
+    async def run_listener_loop(self):
+        """Подписка на сбросы; после переподключения локальные кэши очищаются целиком"""
+        connected_before = False
+        while True:
+            try:
+                async with redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.CHANNEL)
+                    if connected_before:
+                        for reset in self.resets:
+                            reset()
+                    connected_before = True
+                    
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        payload = json.loads(message["data"])
+                        handler = self.handlers.get(payload["kind"])
+                        if handler and payload["origin"] != self.origin():
+                            handler(*payload["args"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener failed: {e}")
+                await asyncio.sleep(1)
+
+cache_bus = CacheBus()
+
+class CatalogCache:
+    """Кэш каталога: in-process LRU перед Redis, данные берутся из БД только при промахе"""
+    
+    CATEGORIES_KEY = "catalog:categories"
+    CATEGORY_VERSION_KEY = "catalog:category:{category_id}:version"
+    CATEGORY_PAGE_KEY = "catalog:category:{category_id}:v{version}:{sort}:{direction}:{cursor}"
+    PRODUCT_KEY = "catalog:product:{product_id}"
+    
+    def __init__(self):
+        self.local = LRUCache()
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self._tasks: set = set()  # Фоновые подгрузки: без ссылки задачу может собрать GC
+    
+    async def _get_or_load(self, key: str, loader, ttl: int = Config.CACHE_TTL):
+        """Чтение через оба уровня кэша с загрузкой из БД при промахе"""
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        
+        try:
+            raw = await redis_client.get(key)
+        except Exception as e:
+            logger.warning(f"Catalog cache read failed: {e}")
+            raw = None
+        
+        if raw is not None:
+            self.redis_hits += 1
+            value = json.loads(raw)
+        else:
+            self.redis_misses += 1
+            value = await loader()
+            if value is None:
+                return None
+            try:
+                await redis_client.set(key, json.dumps(value, ensure_ascii=False, default=str), ex=ttl)
+            except Exception as e:
+                logger.warning(f"Catalog cache write failed: {e}")
+        
+        self.local.set(key, value)
+        return value
+    
+    async def categories(self, db: AsyncSession) -> list:
+        """Список категорий с количеством активных товаров"""
+        return await self._get_or_load(self.CATEGORIES_KEY, lambda: Categories.load(db))
+    
+    async def _category_version(self, category_id: str) -> int:
+        """Версия списков категории: меняется при изменении состава, старые страницы истекают сами"""
+        key = self.CATEGORY_VERSION_KEY.format(category_id=category_id)
+        version = self.local.get(key)
+        if version is None:
+            try:
+                version = int(await redis_client.get(key) or 0)
+            except Exception as e:
+                logger.warning(f"Catalog cache read failed: {e}")
+                return 0
+            self.local.set(key, version)
+        return version
+    
+    async def category_page(self, db: AsyncSession, category_name: str, sort: str = "n",
+                            direction: str = "f", cursor: int = 0) -> dict:
+        """Страница товаров категории; следующая страница подгружается в кэш заранее"""
+        category_id = Categories.make_id(category_name)
+        version = await self._category_version(category_id)
+        key = self.CATEGORY_PAGE_KEY.format(
+            category_id=category_id, version=version, sort=sort, direction=direction, cursor=cursor
+        )
+        page = await self._get_or_load(
+            key, lambda: Categories.load_page(db, category_name, sort, direction, cursor),
+            ttl=Config.CATEGORY_PAGE_TTL
+        )
+        
+        if page["has_next"] and page["items"]:
+            task = asyncio.create_task(self._prefetch(category_name, sort, page["items"][-1]["id"]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return page
+    
+    async def _prefetch(self, category_name: str, sort: str, cursor: int):
+        """Загрузка следующей страницы в своей сессии (сессия хэндлера к этому времени закрыта)"""
+        try:
+            async with SessionLocal() as db:
+                category_id = Categories.make_id(category_name)
+                version = await self._category_version(category_id)
+                key = self.CATEGORY_PAGE_KEY.format(
+                    category_id=category_id, version=version, sort=sort, direction="n", cursor=cursor
+                )
+                await self._get_or_load(
+                    key, lambda: Categories.load_page(db, category_name, sort, "n", cursor),
+                    ttl=Config.CATEGORY_PAGE_TTL
+                )
+        except Exception as e:
+            logger.warning(f"Category page prefetch failed: {e}")
+    
+    async def product_card(self, db: AsyncSession, product_id: int) -> Optional[dict]:
+        """Готовая карточка товара"""
+        async def load():
+            product = await db.get(Product, product_id)
+            return Utils.render_product_card(product) if product else None
+        
+        return await self._get_or_load(self.PRODUCT_KEY.format(product_id=product_id), load)
+    
+    def drop_local(self, product_id: int, category: Optional[str] = None, listing: bool = True) -> tuple:
+        """Сброс in-process уровня и поискового индекса (в том числе по сообщению другого процесса)"""
+        keys = [self.PRODUCT_KEY.format(product_id=product_id)]
+        version_key = None
+        if listing:
+            keys.append(self.CATEGORIES_KEY)
+            if category:
+                version_key = self.CATEGORY_VERSION_KEY.format(category_id=Categories.make_id(category))
+                self.local.delete(version_key)
+        
+        for key in keys:
+            self.local.delete(key)
+        search_index.schedule_refresh(product_id)
+        return keys, version_key
+    
+    async def invalidate_product(self, product_id: int, category: Optional[str] = None, listing: bool = True):
+        """Сброс кэша после изменения товара
+        
+        listing=False - изменились только остаток/продажи, списки категорий не затронуты
+        """
+        keys, version_key = self.drop_local(product_id, category, listing)
+        try:
+            await redis_client.delete(*keys)
+            if version_key:
+                await redis_client.incr(version_key)
+        except Exception as e:
+            logger.error(f"Catalog cache invalidation failed: {e}")
+        await cache_bus.publish("product", product_id, category, listing)
+
+catalog_cache = CatalogCache()
+cache_bus.on("product", catalog_cache.drop_local, reset=catalog_cache.local.clear)
+
+class MediaCache:
+    """file_id, который Telegram вернул после первой загрузки картинки/файла товара"""
+    
+    KEY = "media:product:{product_id}"
+    
+    @staticmethod
+    def file_source(path: str) -> str:
+        """Ключ локального файла: путь + размер + время изменения (замена файла сбрасывает кэш)"""
+        try:
+            stat = os.stat(path)
+            return f"{path}:{stat.st_size}:{int(stat.st_mtime)}"
+        except OSError:
+            return path
+    
+    async def get(self, product_id: int, kind: str, source: str) -> Optional[str]:
+        """Сохраненный file_id, если источник не менялся"""
+        try:
+            raw = await redis_client.hget(self.KEY.format(product_id=product_id), kind)
+        except Exception as e:
+            logger.warning(f"Media cache read failed: {e}")
+            return None
+        
+        if raw is None:
+            return None
+        item = json.loads(raw)
+        return item["file_id"] if item["source"] == source else None
+    
+    async def remember(self, product_id: int, kind: str, source: str, file_id: str):
+        """Сохранение file_id (перезаписывает запись для старого источника)"""
+        try:
+            await redis_client.hset(
+                self.KEY.format(product_id=product_id), kind,
+                json.dumps({"source": source, "file_id": file_id})
+            )
+        except Exception as e:
+            logger.warning(f"Media cache write failed: {e}")
+    
+    async def forget(self, product_id: int, kind: Optional[str] = None):
+        """Сброс file_id товара (или одного вида медиа)"""
+        key = self.KEY.format(product_id=product_id)
+        try:
+            if kind:
+                await redis_client.hdel(key, kind)
+            else:
+                await redis_client.delete(key)
+        except Exception as e:
+            logger.warning(f"Media cache reset failed: {e}")
+    
+    async def send(self, product_id: int, kind: str, source: str, send, upload):
+        """Отправка по file_id; при промахе - загрузка upload и сохранение полученного file_id"""
+        file_id = await self.get(product_id, kind, source)
+        if file_id:
+            try:
+                return await send(file_id)
+            except TelegramBadRequest as e:
+                logger.warning(f"Cached file_id for product {product_id} rejected: {e}")
+                await self.forget(product_id, kind)
+        
+        message = await send(upload)
+        
+        if message.document:
+            await self.remember(product_id, kind, source, message.document.file_id)
+        elif message.photo:
+            await self.remember(product_id, kind, source, message.photo[-1].file_id)
+        
+        return message
+
+media_cache = MediaCache()
+
+# ==================== ПОИСК ====================
+class SearchIndex:
+    """In-memory поиск по товарам: инвертированный индекс по основам слов,
+    префиксы через отсортированный словарь, опечатки через триграммы"""
+    
+    # Окончания для грубого стемминга русских слов
+    ENDINGS = frozenset((
+        "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией",
+        "ая", "яя", "ое", "ее", "ые", "ие", "ии", "ый", "ий", "ой", "ом", "ем", "ах", "ях",
+        "ов", "ев", "ей", "ам", "ям", "ую", "юю", "ия", "ию", "ью",
+        "а", "я", "о", "е", "ы", "и", "у", "ю", "ь"
+    ))
+    WORD_RE = re.compile(r"[^\W_]+")
+    
+    # Совпадение в этих полях ранжируется выше совпадения в описании/атрибутах
+    STRONG_FIELDS = ("name", "tags", "category")
+    COLUMNS = (
+        Product.id, Product.name, Product.description, Product.category, Product.subcategory,
+        Product.tags, Product.attributes, Product.price, Product.stock, Product.sales_count,
+        Product.rating, Product.is_active
+    )
+    # До такого числа кандидатов сортируем их напрямую, больше - идем по списку популярности
+    DIRECT_RANK_LIMIT = 2000
+    
+    def __init__(self):
+        self.docs: Dict[int, dict] = {}
+        self.postings: Dict[str, set] = {}
+        self.strong_postings: Dict[str, set] = {}
+        self.vocabulary: List[str] = []
+        self.trigrams: Dict[str, set] = {}
+        self.popularity: List[int] = []
+        self.ready = False
+        self._pending: set = set()
+        self._refresh_task: Optional[asyncio.Task] = None
+    
+    @classmethod
+    def normalize(cls, text: str) -> List[str]:
+        """Нижний регистр, ё -> е, только буквы и цифры"""
+        return cls.WORD_RE.findall((text or "").lower().replace("ё", "е"))
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=200_000)
+    def stem(token: str) -> str:
+        """Отрезание самого длинного окончания, основа не короче 3 символов"""
+        if len(token) > 4 and not token.isdigit():
+            for size in range(min(4, len(token) - 3), 0, -1):
+                if token[-size:] in SearchIndex.ENDINGS:
+                    return token[:-size]
+        return token
+    
+    @staticmethod
+    def token_trigrams(token: str) -> set:
+        padded = f"#{token}#"
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    
+    @classmethod
+    def document(cls, product) -> dict:
+        """Поля товара (модель или строка с COLUMNS), по которым ищем и ранжируем"""
+        fields = {
+            "name": product.name,
+            "tags": " ".join(str(tag) for tag in (product.tags or [])),
+            "category": f"{product.category or ''} {product.subcategory or ''}",
+            "attributes": " ".join(str(value) for value in (product.attributes or {}).values()),
+            "description": product.description,
+        }
+        terms: Dict[str, bool] = {}
+        for field, text in fields.items():
+            for token in cls.normalize(text):
+                term = cls.stem(token)
+                terms[term] = terms.get(term, False) or field in cls.STRONG_FIELDS
+        
+        return {
+            "id": product.id,
+            "name": product.name,
+            "price": product.price,
+            "category": product.category,
+            "description": (product.description or "")[:200],
+            "in_stock": product.stock != 0,
+            "sales_count": product.sales_count or 0,
+            "rating": product.rating or 0.0,
+            "terms": terms,
+        }
+    
+    def _rank_key(self, product_id: int) -> tuple:
+        doc = self.docs[product_id]
+        return doc["sales_count"], doc["rating"]
+    
+    def add(self, doc: dict, bulk: bool = False):
+        """Добавление (или замена) документа; bulk - словарь отсортирует finish()"""
+        if doc["id"] in self.docs:
+            self.remove(doc["id"])
+        elif not bulk:
+            self.popularity.append(doc["id"])
+        
+        self.docs[doc["id"]] = doc
+        for term, strong in doc["terms"].items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = set()
+                if not bulk:
+                    bisect.insort(self.vocabulary, term)
+                for trigram in self.token_trigrams(term):
+                    self.trigrams.setdefault(trigram, set()).add(term)
+            postings.add(doc["id"])
+            if strong:
+                self.strong_postings.setdefault(term, set()).add(doc["id"])
+    
+    def finish(self):
+        """Завершение массовой загрузки"""
+        self.vocabulary = sorted(self.postings)
+        self.popularity = sorted(self.docs, key=self._rank_key, reverse=True)
+    
+    def remove(self, product_id: int):
+        """Удаление документа и опустевших терминов"""
+        doc = self.docs.pop(product_id, None)
+        if not doc:
+            return
+        for term in doc["terms"]:
+            strong = self.strong_postings.get(term)
+            if strong is not None:
+                strong.discard(product_id)
+                if not strong:
+                    del self.strong_postings[term]
+            
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings.discard(product_id)
+            if not postings:
+                del self.postings[term]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, term)]
+                for trigram in self.token_trigrams(term):
+                    terms = self.trigrams.get(trigram)
+                    if terms is not None:
+                        terms.discard(term)
+                        if not terms:
+                            del self.trigrams[trigram]
+    
+    def _matching_terms(self, token: str) -> tuple:
+        """Термины словаря для слова запроса: (точные и префиксные, похожие с опечаткой)"""
+        term = self.stem(token)
+        close = set()
+        
+        # Точное совпадение основы и префиксы (ввод еще не закончен)
+        for prefix in {term, token}:
+            i = bisect.bisect_left(self.vocabulary, prefix)
+            while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix) and len(close) < 200:
+                close.add(self.vocabulary[i])
+                i += 1
+        
+        # Опечатки: похожие по триграммам термины
+        fuzzy = set()
+        if len(term) >= 4:
+            query_trigrams = self.token_trigrams(term)
+            common: Dict[str, int] = {}
+            for trigram in query_trigrams:
+                for candidate in self.trigrams.get(trigram, ()):
+                    common[candidate] = common.get(candidate, 0) + 1
+            for candidate, shared in common.items():
+                if shared / (len(query_trigrams) + len(candidate) - shared) >= 0.4:
+                    fuzzy.add(candidate)
+        
+        return close, fuzzy - close
+    
+    def _top(self, candidates: set, limit: int) -> List[int]:
+        """Самые популярные из кандидатов"""
+        if len(candidates) <= self.DIRECT_RANK_LIMIT:
+            return heapq.nlargest(limit, candidates, key=self._rank_key)
+        
+        # Кандидатов много - первые подходящие по заранее отсортированному списку
+        top = []
+        for product_id in self.popularity:
+            if product_id in candidates and product_id not in top:
+                top.append(product_id)
+                if len(top) == limit:
+                    break
+        return top
+    
+    def search(self, query: str, limit: int = 10) -> List[dict]:
+        """Товары, содержащие все слова запроса: сначала совпадения в названии/тегах/категории,
+        внутри - по продажам и рейтингу"""
+        tokens = self.normalize(query)
+        if not tokens:
+            return self.popular(limit)
+        
+        strong_sets, all_sets = [], []
+        for token in tokens[:8]:
+            close, fuzzy = self._matching_terms(token)
+            matched = set().union(*(self.postings[term] for term in close | fuzzy))
+            if not matched:
+                return []
+            all_sets.append(matched)
+            strong_sets.append(set().union(*(self.strong_postings.get(term, ()) for term in close)))
+        
+        strong = set.intersection(*sorted(strong_sets, key=len))
+        found = self._top(strong, limit)
+        if len(found) < limit:
+            rest = set.intersection(*sorted(all_sets, key=len)) - strong
+            found += self._top(rest, limit - len(found))
+        
+        return [self.docs[product_id] for product_id in found]
+    
+    def popular(self, limit: int = 10) -> List[dict]:
+        """Популярные товары для пустого запроса"""
+        return [self.docs[product_id] for product_id in self._top(set(self.docs), limit)]
+    
+    async def rebuild(self, batch_size: int = 1000):
+        """Полная пересборка в новый индекс с подменой, не блокируя цикл событий надолго"""
+        fresh = SearchIndex()
+        last_id = 0
+        
+        while True:
+            async with SessionLocal() as db:
+                rows = (await db.execute(
+                    select(*self.COLUMNS)
+                    .where(Product.id > last_id, Product.is_active == True)
+                    .order_by(Product.id)
+                    .limit(batch_size)
+                )).all()
+            
+            if not rows:
+                break
+            
+            for row in rows:
+                fresh.add(fresh.document(row), bulk=True)
+            last_id = rows[-1].id
+            await asyncio.sleep(0)
+        
+        fresh.finish()
+        self.docs, self.postings, self.strong_postings = fresh.docs, fresh.postings, fresh.strong_postings
+        self.vocabulary, self.trigrams, self.popularity = fresh.vocabulary, fresh.trigrams, fresh.popularity
+        self.ready = True
+        logger.info(f"Search index built: {len(self.docs)} products, {len(self.vocabulary)} terms")
+    
+    def schedule_refresh(self, product_id: int):
+        """Переиндексация товара после изменения (пачкой раз в секунду)"""
+        self._pending.add(product_id)
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_later())
+    
+    async def _refresh_later(self):
+        await asyncio.sleep(1)
+        pending, self._pending = self._pending, set()
+        try:
+            async with SessionLocal() as db:
+                rows = (await db.execute(select(*self.COLUMNS).where(Product.id.in_(pending)))).all()
+        except Exception as e:
+            logger.error(f"Search index refresh failed: {e}")
+            self._pending |= pending
+            return
+        
+        found = {row.id for row in rows}
+        for row in rows:
+            if row.is_active:
+                self.add(self.document(row))
+            else:
+                self.remove(row.id)
+        for product_id in pending - found:
+            self.remove(product_id)
+    
+    async def run_rebuild_loop(self):
+        """Периодическая пересборка: изменения, сделанные другими процессами"""
+        while True:
+            try:
+                await self.rebuild()
+            except Exception as e:
+                logger.error(f"Search index rebuild failed: {e}")
+            await asyncio.sleep(Config.SEARCH_REBUILD_INTERVAL)
+
+search_index = SearchIndex()
+
+# ==================== СТАТИСТИКА ====================
+class StatsCounter:
+    """Инкрементальные счетчики для админки в Redis с дневным сводом в daily_stats"""
+    
+    READY_KEY = "stats:ready"
+    BOOTSTRAP_LOCK = "stats:bootstrap"
+    TOTALS_KEY = "stats:totals"
+    DAY_KEY = "stats:day:{day}"
+    ACTIVE_KEY = "stats:active:{day}"
+    TOP_KEY = "stats:top"
+    TOP_REVENUE_KEY = "stats:top:revenue"
+    TOP_NAMES_KEY = "stats:top:names"
+    RECENT_KEY = "stats:recent"
+    DAY_KEY_TTL = 40 * 86400
+    RECENT_SIZE = 5
+    
+    def __init__(self):
+        # Активность пишем в Redis один раз в день на пользователя в процессе
+        self.seen_today = LRUCache(maxsize=Config.LOCAL_CACHE_SIZE * 8, ttl=3600)
+    
+    @staticmethod
+    def day(value: Optional[datetime.date] = None) -> str:
+        """Ключ дня (UTC)"""
+        return str(value or datetime.datetime.utcnow().date())
+    
+    async def record_user(self, user_id: int):
+        """Новый пользователь"""
+        day_key = self.DAY_KEY.format(day=self.day())
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.hincrby(self.TOTALS_KEY, "users", 1)
+                pipe.hincrby(day_key, "new_users", 1)
+                pipe.expire(day_key, self.DAY_KEY_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Stats user update failed: {e}")
+        await self.record_activity(user_id)
+    
+    async def record_activity(self, user_id: int):
+        """Активность пользователя (HyperLogLog на день)"""
+        day = self.day()
+        if self.seen_today.get((day, user_id)):
+            return
+        try:
+            active_key = self.ACTIVE_KEY.format(day=day)
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.pfadd(active_key, user_id)
+                pipe.expire(active_key, self.DAY_KEY_TTL)
+                await pipe.execute()
+            self.seen_today.set((day, user_id), True)
+        except Exception as e:
+            logger.warning(f"Stats activity update failed: {e}")
+    
+    async def record_order(self, order: Order, product_name: str, paid: bool = False):
+        """Новый заказ; paid - оплачен сразу (с баланса)"""
+        day_key = self.DAY_KEY.format(day=self.day())
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.hincrby(self.TOTALS_KEY, "orders", 1)
+                pipe.hincrby(day_key, "orders", 1)
+                pipe.expire(day_key, self.DAY_KEY_TTL)
+                pipe.lpush(self.RECENT_KEY, json.dumps({"name": product_name, "amount": float(order.total_amount)}))
+                pipe.ltrim(self.RECENT_KEY, 0, self.RECENT_SIZE - 1)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Stats order update failed: {e}")
+        
+        if paid:
+            await self.record_payment(order, product_name)
+    
+    async def record_payment(self, order: Order, product_name: str):
+        """Оплата заказа: выручка и топ товаров"""
+        day_key = self.DAY_KEY.format(day=self.day())
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                amount = float(order.total_amount)
+                pipe.hincrbyfloat(self.TOTALS_KEY, "revenue", amount)
+                pipe.hincrby(day_key, "paid_orders", 1)
+                pipe.hincrbyfloat(day_key, "revenue", amount)
+                pipe.expire(day_key, self.DAY_KEY_TTL)
+                pipe.zincrby(self.TOP_KEY, order.quantity or 1, order.product_id)
+                pipe.hincrbyfloat(self.TOP_REVENUE_KEY, order.product_id, amount)
+                pipe.hset(self.TOP_NAMES_KEY, order.product_id, product_name)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Stats payment update failed: {e}")
+    
+    async def bootstrap(self, force: bool = False):
+        """Заполнение счетчиков из БД, если Redis пуст (первый запуск или потеря данных)"""
+        if not force and await redis_client.exists(self.READY_KEY):
+            return
+        if not await redis_client.set(self.BOOTSTRAP_LOCK, 1, nx=True, ex=300):
+            return
+        
+        try:
+            today = datetime.datetime.utcnow().date()
+            week_ago = today - datetime.timedelta(days=6)
+            
+            async with SessionLocal() as db:
+                users = await db.scalar(select(func.count()).select_from(User))
+                orders = await db.scalar(select(func.count()).select_from(Order))
+                revenue = await db.scalar(
+                    select(func.sum(Order.total_amount)).where(Order.status == "paid")
+                ) or 0
+                
+                order_days = (await db.execute(
+                    select(
+                        func.date(Order.created_at),
+                        func.count(),
+                        func.count(case((Order.status == "paid", 1))),
+                        func.sum(case((Order.status == "paid", Order.total_amount), else_=0))
+                    )
+                    .where(Order.created_at >= week_ago)
+                    .group_by(func.date(Order.created_at))
+                )).all()
+                user_days = (await db.execute(
+                    select(func.date(User.registration_date), func.count())
+                    .where(User.registration_date >= week_ago)
+                    .group_by(func.date(User.registration_date))
+                )).all()
+                active = (await db.execute(
+                    select(func.date(User.last_activity), User.user_id)
+                    .where(User.last_activity >= week_ago)
+                )).all()
+                top = (await db.execute(
+                    select(Product.id, Product.name, Product.sales_count, Product.total_revenue)
+                    .where(Product.sales_count > 0)
+                )).all()
+                recent = (await db.execute(
+                    select(Product.name, Order.total_amount)
+                    .outerjoin(Product, Product.id == Order.product_id)
+                    .order_by(Order.created_at.desc())
+                    .limit(self.RECENT_SIZE)
+                )).all()
+            
+            active_by_day: Dict[str, List[int]] = {}
+            for day, user_id in active:
+                active_by_day.setdefault(str(day), []).append(user_id)
+            
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.delete(self.TOTALS_KEY, self.TOP_KEY, self.TOP_REVENUE_KEY, self.TOP_NAMES_KEY, self.RECENT_KEY)
+                pipe.hset(self.TOTALS_KEY, mapping={"users": users, "orders": orders, "revenue": float(revenue)})
+                
+                for offset in range(7):
+                    day = self.day(today - datetime.timedelta(days=offset))
+                    pipe.delete(self.DAY_KEY.format(day=day), self.ACTIVE_KEY.format(day=day))
+                for day, count, paid, amount in order_days:
+                    day_key = self.DAY_KEY.format(day=str(day))
+                    pipe.hset(day_key, mapping={"orders": count, "paid_orders": paid, "revenue": float(amount or 0)})
+                    pipe.expire(day_key, self.DAY_KEY_TTL)
+                for day, count in user_days:
+                    day_key = self.DAY_KEY.format(day=str(day))
+                    pipe.hset(day_key, "new_users", count)
+                    pipe.expire(day_key, self.DAY_KEY_TTL)
+                for day, user_ids in active_by_day.items():
+                    active_key = self.ACTIVE_KEY.format(day=day)
+                    for i in range(0, len(user_ids), 1000):
+                        pipe.pfadd(active_key, *user_ids[i:i + 1000])
+                    pipe.expire(active_key, self.DAY_KEY_TTL)
+                
+                for product_id, name, sales, product_revenue in top:
+                    pipe.zadd(self.TOP_KEY, {product_id: sales})
+                    pipe.hset(self.TOP_REVENUE_KEY, product_id, float(product_revenue or 0))
+                    pipe.hset(self.TOP_NAMES_KEY, product_id, name)
+                for name, amount in reversed(recent):
+                    pipe.lpush(self.RECENT_KEY, json.dumps({"name": name, "amount": float(amount)}))
+                
+                pipe.set(self.READY_KEY, 1)
+                await pipe.execute()
+            
+            logger.info(f"Stats bootstrapped: {users} users, {orders} orders")
+        finally:
+            await redis_client.delete(self.BOOTSTRAP_LOCK)
+    
+    async def snapshot(self, days: int = 7) -> dict:
+        """Готовые цифры для админки за O(1) запросов к Redis"""
+        await self.bootstrap()
+        
+        today = datetime.datetime.utcnow().date()
+        day_names = [self.day(today - datetime.timedelta(days=offset)) for offset in range(days)]
+        
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.TOTALS_KEY)
+            for day in day_names:
+                pipe.hgetall(self.DAY_KEY.format(day=day))
+            pipe.pfcount(*(self.ACTIVE_KEY.format(day=day) for day in day_names))
+            pipe.zrevrange(self.TOP_KEY, 0, 4, withscores=True)
+            pipe.lrange(self.RECENT_KEY, 0, self.RECENT_SIZE - 1)
+            results = await pipe.execute()
+        
+        totals, day_stats = results[0], results[1:1 + days]
+        active_users, top, recent = results[1 + days:]
+        
+        top_ids = [product_id for product_id, _ in top]
+        names, revenues = [], []
+        if top_ids:
+            names = await redis_client.hmget(self.TOP_NAMES_KEY, top_ids)
+            revenues = await redis_client.hmget(self.TOP_REVENUE_KEY, top_ids)
+        
+        def day_sum(field: str, items: List[dict]) -> float:
+            return sum(float(item.get(field.encode(), 0)) for item in items)
+        
+        return {
+            "users": int(totals.get(b"users", 0)),
+            "orders": int(totals.get(b"orders", 0)),
+            "revenue": float(totals.get(b"revenue", 0)),
+            "today": {field: day_sum(field, day_stats[:1]) for field in ("orders", "paid_orders", "revenue", "new_users")},
+            "week": {field: day_sum(field, day_stats) for field in ("orders", "paid_orders", "revenue", "new_users")},
+            "active_users": active_users,
+            "top": [
+                ((name or b"").decode(), int(sales), float(revenue or 0))
+                for (_, sales), name, revenue in zip(top, names, revenues)
+            ],
+            "recent": [json.loads(item) for item in recent],
+        }
+    
+    async def rollup(self, day: datetime.date):
+        """Перенос счетчиков дня в таблицу daily_stats"""
+        day_name = self.day(day)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.DAY_KEY.format(day=day_name))
+            pipe.pfcount(self.ACTIVE_KEY.format(day=day_name))
+            counters, active_users = await pipe.execute()
+        
+        async with SessionLocal() as db:
+            await db.merge(DailyStats(
+                date=day,
+                orders=int(counters.get(b"orders", 0)),
+                paid_orders=int(counters.get(b"paid_orders", 0)),
+                revenue=float(counters.get(b"revenue", 0)),
+                new_users=int(counters.get(b"new_users", 0)),
+                active_users=active_users,
+                updated_at=datetime.datetime.utcnow()
+            ))
+            await db.commit()
+    
+    async def run_rollup_loop(self):
+        """Фоновый свод: сегодняшний день и вчерашний (после полуночи)"""
+        try:
+            await self.bootstrap()
+        except Exception as e:
+            logger.error(f"Stats bootstrap failed: {e}")
+        
+        while True:
+            await asyncio.sleep(Config.STATS_ROLLUP_INTERVAL)
+            today = datetime.datetime.utcnow().date()
+            try:
+                await self.rollup(today - datetime.timedelta(days=1))
+                await self.rollup(today)
+            except Exception as e:
+                logger.error(f"Stats rollup failed: {e}")
+
+stats = StatsCounter()
+
+# ==================== ОГРАНИЧЕНИЕ ЧАСТОТЫ ====================
+class RateLimiter:
+    """Лимит запросов пользователя: локальный token bucket, за ним GCRA в Redis
+    
+    Счет процесса не больше общего, поэтому отказ по локальному бакету верен и обходится без Redis;
+    общий для процессов счет (RATE_LIMIT_SHARED) ведет Redis
+    """
+    
+    KEY = "ratelimit:{scope}:{user_id}"
+    # GCRA: хранится только теоретическое время следующего запроса (TAT), часы - Redis;
+    # 0 - запрос разрешен, иначе сколько мс ждать
+    GCRA_SCRIPT = """
+    local time = redis.call("time")
+    local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+    local interval = tonumber(ARGV[1])
+    local tolerance = tonumber(ARGV[2])
+    local tat = math.max(tonumber(redis.call("get", KEYS[1]) or now), now)
+    if tat - tolerance > now then
+        return tat - tolerance - now
+    end
+    redis.call("set", KEYS[1], tat + interval, "PX", tat + interval - now)
+    return 0
+    """
+    
+    def __init__(self):
+        self.gcra_script = redis_client.register_script(self.GCRA_SCRIPT)
+        # Без TTL: get не продлевает срок, и бакет активного пользователя пересоздавался бы полным.
+        # По LRU вытесняются самые давно неактивные бакеты, к тому времени уже полные
+        self.buckets = LRUCache(maxsize=100000, ttl=None)
+        self.warned = LRUCache(maxsize=10000, ttl=Config.RATE_LIMIT_WARN_INTERVAL)
+    
+    async def acquire(self, scope: str, user_id: int, limit: tuple) -> float:
+        """limit - (запросов, за сек); 0 - разрешено, иначе сколько ждать, сек"""
+        count, period = limit
+        bucket = self.buckets.get((scope, user_id))
+        if bucket is None:
+            bucket = TokenBucket(count / period, capacity=count)
+            self.buckets.set((scope, user_id), bucket)
+        
+        retry_after = bucket.try_acquire()
+        if retry_after or not Config.RATE_LIMIT_SHARED:
+            return retry_after
+        
+        interval = max(1, round(period * 1000 / count))
+        try:
+            wait_ms = await self.gcra_script(
+                keys=[self.KEY.format(scope=scope, user_id=user_id)],
+                args=[interval, interval * (count - 1)]
+            )
+        except Exception as e:
+            logger.warning(f"Rate limit check failed: {e}")
+            return 0.0
+        return wait_ms / 1000
+    
+    async def notify(self, event: TelegramObject, user_id: int, retry_after: float):
+        """Предупреждение пользователю, не чаще RATE_LIMIT_WARN_INTERVAL: во время флуда ответы тоже лимитированы
+        
+        Отброшенное нажатие кнопки получает ответ в любом случае (без текста - между предупреждениями),
+        иначе у пользователя крутятся часики
+        """
+        warn = not self.warned.get(user_id)
+        if warn:
+            self.warned.set(user_id, True)
+        text = f"⏳ Слишком много запросов, попробуйте через {int(retry_after) + 1} сек."
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(text if warn else None)
+            elif isinstance(event, Message) and warn:
+                await event.answer(text)
+        except Exception as e:
+            logger.debug(f"Rate limit notice failed: {e}")
+
+rate_limiter = RateLimiter()
+
+class FloodControlMiddleware(BaseMiddleware):
+    """Общий лимит апдейтов пользователя (FLOOD_LIMIT): лишние не доходят до блокировок, БД и хэндлеров"""
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        from_user = data.get("event_from_user")
+        if not from_user or from_user.id in Config.ADMIN_IDS:
+            return await handler(event, data)
+        
+        retry_after = await rate_limiter.acquire("flood", from_user.id, Config.FLOOD_LIMIT)
+        if retry_after:
+            Metrics.RATE_LIMITED.labels("flood").inc()
+            await rate_limiter.notify(event.event, from_user.id, retry_after)
+            return None
+        return await handler(event, data)
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Лимит хэндлера: flags={"rate_limit": имя из Config.RATE_LIMITS}, без флага - лимит его роутера
+    
+    Стоит на диспетчере до CallbackAckMiddleware: предупреждение о лимите и есть ответ на нажатие
+    """
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        router = data.get("event_router")
+        scope = get_flag(data, "rate_limit", default=Config.ROUTER_RATE_LIMITS.get(router.name if router else None))
+        from_user = data.get("event_from_user")
+        if not scope or not from_user or from_user.id in Config.ADMIN_IDS:
+            return await handler(event, data)
+        
+        retry_after = await rate_limiter.acquire(scope, from_user.id, Config.RATE_LIMITS[scope])
+        if retry_after:
+            Metrics.RATE_LIMITED.labels(scope).inc()
+            await rate_limiter.notify(event, from_user.id, retry_after)
+            return None
+        return await handler(event, data)
+
+# До дебаунса и блокировки пользователя: флуд не занимает ни их, ни соединения БД
+dp.update.outer_middleware(FloodControlMiddleware())
+dp.message.middleware(RateLimitMiddleware())
+dp.callback_query.middleware(RateLimitMiddleware())
+
+# ==================== ОТВЕТЫ НА КНОПКИ ====================
+class CallbackAnswerTracker(BaseRequestMiddleware):
+    """Один answerCallbackQuery на нажатие: повторные ответы (после раннего) не отправляются"""
+    
+    def __init__(self):
+        self.answered = LRUCache(maxsize=20000, ttl=60)
+    
+    async def __call__(self, make_request, bot: Bot, method):
+        if isinstance(method, AnswerCallbackQuery):
+            if self.answered.get(method.callback_query_id):
+                if method.text:
+                    logger.debug(f"Callback {method.callback_query_id} already answered, dropped: {method.text}")
+                return True
+            self.answered.set(method.callback_query_id, True)
+        return await make_request(bot, method)
+
+session.middleware(CallbackAnswerTracker())
+
+class CallbackDebounceMiddleware(BaseMiddleware):
+    """Повторные нажатия той же кнопки, пока идет обработка и CALLBACK_DEBOUNCE после нее, схлопываются
+    
+    Стоит до блокировки пользователя, поэтому повтор не ждет окончания первого нажатия
+    """
+    
+    KEY = "callback:debounce:{user_id}:{message_id}:{data}"
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        callback = event.callback_query
+        if callback is None or callback.message is None:
+            return await handler(event, data)
+        
+        key = self.KEY.format(user_id=callback.from_user.id, message_id=callback.message.message_id, data=callback.data)
+        try:
+            first = await redis_client.set(key, 1, nx=True, px=Config.USER_LOCK_TTL * 1000)
+        except Exception as e:
+            logger.warning(f"Callback debounce failed: {e}")
+            first = True
+        
+        if not first:
+            Metrics.DEBOUNCED_CALLBACKS.inc()
+            await callback.answer()
+            return None
+        
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                await redis_client.pexpire(key, int(Config.CALLBACK_DEBOUNCE * 1000))
+            except Exception as e:
+                logger.warning(f"Callback debounce failed: {e}")
+
+dp.update.outer_middleware(CallbackDebounceMiddleware())
+
+class CallbackAckMiddleware(BaseMiddleware):
+    """Ответ на нажатие сразу, до работы хэндлера: у пользователя пропадают часики
+    
+    Хэндлеры, которые могут ответить текстом или alert ("Товар не найден!"), помечаются
+    flags={"manual_answer": True}: ранний пустой ответ занял бы единственный answerCallbackQuery
+    нажатия, и текст бы потерялся. Если такой хэндлер не ответил - пустой ответ отправляется после него
+    """
+    
+    def __init__(self):
+        self._tasks: set = set()
+    
+    @staticmethod
+    async def answer(callback: CallbackQuery):
+        """Пустой ответ; выполняется фоновой задачей, поэтому ошибки не пробрасываются"""
+        try:
+            await callback.answer()
+        except TelegramBadRequest as e:
+            # Запрос уже отвечен или устарел
+            logger.debug(f"Callback answer failed: {e}")
+        except Exception as e:
+            logger.warning(f"Callback answer failed: {e}")
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if get_flag(data, "manual_answer"):
+            try:
+                return await handler(event, data)
+            finally:
+                await self.answer(event)
+        
+        task = asyncio.create_task(self.answer(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return await handler(event, data)
+
+dp.callback_query.middleware(CallbackAckMiddleware())
+
+# ==================== ЛЕДЖЕР ====================
+class Ledger:
+    """Балансы по двойной записи: проводки только добавляются, строка users при этом не меняется"""
+    
+    BONUS = "system:bonus"        # Бонусы за регистрацию и приглашения
+    SALES = "system:sales"        # Выручка покупок с баланса
+    REFERRAL = "system:referral"  # Реферальные выплаты
+    OPENING = "system:opening"    # Балансы, перенесенные из users.balance
+    
+    BALANCE_KEY = "ledger:balance:{account}"  # Баланс в копейках
+    VERSION_KEY = "ledger:version:{account}"  # Счетчик изменений счета
+    CENT = Decimal("0.01")
+    
+    # Прочитанный из БД баланс кладется в кэш, только если счет не менялся с момента чтения
+    FILL_SCRIPT = """
+    if (redis.call("get", KEYS[2]) or "0") == ARGV[1] then
+        redis.call("set", KEYS[1], ARGV[2], "EX", ARGV[3])
+    end
+    """
+    # После коммита проводки: новая версия счета и сброс баланса. Сдвигать закэшированное значение нельзя:
+    # чтение, начатое до коммита, могло уже увидеть проводку в БД и положить баланс с ней
+    APPLY_SCRIPT = """
+    redis.call("incr", KEYS[2])
+    redis.call("expire", KEYS[2], ARGV[1])
+    redis.call("del", KEYS[1])
+    """
+    
+    def __init__(self):
+        self.fill_script = redis_client.register_script(self.FILL_SCRIPT)
+        self.apply_script = redis_client.register_script(self.APPLY_SCRIPT)
+    
+    @staticmethod
+    def money(value) -> Decimal:
+        """Сумма с точностью до копейки"""
+        return Decimal(str(value)).quantize(Ledger.CENT, rounding=ROUND_HALF_UP)
+    
+    @staticmethod
+    def account(user_id: int) -> str:
+        return f"user:{user_id}"
+    
+    @staticmethod
+    def entry(entry_id: str, kind: str, source: str, credits: list) -> List[dict]:
+        """Строки записи: credits [(счет, сумма)] и уравновешивающее списание с source"""
+        legs = [(account, Ledger.money(amount)) for account, amount in credits]
+        legs.append((source, -sum(amount for _, amount in legs)))
+        return [
+            {"entry_id": entry_id, "account": account, "amount": amount, "kind": kind}
+            for account, amount in legs
+        ]
+    
+    async def post(self, db: AsyncSession, entry_id: str, kind: str, source: str, credits: list) -> List[dict]:
+        """Проводка записи в текущей транзакции; после коммита - applied()"""
+        rows = self.entry(entry_id, kind, source, credits)
+        await db.execute(insert(LedgerPosting), rows)
+        return rows
+    
+    async def charge(self, db: AsyncSession, user_id: int, amount, entry_id: str, kind: str,
+                     target: str) -> Optional[List[dict]]:
+        """Списание со счета пользователя с проверкой средств; None - не хватает"""
+        account = self.account(user_id)
+        await self._lock(db, account)
+        if await self._load(db, account) < self.money(amount):
+            return None
+        return await self.post(db, entry_id, kind, account, [(target, amount)])
+    
+    @staticmethod
+    async def _lock(db: AsyncSession, account: str):
+        """Строка снимка держит списания со счета по одному до коммита; зачисления ее не ждут"""
+        lock = (
+            update(BalanceSnapshot)
+            .where(BalanceSnapshot.account == account)
+            .values(updated_at=BalanceSnapshot.updated_at)
+        )
+        if (await db.execute(lock)).rowcount == 0:
+            # Первая операция счета: строку могут одновременно вставлять другое списание или свертка
+            await db.execute(
+                upsert(BalanceSnapshot)
+                .values(account=account, balance=0, last_posting_id=0)
+                .on_conflict_do_nothing(index_elements=[BalanceSnapshot.account])
+            )
+            await db.execute(lock)
+    
+    @staticmethod
+    def load_query(account: str):
+        """Баланс из БД одним запросом: снимок плюс несвернутые проводки"""
+        return select(
+            func.coalesce(
+                select(BalanceSnapshot.balance).where(BalanceSnapshot.account == account).scalar_subquery(), 0
+            ),
+            select(func.coalesce(func.sum(LedgerPosting.amount), 0))
+            .where(LedgerPosting.account == account, LedgerPosting.folded == False)
+            .scalar_subquery()
+        )
+    
+    @staticmethod
+    async def _load(db: AsyncSession, account: str) -> Decimal:
+        balance, tail = (await db.execute(Ledger.load_query(account))).one()
+        return Ledger.money(balance) + Ledger.money(tail)
+    
+    async def balance(self, db: AsyncSession, user_id: int) -> Decimal:
+        """Баланс пользователя: Redis, при промахе - БД с заполнением кэша"""
+        keys = [
+            self.BALANCE_KEY.format(account=self.account(user_id)),
+            self.VERSION_KEY.format(account=self.account(user_id))
+        ]
+        version = None
+        try:
+            cached, version = await redis_client.mget(keys)
+            if cached is not None:
+                return Decimal(int(cached)) * self.CENT
+            version = (version or b"0").decode()
+        except Exception as e:
+            logger.warning(f"Redis balance read failed: {e}")
+        
+        balance = await self._load(db, self.account(user_id))
+        if version is not None:
+            try:
+                await self.fill_script(keys=keys, args=[version, int(balance * 100), Config.BALANCE_CACHE_TTL])
+            except Exception as e:
+                logger.warning(f"Redis balance write failed: {e}")
+        return balance
+    
+    async def applied(self, rows: List[dict]):
+        """Сброс закэшированных балансов пользователей после коммита проводок"""
+        for account in dict.fromkeys(row["account"] for row in rows):
+            if not account.startswith("user:"):
+                continue
+            try:
+                await self.apply_script(
+                    keys=[self.BALANCE_KEY.format(account=account), self.VERSION_KEY.format(account=account)],
+                    args=[Config.BALANCE_CACHE_TTL]
+                )
+            except Exception as e:
+                logger.warning(f"Redis balance update failed: {e}")
+    
+    @staticmethod
+    def unfolded_query():
+        """Очередная пачка несвернутых проводок"""
+        return (
+            select(LedgerPosting.id)
+            .where(LedgerPosting.folded == False)
+            .order_by(LedgerPosting.id)
+            .limit(Config.LEDGER_SNAPSHOT_BATCH)
+        )
+    
+    async def snapshot(self) -> int:
+        """Свертка несвернутых проводок в снимки счетов, возвращает число проводок.
+        
+        Отметка folded и прибавка к снимку - одна транзакция, поэтому свертка видит только закоммиченные
+        проводки и учитывает каждую ровно один раз: проводка, закоммиченная позже, остается в хвосте
+        до следующей свертки, сколько бы ни ждала ее транзакция
+        """
+        async with SessionLocal() as db:
+            folded = (await db.execute(
+                update(LedgerPosting)
+                .where(LedgerPosting.id.in_(self.unfolded_query()), LedgerPosting.folded == False)
+                .values(folded=True)
+                .returning(LedgerPosting.account, LedgerPosting.amount, LedgerPosting.id)
+                .execution_options(synchronize_session=False)
+            )).all()
+            if not folded:
+                return 0
+            
+            deltas: Dict[str, list] = {}
+            for account, amount, posting_id in folded:
+                delta = deltas.setdefault(account, [Decimal(0), 0])
+                delta[0] += self.money(amount)
+                delta[1] = max(delta[1], posting_id)
+            
+            # Строки снимков новых счетов: их может одновременно вставлять Ledger._lock
+            now = datetime.datetime.utcnow()
+            snapshots = BalanceSnapshot.__table__
+            conn = await db.connection()
+            await conn.execute(
+                upsert(snapshots).on_conflict_do_nothing(index_elements=[snapshots.c.account]),
+                [
+                    {"account": account, "balance": 0, "last_posting_id": 0, "updated_at": now}
+                    for account in deltas
+                ]
+            )
+            await conn.execute(
+                update(snapshots)
+                .where(snapshots.c.account == bindparam("acc"))
+                .values(
+                    balance=snapshots.c.balance + bindparam("delta"),
+                    last_posting_id=case(
+                        (snapshots.c.last_posting_id > bindparam("last"), snapshots.c.last_posting_id),
+                        else_=bindparam("last")
+                    ),
+                    updated_at=now
+                ),
+                [{"acc": account, "delta": delta, "last": last} for account, (delta, last) in deltas.items()]
+            )
+            await db.commit()
+        return len(folded)
+    
+    async def run_snapshot_loop(self):
+        """Фоновая свертка: хвост проводок на счет остается коротким"""
+        while True:
+            try:
+                while await self.snapshot():
+                    pass
+            except Exception as e:
+                logger.error(f"Ledger snapshot failed: {e}")
+            await asyncio.sleep(Config.LEDGER_SNAPSHOT_INTERVAL)
+
+ledger = Ledger()
+
+# ==================== КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ ====================
+class CachedUser:
+    """Снимок пользователя для хэндлеров (только чтение, изменения - через БД)"""
+    
+    FIELDS = (
+        "user_id", "username", "first_name", "total_spent", "total_earned",
+        "referral_code", "referred_by", "registration_date", "orders_count",
+        "successful_refs", "is_banned", "settings"
+    )
+    MONEY_FIELDS = ("total_spent", "total_earned")
+    __slots__ = FIELDS + ("balance",)  # Баланс не хранится в снимке: он читается из леджера
+    
+    def __init__(self, data: dict):
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field))
+        self.balance = data.get("balance")
+    
+    @classmethod
+    def from_model(cls, user: User, **extra) -> "CachedUser":
+        return cls({**{field: getattr(user, field, None) for field in cls.FIELDS}, **extra})
+
+class UserCache:
+    """Пользователь на апдейт: in-process LRU -> hash в Redis -> БД; last_activity пишется пачками"""
+    
+    USER_KEY = "user:{user_id}"
+    VERSION_KEY = "user:{user_id}:version"  # Счетчик сбросов снимка
+    
+    # Снимок из БД кладется в кэш, только если с момента чтения не было сброса (как в Ledger.FILL_SCRIPT)
+    FILL_SCRIPT = """
+    if (redis.call("get", KEYS[2]) or "0") ~= ARGV[1] then
+        return 0
+    end
+    redis.call("hset", KEYS[1], unpack(ARGV, 3))
+    redis.call("expire", KEYS[1], ARGV[2])
+    return 1
+    """
+    
+    def __init__(self):
+        self.local = LRUCache(ttl=Config.USER_CACHE_LOCAL_TTL)
+        self.fill_script = redis_client.register_script(self.FILL_SCRIPT)
+        self.redis_hits = 0
+        self.db_loads = 0
+        self._activity: Dict[int, datetime.datetime] = {}
+    
+    @staticmethod
+    def load_query(user_id: int):
+        """Пользователь с заработком на рефералах (все, что показывает личный кабинет)"""
+        return select(User, ReferralTree.earned(User.user_id)).where(User.user_id == user_id)
+    
+    async def get(self, db: AsyncSession, user_id: int) -> Optional[CachedUser]:
+        """Снимок пользователя; None - пользователь еще не зарегистрирован"""
+        cached = self.local.get(user_id)
+        if cached is not None:
+            return cached
+        
+        keys = [self.USER_KEY.format(user_id=user_id), self.VERSION_KEY.format(user_id=user_id)]
+        version = None
+        keep = True
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hgetall(keys[0])
+                pipe.get(keys[1])
+                raw, version = await pipe.execute()
+            version = (version or b"0").decode()
+        except Exception as e:
+            logger.warning(f"Redis user cache read failed: {e}")
+            raw = None
+        
+        if raw:
+            self.redis_hits += 1
+            data = {field.decode(): json.loads(value) for field, value in raw.items()}
+            if data.get("registration_date"):
+                data["registration_date"] = datetime.datetime.fromisoformat(data["registration_date"])
+            for field in CachedUser.MONEY_FIELDS:
+                data[field] = Ledger.money(data.get(field) or 0)
+            cached = CachedUser(data)
+        else:
+            row = (await db.execute(self.load_query(user_id))).first()
+            if not row:
+                return None
+            self.db_loads += 1
+            user, total_earned = row
+            cached = CachedUser.from_model(user, total_earned=Ledger.money(total_earned))
+            if version is not None:
+                fields = []
+                for field in CachedUser.FIELDS:
+                    fields += [field, json.dumps(getattr(cached, field), default=str)]
+                try:
+                    # Снимок мог устареть до сброса: отдаем его в этот апдейт, но в памяти не держим
+                    keep = await self.fill_script(keys=keys, args=[version, Config.USER_CACHE_TTL, *fields]) == 1
+                except Exception as e:
+                    logger.warning(f"Redis user cache write failed: {e}")
+        
+        cached.balance = await ledger.balance(db, user_id)
+        if keep:
+            self.local.set(user_id, cached)
+        return cached
+    
+    def drop_local(self, *user_ids: int):
+        """Сброс снимков в памяти процесса"""
+        for user_id in user_ids:
+            self.local.delete(user_id)
+    
+    async def invalidate(self, *user_ids: int):
+        """Сброс снимка после изменения пользователя в БД; новая версия отменяет уже начатые заполнения"""
+        self.drop_local(*user_ids)
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                for user_id in user_ids:
+                    pipe.incr(self.VERSION_KEY.format(user_id=user_id))
+                    pipe.expire(self.VERSION_KEY.format(user_id=user_id), Config.USER_CACHE_TTL)
+                    pipe.delete(self.USER_KEY.format(user_id=user_id))
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis user cache invalidation failed: {e}")
+        await cache_bus.publish("user", *user_ids)
+    
+    def touch(self, user_id: int):
+        """Отметка активности, в БД попадет при следующем сбросе"""
+        self._activity[user_id] = datetime.datetime.utcnow()
+    
+    async def flush_activity(self):
+        """Запись накопленных last_activity одним executemany"""
+        activity, self._activity = self._activity, {}
+        if not activity:
+            return
+        
+        users = User.__table__
+        async with SessionLocal() as db:
+            conn = await db.connection()
+            await conn.execute(
+                update(users)
+                .where(users.c.user_id == bindparam("uid"))
+                .values(last_activity=bindparam("ts")),
+                [{"uid": user_id, "ts": ts} for user_id, ts in activity.items()]
+            )
+            await db.commit()
+    
+    async def run_flush_loop(self):
+        """Фоновый сброс активности"""
+        while True:
+            await asyncio.sleep(Config.ACTIVITY_FLUSH_INTERVAL)
+            try:
+                await self.flush_activity()
+            except Exception as e:
+                logger.error(f"Activity flush failed: {e}")
+
+user_cache = UserCache()
+cache_bus.on("user", user_cache.drop_local, reset=user_cache.local.clear)
+
+class UserLockMiddleware(BaseMiddleware):
+    """Апдейты одного пользователя обрабатываются по одному, в том числе в разных процессах
+    
+    Хэндлер без блокировки не выполняется: не дождавшись ее за USER_LOCK_WAIT, апдейт отбрасывается
+    с сообщением пользователю. Пока хэндлер работает, TTL блокировки продлевается
+    """
+    
+    KEY = "lock:user:{user_id}"
+    BUSY_TEXT = "⏳ Предыдущий запрос еще обрабатывается, повторите чуть позже."
+    # Снятие только своей блокировки (чужая могла появиться после истечения TTL)
+    RELEASE_SCRIPT = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+    # Продление только своей блокировки
+    EXTEND_SCRIPT = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("pexpire", KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    
+    def __init__(self):
+        self.local: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self.release_script = redis_client.register_script(self.RELEASE_SCRIPT)
+        self.extend_script = redis_client.register_script(self.EXTEND_SCRIPT)
+    
+    async def acquire_shared(self, key: str, token: str) -> bool:
+        """Блокировка в Redis с ожиданием; False - не дождались"""
+        deadline = time.monotonic() + Config.USER_LOCK_WAIT
+        delay = 0.005
+        while not await redis_client.set(key, token, nx=True, px=Config.USER_LOCK_TTL * 1000):
+            if time.monotonic() > deadline:
+                logger.warning(f"User lock wait timed out: {key}")
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        return True
+    
+    async def heartbeat(self, key: str, token: str):
+        """Продление блокировки, пока идет обработка"""
+        while True:
+            await asyncio.sleep(Config.USER_LOCK_TTL / 3)
+            try:
+                if not await self.extend_script(keys=[key], args=[token, Config.USER_LOCK_TTL * 1000]):
+                    logger.warning(f"User lock lost: {key}")
+                    return
+            except Exception as e:
+                logger.warning(f"User lock extend failed: {e}")
+    
+    async def notify_busy(self, event: TelegramObject):
+        """Апдейт отброшен: пользователь узнает, что нажатие или сообщение не обработано"""
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(self.BUSY_TEXT)
+            elif isinstance(event, Message):
+                await event.answer(self.BUSY_TEXT)
+        except Exception as e:
+            logger.debug(f"User lock notice failed: {e}")
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        from_user = data.get("event_from_user")
+        if not from_user:
+            return await handler(event, data)
+        
+        # Сначала очередь внутри процесса, чтобы не опрашивать Redis из нескольких задач
+        lock = self.local.get(from_user.id)
+        if lock is None:
+            lock = self.local[from_user.id] = asyncio.Lock()
+        
+        try:
+            async with asyncio.timeout(Config.USER_LOCK_WAIT):
+                await lock.acquire()
+        except TimeoutError:
+            logger.warning(f"User lock wait timed out: {from_user.id}")
+            await self.notify_busy(event.event)
+            return None
+        
+        try:
+            if not Config.USER_LOCK_SHARED:
+                return await handler(event, data)
+            
+            key = self.KEY.format(user_id=from_user.id)
+            token = uuid.uuid4().hex
+            try:
+                acquired = await self.acquire_shared(key, token)
+            except Exception as e:
+                logger.warning(f"User lock failed: {e}")
+                acquired = False
+            if not acquired:
+                await self.notify_busy(event.event)
+                return None
+            
+            heartbeat = asyncio.create_task(self.heartbeat(key, token))
+            try:
+                return await handler(event, data)
+            finally:
+                heartbeat.cancel()
+                try:
+                    await self.release_script(keys=[key], args=[token])
+                except Exception as e:
+                    logger.warning(f"User lock release failed: {e}")
+        finally:
+            lock.release()
+
+# Блокировка до чтения снимка: следующий апдейт видит изменения предыдущего
+dp.update.outer_middleware(UserLockMiddleware())
+
+class UserContextMiddleware(BaseMiddleware):
+    """Снимок пользователя в хэндлеры как user, учет активности без записи в БД на каждый апдейт"""
+    
+    async def __call__(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        from_user = data.get("event_from_user")
+        if from_user:
+            user_cache.touch(from_user.id)
+            await stats.record_activity(from_user.id)
+            data["user"] = await user_cache.get(data["db"], from_user.id)
+        return await handler(event, data)
+
+dp.update.outer_middleware(UserContextMiddleware())
+
+# ==================== ПОКУПКИ И РЕЗЕРВЫ ====================
+class PurchaseError(Exception):
+    """Покупка невозможна, текст ошибки показывается пользователю"""
+
+class PurchaseIdempotency:
+    """Ключ идемпотентности покупки: одна покупка на одно состояние карточки товара"""
+    
+    KEY = "purchase:idempotency:{key}"
+    PENDING = "pending"
+    
+    @staticmethod
+    def key_for(callback: CallbackQuery) -> str:
+        """Пользователь + сообщение + момент последнего изменения сообщения + кнопка
+        
+        Двойное нажатие приходит с тем же edit_date, а новая покупка возможна
+        только после повторного показа карточки, который меняет edit_date
+        """
+        message = callback.message
+        version = getattr(message, "edit_date", None) or message.date
+        version = int(version.timestamp()) if isinstance(version, datetime.datetime) else version
+        return f"{callback.from_user.id}:{message.message_id}:{version}:{callback.data}"
+    
+    @classmethod
+    async def begin(cls, key: str) -> Optional[str]:
+        """None - покупку можно выполнять; иначе PENDING или order_id прошлой покупки"""
+        redis_key = cls.KEY.format(key=key)
+        try:
+            if await redis_client.set(redis_key, cls.PENDING, nx=True, ex=Config.PURCHASE_IDEMPOTENCY_TTL):
+                return None
+            previous = await redis_client.get(redis_key)
+        except Exception as e:
+            logger.warning(f"Purchase idempotency check failed: {e}")
+            return None
+        return previous.decode() if previous else None
+    
+    @classmethod
+    async def finish(cls, key: str, order_id: str):
+        """Покупка выполнена: повторы получат ее order_id"""
+        try:
+            await redis_client.set(cls.KEY.format(key=key), order_id, ex=Config.PURCHASE_IDEMPOTENCY_TTL)
+        except Exception as e:
+            logger.warning(f"Purchase idempotency save failed: {e}")
+    
+    @classmethod
+    async def abort(cls, key: str):
+        """Покупка не состоялась: можно нажать еще раз"""
+        try:
+            await redis_client.delete(cls.KEY.format(key=key))
+        except Exception as e:
+            logger.warning(f"Purchase idempotency reset failed: {e}")
+
+class StockReservation:
+    """Атомарное списание остатков и баланса без чтения-изменения-записи в Python"""
+    
+    @staticmethod
+    async def _take_stock(db: AsyncSession, product_id: int, quantity: int, amount: float = 0.0) -> bool:
+        """Условное списание остатка; amount > 0 - сразу учитываем продажу"""
+        values = {
+            "stock": case((Product.stock == -1, Product.stock), else_=Product.stock - quantity)
+        }
+        if amount:
+            values["sales_count"] = Product.sales_count + quantity
+            values["total_revenue"] = Product.total_revenue + amount
+        
+        result = await db.execute(
+            update(Product)
+            .where(
+                Product.id == product_id,
+                Product.is_active == True,
+                or_(Product.stock == -1, Product.stock >= quantity)
+            )
+            .values(**values)
+        )
+        return result.rowcount == 1
+    
+    @staticmethod
+    async def purchase_with_balance(db: AsyncSession, user_id: int, product_id: int) -> tuple:
+        """Покупка с баланса одной транзакцией, возвращает (заказ, товар)"""
+        product = await db.get(Product, product_id, populate_existing=True)
+        
+        if not product or not product.is_active:
+            raise PurchaseError("Товар недоступен!")
+        
+        if product.stock == 0:
+            raise PurchaseError("Товар закончился!")
+        
+        price = Ledger.money(product.price)
+        invoice = await Utils.create_order_invoice(product, user_id)
+        
+        # Списание средств проводкой в леджер; средства проверяются под блокировкой счета покупателя
+        postings = await ledger.charge(db, user_id, price, invoice["order_id"], "purchase", Ledger.SALES)
+        if postings is None:
+            await db.rollback()
+            raise PurchaseError("Недостаточно средств на балансе!")
+        
+        await db.execute(
+            update(User)
+            .where(User.user_id == user_id)
+            .values(total_spent=User.total_spent + price, orders_count=User.orders_count + 1)
+        )
+        
+        order = Order(
+            order_id=invoice["order_id"],
+            user_id=user_id,
+            product_id=product_id,
+            total_amount=price,
+            status="paid",
+            payment_method="balance",
+            is_auto=True
+        )
+        db.add(order)
+        await db.flush()
+        
+        # Остаток списываем последним, чтобы строка горячего товара была заблокирована
+        # только до коммита
+        if not await StockReservation._take_stock(db, product_id, 1, amount=product.price):
+            await db.rollback()
+            raise PurchaseError("Товар закончился!")
+        
+        await db.commit()
+        await ledger.applied(postings)
+        await user_cache.invalidate(user_id)
+        await stats.record_order(order, product.name, paid=True)
+        return order, product
+
+# ==================== ТИКЕТЫ ====================
+class Tickets:
+    """Тикеты поддержки: сообщения отдельными строками, очередь админов, захват тикета атомарным UPDATE"""
+    
+    OPEN = "open"          # Ждет ответа поддержки
+    ANSWERED = "answered"  # Ждет пользователя
+    CLOSED = "closed"
+    
+    @staticmethod
+    async def create(db: AsyncSession, user_id: int, text: str) -> SupportTicket:
+        """Новый тикет с первым сообщением"""
+        now = datetime.datetime.utcnow()
+        ticket = SupportTicket(
+            ticket_id=ids.new("TICKET"),
+            user_id=user_id,
+            subject="Проблема с ботом",
+            message=text,
+            status=Tickets.OPEN,
+            priority="normal",
+            messages_count=1,
+            created_at=now,
+            updated_at=now
+        )
+        db.add(ticket)
+        await db.flush()
+        
+        db.add(TicketMessage(ticket_id=ticket.id, author="user", sender_id=user_id, text=text, created_at=now))
+        await db.commit()
+        return ticket
+    
+    @staticmethod
+    async def _post(db: AsyncSession, ticket_id: int, author: str, sender_id: int, text: str, *where, **values):
+        """Сообщение в тикет: права проверяет тот же UPDATE, что двигает счетчик и статус.
+        
+        Возвращает (ticket_id, user_id, admin_id) тикета или None, если условие не выполнено
+        """
+        now = datetime.datetime.utcnow()
+        ticket = (await db.execute(
+            update(SupportTicket)
+            .where(SupportTicket.id == ticket_id, *where)
+            .values(messages_count=SupportTicket.messages_count + 1, updated_at=now, **values)
+            .returning(SupportTicket.ticket_id, SupportTicket.user_id, SupportTicket.admin_id)
+        )).one_or_none()
+        if ticket is None:
+            return None
+        
+        await db.execute(insert(TicketMessage).values(
+            ticket_id=ticket_id, author=author, sender_id=sender_id, text=text, created_at=now
+        ))
+        await db.commit()
+        return ticket
+    
+    @staticmethod
+    async def user_reply(db: AsyncSession, ticket_id: int, user_id: int, text: str):
+        """Сообщение пользователя в свой тикет (закрытый тикет открывается снова)"""
+        return await Tickets._post(
+            db, ticket_id, "user", user_id, text,
+            SupportTicket.user_id == user_id,
+            status=Tickets.OPEN
+        )
+    
+    @staticmethod
+    async def admin_reply(db: AsyncSession, ticket_id: int, admin_id: int, text: str):
+        """Ответ админа: свободный тикет при этом закрепляется за ним, чужой - не трогается"""
+        return await Tickets._post(
+            db, ticket_id, "admin", admin_id, text,
+            SupportTicket.status != Tickets.CLOSED,
+            or_(SupportTicket.admin_id.is_(None), SupportTicket.admin_id == admin_id),
+            status=Tickets.ANSWERED,
+            admin_id=admin_id
+        )
+    
+    @staticmethod
+    async def assign(db: AsyncSession, ticket_id: int, admin_id: int, to_admin_id: Optional[int] = None) -> bool:
+        """Захват свободного тикета (to_admin_id не задан) или передача своего другому админу"""
+        result = await db.execute(
+            update(SupportTicket)
+            .where(
+                SupportTicket.id == ticket_id,
+                SupportTicket.status != Tickets.CLOSED,
+                or_(SupportTicket.admin_id.is_(None), SupportTicket.admin_id == admin_id)
+            )
+            .values(admin_id=to_admin_id or admin_id)
+        )
+        await db.commit()
+        return result.rowcount == 1
+    
+    @staticmethod
+    async def close(db: AsyncSession, ticket_id: int, admin_id: int) -> Optional[Any]:
+        """Закрытие свободного или своего тикета; (ticket_id, user_id) или None"""
+        ticket = (await db.execute(
+            update(SupportTicket)
+            .where(
+                SupportTicket.id == ticket_id,
+                SupportTicket.status != Tickets.CLOSED,
+                or_(SupportTicket.admin_id.is_(None), SupportTicket.admin_id == admin_id)
+            )
+            .values(status=Tickets.CLOSED, admin_id=admin_id, updated_at=datetime.datetime.utcnow())
+            .returning(SupportTicket.ticket_id, SupportTicket.user_id)
+        )).one_or_none()
+        await db.commit()
+        return ticket
+    
+    @staticmethod
+    async def history(db: AsyncSession, ticket_id: int, cursor: int = 0) -> dict:
+        """Страница истории: последние сообщения до сообщения cursor (0 - самые новые), по времени"""
+        query = select(
+            TicketMessage.id, TicketMessage.author, TicketMessage.text, TicketMessage.created_at
+        ).where(TicketMessage.ticket_id == ticket_id)
+        if cursor:
+            boundary = tuple_(
+                select(TicketMessage.created_at).where(TicketMessage.id == cursor).scalar_subquery(),
+                literal(cursor)
+            )
+            query = query.where(tuple_(TicketMessage.created_at, TicketMessage.id) < boundary)
+        
+        rows = (await db.execute(
+            query.order_by(TicketMessage.created_at.desc(), TicketMessage.id.desc())
+            .limit(Config.TICKET_PAGE_SIZE + 1)
+        )).all()
+        
+        more = len(rows) > Config.TICKET_PAGE_SIZE
+        rows = rows[:Config.TICKET_PAGE_SIZE]
+        rows.reverse()
+        return {"items": rows, "older": rows[0].id if more else 0}
+    
+    @staticmethod
+    async def queue(db: AsyncSession, admin_id: Optional[int] = None, cursor: int = 0) -> dict:
+        """Ждущие ответа тикеты: свободные (admin_id не задан) или закрепленные за админом, дольше ждущие первыми"""
+        query = select(
+            SupportTicket.id, SupportTicket.ticket_id, SupportTicket.user_id,
+            SupportTicket.messages_count, SupportTicket.updated_at
+        ).where(
+            SupportTicket.status == Tickets.OPEN,
+            SupportTicket.admin_id.is_(None) if admin_id is None else SupportTicket.admin_id == admin_id
+        )
+        if cursor:
+            boundary = tuple_(
+                select(SupportTicket.updated_at).where(SupportTicket.id == cursor).scalar_subquery(),
+                literal(cursor)
+            )
+            query = query.where(tuple_(SupportTicket.updated_at, SupportTicket.id) > boundary)
+        
+        rows = (await db.execute(
+            query.order_by(SupportTicket.updated_at, SupportTicket.id).limit(Config.TICKET_QUEUE_PAGE_SIZE + 1)
+        )).all()
+        
+        more = len(rows) > Config.TICKET_QUEUE_PAGE_SIZE
+        rows = rows[:Config.TICKET_QUEUE_PAGE_SIZE]
+        return {"items": rows, "next": rows[-1].id if more else 0}
+    
+    @staticmethod
+    def render_history(ticket: SupportTicket, page: dict, for_admin: bool = False) -> str:
+        """Текст тикета со страницей переписки"""
+        statuses = {Tickets.OPEN: "⏳ ждет ответа", Tickets.ANSWERED: "✅ отвечен", Tickets.CLOSED: "🔒 закрыт"}
+        text = f"📨 <b>Тикет #{ticket.ticket_id}</b>\n"
+        text += f"Статус: {statuses.get(ticket.status, ticket.status)}, сообщений: {ticket.messages_count}\n"
+        if for_admin:
+            text += f"Пользователь: <code>{ticket.user_id}</code>, админ: {ticket.admin_id or 'не назначен'}\n"
+        text += "\n"
+        if page["older"]:
+            text += "<i>…более ранние сообщения - кнопкой ниже</i>\n\n"
+        
+        for item in page["items"]:
+            if item.author == "user":
+                author = "👤 Пользователь" if for_admin else "👤 Вы"
+            else:
+                author = "🛟 Поддержка"
+            body = item.text
+            if len(body) > Config.TICKET_PREVIEW_LENGTH:
+                body = body[:Config.TICKET_PREVIEW_LENGTH] + "…"
+            text += f"<b>{author}</b> · {item.created_at.strftime('%d.%m %H:%M')}\n{html.escape(body)}\n\n"
+        return text
+    
+    @staticmethod
+    async def notify(chat_ids: List[int], text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        """Рассылка оповещения параллельно; лимиты Telegram соблюдает telegram_sender"""
+        results = await asyncio.gather(*(
+            telegram_sender.send_message(chat_id, text, reply_markup=reply_markup)
+            for chat_id in chat_ids
+        ), return_exceptions=True)
+        
+        for chat_id, result in zip(chat_ids, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Ticket alert to {chat_id} failed: {result}")
+
+# ==================== КЛАВИАТУРЫ ====================
+class KeyboardRegistry:
+    """Готовые клавиатуры: статичные строятся один раз, параметризованные хранятся в LRU"""
+    
+    def __init__(self):
+        self.caches: Dict[str, LRUCache] = {}
+    
+    def cached(self, maxsize: int = 1, key=None):
+        """Мемоизация построителя клавиатуры; key - ключ из аргументов (по умолчанию сами аргументы)"""
+        def decorator(builder):
+            cache = self.caches[builder.__name__] = LRUCache(maxsize=maxsize, ttl=None)
+            
+            @functools.wraps(builder)
+            def wrapper(*args):
+                cache_key = key(*args) if key else args
+                markup = cache.get(cache_key)
+                if markup is None:
+                    markup = builder(*args)
+                    cache.set(cache_key, markup)
+                return markup
+            
+            return wrapper
+        return decorator
+    
+    def stats(self) -> Dict[str, dict]:
+        """Попадания в кэш по каждой клавиатуре"""
+        return {
+            name: {
+                "hits": cache.hits,
+                "misses": cache.misses,
+                "size": len(cache),
+                "hit_rate": cache.hits / ((cache.hits + cache.misses) or 1),
+            }
+            for name, cache in self.caches.items()
+        }
+
+keyboard_registry = KeyboardRegistry()
+
+class Keyboards:
+    """Клавиатуры бота"""
+    
+    @staticmethod
+    @keyboard_registry.cached()
+    def main_menu() -> InlineKeyboardMarkup:
+        """Главное меню"""
+        builder = InlineKeyboardBuilder()
+        builder.row(
+            InlineKeyboardButton(text="🛒 Каталог", callback_data="catalog"),
+            InlineKeyboardButton(text="👤 Профиль", callback_data="profile"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="💰 Пополнить баланс", callback_data="deposit"),
+            InlineKeyboardButton(text="📦 Мои покупки", callback_data="my_orders"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="👥 Реферальная система", callback_data="referral"),
+            InlineKeyboardButton(text="🆘 Поддержка", callback_data="support"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="⚙️ Настройки", callback_data="settings"),
+            InlineKeyboardButton(text="ℹ️ О боте", callback_data="about"),
+        )
+        return builder.as_markup()
+    
+    @staticmethod
+    @keyboard_registry.cached(
+        maxsize=64,
+        key=lambda categories: tuple((category["id"], category["name"]) for category in categories)
+    )
+    def catalog_menu(categories: list) -> InlineKeyboardMarkup:
+        """Меню каталога"""
+        builder = InlineKeyboardBuilder()
+        
+        for category in categories:
+            builder.button(text=f"📁 {category['name']}", callback_data=f"category_{category['id']}")
+        
+        builder.row(
+            InlineKeyboardButton(text="🔍 Поиск товара", callback_data="search"),
+            InlineKeyboardButton(text="🎁 Акции", callback_data="promotions"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
+        )
+        
+        return builder.as_markup()
+    
+    @staticmethod
+    @keyboard_registry.cached(
+        maxsize=Config.KEYBOARD_CACHE_SIZE,
+        key=lambda category_id, sort, page: (
+            category_id, sort, page["has_prev"], page["has_next"],
+            tuple((product["id"], product["name"], product["price"]) for product in page["items"])
+        )
+    )
+    def category_page(category_id: str, sort: str, page: dict) -> InlineKeyboardMarkup:
+        """Страница категории: товары, листание и сортировка"""
+        builder = InlineKeyboardBuilder()
+        
+        for product in page["items"]:
+            builder.row(
+                InlineKeyboardButton(
+                    text=f"{product['name']} - {product['price']:.2f} ₽",
+                    callback_data=f"product_{product['id']}"
+                )
+            )
+        
+        navigation = []
+        if page["has_prev"]:
+            cursor = Categories.encode_cursor(page["items"][0]["id"])
+            navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"catp_{category_id}_{sort}_p_{cursor}"))
+        if page["has_next"]:
+            cursor = Categories.encode_cursor(page["items"][-1]["id"])
+            navigation.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"catp_{category_id}_{sort}_n_{cursor}"))
+        if navigation:
+            builder.row(*navigation)
+        
+        sorts = [
+            InlineKeyboardButton(
+                text=f"✅ {label}" if code == sort else label,
+                callback_data=f"catp_{category_id}_{code}_f_0"
+            )
+            for code, (_, _, label) in Categories.SORTS.items()
+        ]
+        builder.row(*sorts[:2])
+        builder.row(*sorts[2:])
+        builder.row(
+            InlineKeyboardButton(text="🔙 Назад", callback_data="catalog"),
+            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
+        )
+        
+        return builder.as_markup()
+    
+    @staticmethod
+    @keyboard_registry.cached(maxsize=Config.KEYBOARD_CACHE_SIZE)
+    def product_menu(product_id: int, in_stock: bool = True) -> InlineKeyboardMarkup:
+        """Меню товара"""
+        builder = InlineKeyboardBuilder()
+        
+        if in_stock:
+            builder.button(text="🛒 Купить сейчас", callback_data=f"buy_{product_id}")
+            builder.button(text="💰 Купить с баланса", callback_data=f"buy_balance_{product_id}")
+        
+        builder.button(text="📋 Описание", callback_data=f"desc_{product_id}")
+        builder.button(text="⭐ Отзывы", callback_data=f"reviews_{product_id}")
+        
+        builder.row(
+            InlineKeyboardButton(text="🔙 Назад в каталог", callback_data="catalog"),
+            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
+        )
+        
+        return builder.as_markup()
+    
+    @staticmethod
+    @keyboard_registry.cached()
+    def payment_methods() -> InlineKeyboardMarkup:
+        """Методы оплаты"""
+        builder = InlineKeyboardBuilder()
+        
+        builder.row(
+            InlineKeyboardButton(text="💳 Банковская карта", callback_data="pay_card"),
+            InlineKeyboardButton(text="🥝 ЮMoney", callback_data="pay_yoomoney"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="🔶 ЮKassa", callback_data="pay_yookassa"),
+            InlineKeyboardButton(text="₿ Криптовалюта", callback_data="pay_crypto"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="📱 QIWI", callback_data="pay_qiwi"),
+            InlineKeyboardButton(text="🌐 СБП", callback_data="pay_sbp"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="🔙 Назад", callback_data="deposit_back"),
+            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
+        )
+        
+        return builder.as_markup()
+    
+    @staticmethod
+    @keyboard_registry.cached(maxsize=Config.KEYBOARD_CACHE_SIZE, key=lambda user_data: round(user_data["balance"], 2))
+    def profile_menu(user_data: dict) -> InlineKeyboardMarkup:
+        """Меню профиля"""
+        builder = InlineKeyboardBuilder()
+        
+        builder.row(
+            InlineKeyboardButton(text="💰 Баланс: {:.2f} ₽".format(user_data['balance']), callback_data="balance_info"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="📊 Статистика", callback_data="stats"),
+            InlineKeyboardButton(text="🎁 Промокод", callback_data="promo_activate"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="📱 Контакты", callback_data="contacts"),
+            InlineKeyboardButton(text="✏️ Изменить данные", callback_data="edit_profile"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
+        )
+        
+        return builder.as_markup()
+    
+    @staticmethod
+    @keyboard_registry.cached(maxsize=Config.KEYBOARD_CACHE_SIZE)
+    def referral_menu(ref_code: str) -> InlineKeyboardMarkup:
         """Реферальное меню"""
         builder = InlineKeyboardBuilder()
         
@@ -450,6 +2987,7 @@ class Keyboards:
         return builder.as_markup()
     
     @staticmethod
+    @keyboard_registry.cached()
     def support_menu() -> InlineKeyboardMarkup:
         """Меню поддержки"""
         builder = InlineKeyboardBuilder()
@@ -469,6 +3007,48 @@ class Keyboards:
         return builder.as_markup()
     
     @staticmethod
+    @keyboard_registry.cached(maxsize=Config.KEYBOARD_CACHE_SIZE)
+    def ticket_menu(ticket_id: int, older: int = 0) -> InlineKeyboardMarkup:
+        """Тикет пользователя: листание истории и ответ"""
+        builder = InlineKeyboardBuilder()
+        
+        if older:
+            builder.row(InlineKeyboardButton(
+                text="⬅️ Ранее", callback_data=f"thist_{ticket_id}_{Categories.encode_cursor(older)}"
+            ))
+        builder.row(
+            InlineKeyboardButton(text="✍️ Написать", callback_data=f"treply_{ticket_id}"),
+            InlineKeyboardButton(text="🔙 Мои тикеты", callback_data="my_tickets"),
+        )
+        
+        return builder.as_markup()
+    
+    @staticmethod
+    @keyboard_registry.cached(maxsize=Config.KEYBOARD_CACHE_SIZE)
+    def admin_ticket_menu(ticket_id: int, older: int = 0, assigned: bool = False) -> InlineKeyboardMarkup:
+        """Тикет в админке: история, ответ, захват и передача, закрытие"""
+        builder = InlineKeyboardBuilder()
+        
+        if older:
+            builder.row(InlineKeyboardButton(
+                text="⬅️ Ранее", callback_data=f"admin_thist_{ticket_id}_{Categories.encode_cursor(older)}"
+            ))
+        builder.row(
+            InlineKeyboardButton(text="📨 Ответить", callback_data=f"admin_reply_{ticket_id}"),
+            InlineKeyboardButton(
+                text="👥 Передать" if assigned else "🙋 Взять",
+                callback_data=f"admin_assign_{ticket_id}" if assigned else f"admin_claim_{ticket_id}"
+            ),
+        )
+        builder.row(
+            InlineKeyboardButton(text="🔒 Закрыть", callback_data=f"admin_close_{ticket_id}"),
+            InlineKeyboardButton(text="🔙 Очередь", callback_data="admin_support"),
+        )
+        
+        return builder.as_markup()
+    
+    @staticmethod
+    @keyboard_registry.cached()
     def admin_menu() -> InlineKeyboardMarkup:
         """Админ меню"""
         builder = InlineKeyboardBuilder()
@@ -495,6 +3075,10 @@ class Keyboards:
         
         return builder.as_markup()
 
+# Статичные меню собираются один раз при запуске
+for static_menu in (Keyboards.main_menu, Keyboards.payment_methods, Keyboards.support_menu, Keyboards.admin_menu):
+    static_menu()
+
 # ==================== СОСТОЯНИЯ (FSM) ====================
 class Form(StatesGroup):
     """Состояния для FSM"""
@@ -503,281 +3087,389 @@ class Form(StatesGroup):
     waiting_for_withdraw_amount = State()
     waiting_for_withdraw_method = State()
     waiting_for_product_search = State()
+    waiting_for_ticket_reply = State()
     
     # Админ состояния
     admin_waiting_broadcast = State()
+    admin_waiting_ticket_reply = State()
     admin_waiting_product_name = State()
     admin_waiting_product_price = State()
     admin_waiting_product_description = State()
 
 # ==================== ОСНОВНЫЕ ХЭНДЛЕРЫ ====================
 @main_router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, db: AsyncSession, user: Optional[CachedUser]):
     """Обработчик команды /start"""
     await state.clear()
     
     user_id = message.from_user.id
     args = message.text.split()
     
-    # Проверка реферальной ссылки
+    # Проверка реферальной ссылки (или ссылки на товар из inline-поиска)
     referral_code = None
+    deep_link_product = None
     if len(args) > 1:
         referral_code = args[1]
+        if referral_code.startswith("product_") and referral_code[8:].isdigit():
+            deep_link_product = int(referral_code[8:])
+            referral_code = None
     
-    async with SessionLocal() as db:
-        # Проверка существования пользователя
-        user = db.query(User).filter(User.user_id == user_id).first()
-        
-        if not user:
-            # Регистрация нового пользователя
-            referral_code_used = None
-            if referral_code:
-                referrer = db.query(User).filter(User.referral_code == referral_code).first()
-                if referrer:
-                    referral_code_used = referrer.user_id
-            
-            new_user = User(
-                user_id=user_id,
-                username=message.from_user.username,
-                first_name=message.from_user.first_name,
-                last_name=message.from_user.last_name,
-                language_code=message.from_user.language_code,
-                referral_code=Utils.generate_referral_code(user_id),
-                referred_by=referral_code_used,
-                settings={
-                    "notifications": True,
-                    "language": "ru",
-                    "theme": "dark"
-                }
-            )
-            
-            db.add(new_user)
-            await db.commit()
-            
-            # Начисление бонуса рефереру
-            if referral_code_used:
-                referrer.balance += 100  # Бонус за приглашение
-                referrer.successful_refs += 1
-                
-                # Создание реферальной записи
-                referral = Referral(
-                    referrer_id=referral_code_used,
-                    referred_id=user_id,
-                    level=1
-                )
-                db.add(referral)
-                
-                # Уведомление рефереру
-                await Utils.send_notification(
-                    referral_code_used,
-                    "🎉 Новый реферал!",
-                    f"Пользователь @{message.from_user.username} зарегистрировался по вашей ссылке!\n"
-                    f"На ваш баланс начислено 100 ₽"
-                )
-            
-            await message.answer(
-                f"🎉 <b>Добро пожаловать, {message.from_user.first_name}!</b>\n\n"
-                f"🤖 <b>Digital Shop Bot</b> - лучший бот для покупки цифровых товаров!\n\n"
-                f"💎 <b>Ваши преимущества:</b>\n"
-                f"• Мгновенная доставка товаров\n"
-                f"• Поддержка 24/7\n"
-                f"• Реферальная система до 3 уровней\n"
-                f"• Безопасные платежи\n\n"
-                f"🎁 <b>Бонус за регистрацию:</b> 50 ₽ на баланс!",
-                reply_markup=Keyboards.main_menu()
+    if not user:
+        # Регистрация нового пользователя
+        referral_code_used = None
+        if referral_code:
+            referral_code_used = await db.scalar(select(User.user_id).where(User.referral_code == referral_code))
+        
+        new_user = User(
+            user_id=user_id,
+            username=message.from_user.username,
+            first_name=message.from_user.first_name,
+            last_name=message.from_user.last_name,
+            language_code=message.from_user.language_code,
+            referral_code=Utils.generate_referral_code(user_id),
+            referred_by=referral_code_used,
+            settings={
+                "notifications": True,
+                "language": "ru",
+                "theme": "dark"
+            }
+        )
+        
+        # Пользователь, цепочка рефералов, счетчик и бонусы - одной транзакцией до любых отправок:
+        # ошибка отправки не должна оставить зарегистрированного пользователя без бонусов
+        db.add(new_user)
+        await db.flush()
+        
+        # Бонусы - проводками в леджер; id записи из user_id, повторный /start не начислит дважды
+        bonuses = [(Ledger.account(user_id), 50)]
+        
+        # Начисление бонуса рефереру
+        if referral_code_used:
+            bonuses.append((Ledger.account(referral_code_used), 100))  # Бонус за приглашение
+            await db.execute(
+                update(User)
+                .where(User.user_id == referral_code_used)
+                .values(successful_refs=User.successful_refs + 1)
             )
             
-            # Начисление бонуса
-            new_user.balance += 50
-            await db.commit()
-            
-        else:
-            # Пользователь уже существует
-            user.last_activity = datetime.datetime.utcnow()
-            await db.commit()
-            
-            await message.answer(
-                f"👋 <b>С возвращением, {user.first_name}!</b>\n\n"
-                f"Ваш баланс: {user.balance:.2f} ₽\n"
-                f"Всего покупок: {user.orders_count}\n\n"
-                f"Выберите действие:",
-                reply_markup=Keyboards.main_menu()
+            # Цепочка предков нового пользователя
+            await ReferralTree.link(db, referral_code_used, user_id)
+        
+        postings = await ledger.post(db, f"BONUS_{user_id}", "bonus", Ledger.BONUS, bonuses)
+        await db.commit()
+        
+        await ledger.applied(postings)
+        await user_cache.invalidate(*filter(None, (user_id, referral_code_used)))
+        await stats.record_user(user_id)
+        
+        if referral_code_used:
+            # Уведомление рефереру
+            await Utils.send_notification(
+                referral_code_used,
+                "🎉 Новый реферал!",
+                f"Пользователь @{message.from_user.username} зарегистрировался по вашей ссылке!\n"
+                f"На ваш баланс начислено 100 ₽"
             )
+        
+        await message.answer(
+            f"🎉 <b>Добро пожаловать, {message.from_user.first_name}!</b>\n\n"
+            f"🤖 <b>Digital Shop Bot</b> - лучший бот для покупки цифровых товаров!\n\n"
+            f"💎 <b>Ваши преимущества:</b>\n"
+            f"• Мгновенная доставка товаров\n"
+            f"• Поддержка 24/7\n"
+            f"• Реферальная система до 3 уровней\n"
+            f"• Безопасные платежи\n\n"
+            f"🎁 <b>Бонус за регистрацию:</b> 50 ₽ на баланс!",
+            reply_markup=Keyboards.main_menu()
+        )
+        
+    else:
+        # Пользователь уже существует (last_activity обновляет UserContextMiddleware)
+        await message.answer(
+            f"👋 <b>С возвращением, {user.first_name}!</b>\n\n"
+            f"Ваш баланс: {user.balance:.2f} ₽\n"
+            f"Всего покупок: {user.orders_count}\n\n"
+            f"Выберите действие:",
+            reply_markup=Keyboards.main_menu()
+        )
+    
+    if deep_link_product:
+        card = await catalog_cache.product_card(db, deep_link_product)
+        if card:
+            await message.answer(card["text"], reply_markup=Keyboards.product_menu(card["id"], card["in_stock"]))
 
-@main_router.callback_query(F.data == "main_menu")
-async def callback_main_menu(callback: CallbackQuery, state: FSMContext):
+@main_router.callback_query(F.data == "main_menu", flags={"manual_answer": True})
+async def callback_main_menu(callback: CallbackQuery, state: FSMContext, user: Optional[CachedUser]):
     """Возврат в главное меню"""
     await state.clear()
     
-    async with SessionLocal() as db:
-        user = db.query(User).filter(User.user_id == callback.from_user.id).first()
-        
-        await callback.message.edit_text(
-            f"🏠 <b>Главное меню</b>\n\n"
-            f"👤 Пользователь: {user.first_name}\n"
-            f"💰 Баланс: {user.balance:.2f} ₽\n"
-            f"🎯 Рефералов: {user.successful_refs}\n\n"
-            f"Выберите раздел:",
-            reply_markup=Keyboards.main_menu()
-        )
+    if not user:
+        await callback.answer("Пользователь не найден!")
+        return
+    
+    await callback.message.edit_text(
+        f"🏠 <b>Главное меню</b>\n\n"
+        f"👤 Пользователь: {user.first_name}\n"
+        f"💰 Баланс: {user.balance:.2f} ₽\n"
+        f"🎯 Рефералов: {user.successful_refs}\n\n"
+        f"Выберите раздел:",
+        reply_markup=Keyboards.main_menu()
+    )
 
 # ==================== КАТАЛОГ ====================
 @main_router.callback_query(F.data == "catalog")
-async def callback_catalog(callback: CallbackQuery):
+async def callback_catalog(callback: CallbackQuery, db: AsyncSession):
     """Каталог товаров"""
-    async with SessionLocal() as db:
-        # Получение категорий
-        categories = db.query(Product.category).distinct().all()
-        categories_list = []
-        
-        for i, cat in enumerate(categories, 1):
-            if cat[0]:  # Проверка на None
-                count = db.query(Product).filter(
-                    Product.category == cat[0],
-                    Product.is_active == True
-                ).count()
-                
-                categories_list.append({
-                    "id": i,
-                    "name": cat[0],
-                    "count": count
-                })
-        
-        if not categories_list:
-            await callback.message.edit_text(
-                "📦 <b>Каталог товаров</b>\n\n"
-                "На данный момент товары отсутствуют.\n"
-                "Пожалуйста, проверьте позже.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
-                ])
-            )
-            return
-        
-        text = "📦 <b>Каталог товаров</b>\n\n"
-        text += "Выберите категорию:\n\n"
-        
-        for cat in categories_list:
-            text += f"📁 {cat['name']} - {cat['count']} товаров\n"
-        
+    # Получение категорий
+    categories_list = await catalog_cache.categories(db)
+    
+    if not categories_list:
         await callback.message.edit_text(
-            text,
-            reply_markup=Keyboards.catalog_menu(categories_list)
+            "📦 <b>Каталог товаров</b>\n\n"
+            "На данный момент товары отсутствуют.\n"
+            "Пожалуйста, проверьте позже.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
+            ])
         )
+        return
+    
+    text = "📦 <b>Каталог товаров</b>\n\n"
+    text += "Выберите категорию:\n\n"
+    
+    for cat in categories_list:
+        text += f"📁 {cat['name']} - {cat['count']} товаров\n"
+    
+    await callback.message.edit_text(
+        text,
+        reply_markup=Keyboards.catalog_menu(categories_list)
+    )
 
-@main_router.callback_query(F.data.startswith("category_"))
-async def callback_category(callback: CallbackQuery):
-    """Товары в категории"""
-    category_id = int(callback.data.split("_")[1])
+@main_router.callback_query(F.data == "search")
+async def callback_search(callback: CallbackQuery, state: FSMContext):
+    """Поиск товара"""
+    await state.set_state(Form.waiting_for_product_search)
     
-    async with SessionLocal() as db:
-        # Получение категории
-        categories = db.query(Product.category).distinct().all()
-        category_name = categories[category_id-1][0] if category_id <= len(categories) else None
-        
-        if not category_name:
-            await callback.answer("Категория не найдена!")
-            return
-        
-        # Получение товаров в категории
-        products = db.query(Product).filter(
-            Product.category == category_name,
-            Product.is_active == True
-        ).order_by(Product.created_at.desc()).limit(20).all()
-        
-        if not products:
-            await callback.message.edit_text(
-                f"📁 <b>Категория: {category_name}</b>\n\n"
-                "В этой категории пока нет товаров.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Назад", callback_data="catalog")]
-                ])
+    await callback.message.edit_text(
+        "🔍 <b>Поиск товара</b>\n\n"
+        "Введите название, тег или часть описания товара.\n"
+        "Искать можно и прямо в строке ввода любого чата через inline-режим.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔎 Поиск в строке ввода", switch_inline_query_current_chat="")],
+            [InlineKeyboardButton(text="🔙 Назад", callback_data="catalog")]
+        ])
+    )
+
+@main_router.message(Form.waiting_for_product_search)
+async def process_product_search(message: Message):
+    """Результаты поиска (состояние сохраняется, можно уточнить запрос)"""
+    query = (message.text or "").strip()
+    products = search_index.search(query, limit=Config.SEARCH_RESULTS_LIMIT) if query else []
+    
+    if not products:
+        await message.answer(
+            f"🔍 По запросу «{html.escape(query)}» ничего не найдено.\n\n"
+            "Попробуйте другое слово или выберите категорию в каталоге.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="📦 Каталог", callback_data="catalog")]
+            ])
+        )
+        return
+    
+    builder = InlineKeyboardBuilder()
+    for product in products:
+        builder.row(
+            InlineKeyboardButton(
+                text=f"{product['name']} - {product['price']:.2f} ₽",
+                callback_data=f"product_{product['id']}"
             )
-            return
-        
-        # Создание карусели товаров
-        builder = InlineKeyboardBuilder()
+        )
+    builder.row(
+        InlineKeyboardButton(text="🔙 Назад", callback_data="catalog"),
+        InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
+    )
+    
+    await message.answer(
+        f"🔍 <b>Поиск:</b> {html.escape(query)}\n\n"
+        f"Найдено товаров: {len(products)}\n\n"
+        "Выберите товар:",
+        reply_markup=builder.as_markup()
+    )
+
+@main_router.inline_query()
+async def inline_product_search(inline_query: InlineQuery):
+    """Поиск товаров в inline-режиме"""
+    products = search_index.search(inline_query.query, limit=Config.SEARCH_INLINE_LIMIT)
+    bot_username = (await bot.me()).username
+    
+    results = []
+    for product in products:
+        text = f"<b>{product['name']}</b>\n\n"
+        text += f"{product['description']}\n\n" if product["description"] else ""
+        text += f"💵 <b>Цена:</b> {product['price']:.2f} ₽"
         
-        for product in products:
-            builder.row(
+        results.append(InlineQueryResultArticle(
+            id=str(product["id"]),
+            title=product["name"],
+            description=f"{product['price']:.2f} ₽" + (f" · {product['category']}" if product["category"] else ""),
+            input_message_content=InputTextMessageContent(message_text=text),
+            # Кнопки с callback_data не работают в чужих чатах, ведем в бота по ссылке
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
                 InlineKeyboardButton(
-                    text=f"{product.name} - {product.price:.2f} ₽",
-                    callback_data=f"product_{product.id}"
+                    text="🛒 Открыть в боте",
+                    url=f"https://t.me/{bot_username}?start=product_{product['id']}"
                 )
-            )
-        
-        builder.row(
-            InlineKeyboardButton(text="🔙 Назад", callback_data="catalog"),
-            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
-        )
+            ]])
+        ))
+    
+    await inline_query.answer(results, cache_time=30)
+
+@main_router.callback_query(F.data.startswith("category_"), flags={"manual_answer": True})
+async def callback_category(callback: CallbackQuery, db: AsyncSession):
+    """Товары в категории"""
+    category_id = callback.data.split("_", 1)[1]
+    await show_category_page(callback, db, category_id)
+
+@main_router.callback_query(F.data.startswith("catp_"), flags={"manual_answer": True})
+async def callback_category_page(callback: CallbackQuery, db: AsyncSession):
+    """Листание и сортировка категории: catp_<категория>_<сортировка>_<направление>_<курсор>"""
+    _, category_id, sort, direction, cursor = callback.data.split("_")
+    
+    if sort not in Categories.SORTS or direction not in ("f", "n", "p"):
+        await callback.answer()
+        return
+    
+    await show_category_page(callback, db, category_id, sort, direction, Categories.decode_cursor(cursor))
+
+async def show_category_page(callback: CallbackQuery, db: AsyncSession, category_id: str,
+                             sort: str = "n", direction: str = "f", cursor: int = 0):
+    """Вывод страницы категории"""
+    category = await Categories.resolve(db, category_id)
+    
+    if not category:
+        await callback.answer("Категория не найдена!")
+        return
+    
+    # Получение товаров в категории
+    page = await catalog_cache.category_page(db, category["name"], sort, direction, cursor)
+    
+    if not page["items"]:
+        if direction != "f":
+            # Товары на соседней странице успели закончиться - начинаем сначала
+            await show_category_page(callback, db, category_id, sort)
+            return
         
         await callback.message.edit_text(
-            f"📁 <b>Категория: {category_name}</b>\n\n"
-            f"Найдено товаров: {len(products)}\n\n"
-            "Выберите товар:",
-            reply_markup=builder.as_markup()
+            f"📁 <b>Категория: {category['name']}</b>\n\n"
+            "В этой категории пока нет товаров.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="catalog")]
+            ])
         )
+        return
+    
+    await callback.message.edit_text(
+        f"📁 <b>Категория: {category['name']}</b>\n\n"
+        f"Найдено товаров: {category['count']}\n"
+        f"Сортировка: {Categories.SORTS[sort][2]}\n\n"
+        "Выберите товар:",
+        reply_markup=Keyboards.category_page(category_id, sort, page)
+    )
 
-@main_router.callback_query(F.data.startswith("product_"))
-async def callback_product(callback: CallbackQuery):
+@main_router.callback_query(F.data.startswith("product_"), flags={"manual_answer": True})
+async def callback_product(callback: CallbackQuery, db: AsyncSession):
     """Информация о товаре"""
     product_id = int(callback.data.split("_")[1])
     
-    async with SessionLocal() as db:
-        product = db.query(Product).filter(Product.id == product_id).first()
-        
-        if not product:
-            await callback.answer("Товар не найден!")
-            return
-        
-        # Формирование описания
-        description = f"<b>{product.name}</b>\n\n"
-        description += f"{product.description}\n\n" if product.description else ""
-        description += f"💵 <b>Цена:</b> {product.price:.2f} ₽\n"
-        
-        if product.stock >= 0:
-            description += f"📦 <b>В наличии:</b> {product.stock} шт.\n"
-        else:
-            description += "📦 <b>В наличии:</b> ∞\n"
-        
-        description += f"⭐ <b>Рейтинг:</b> {product.rating}/5 ({product.reviews_count} отзывов)\n"
-        description += f"🛒 <b>Продано:</b> {product.sales_count} шт.\n\n"
-        
-        if product.attributes:
-            description += "<b>Характеристики:</b>\n"
-            for key, value in product.attributes.items():
-                description += f"• {key}: {value}\n"
-        
-        # Кнопки
-        in_stock = product.stock != 0
-        
-        if product.image_url:
-            try:
-                await callback.message.delete()
-                await callback.message.answer_photo(
-                    photo=product.image_url,
+    card = await catalog_cache.product_card(db, product_id)
+    
+    if not card:
+        await callback.answer("Товар не найден!")
+        return
+    
+    description = card["text"]
+    
+    # Кнопки
+    in_stock = card["in_stock"]
+    
+    if card["image_url"]:
+        deleted = False
+        try:
+            await callback.message.delete()
+            deleted = True
+            await media_cache.send(
+                product_id, "image", card["image_url"],
+                lambda photo: callback.message.answer_photo(
+                    photo=photo,
                     caption=description,
                     reply_markup=Keyboards.product_menu(product_id, in_stock)
-                )
-                return
-            except:
-                pass
+                ),
+                card["image_url"]
+            )
+            return
+        except Exception as e:
+            logger.warning(f"Product {product_id} photo card failed: {e}")
         
-        await callback.message.edit_text(
-            description,
-            reply_markup=Keyboards.product_menu(product_id, in_stock)
-        )
+        if deleted:
+            # Исходное сообщение уже удалено: редактировать нечего, карточка уходит новым сообщением
+            await callback.message.answer(
+                description,
+                reply_markup=Keyboards.product_menu(product_id, in_stock)
+            )
+            return
+    
+    await callback.message.edit_text(
+        description,
+        reply_markup=Keyboards.product_menu(product_id, in_stock)
+    )
 
-@main_router.callback_query(F.data.startswith("buy_"))
-async def callback_buy_product(callback: CallbackQuery):
+@main_router.callback_query(F.data.startswith("buy_"), flags={"manual_answer": True, "rate_limit": "purchase"})
+async def callback_buy_product(callback: CallbackQuery, state: FSMContext, db: AsyncSession):
     """Покупка товара"""
+    # buy_<id> - выбор способа оплаты, buy_balance_<id> - покупка с баланса
     data = callback.data.split("_")
-    product_id = int(data[1])
-    use_balance = len(data) > 2 and data[2] == "balance"
+    product_id = int(data[-1])
+    use_balance = data[1] == "balance"
     
-    async with SessionLocal() as db:
-        user = db.query(User).filter(User.user_id == callback.from_user.id).first()
-        product = db.query(Product).filter(Product.id == product_id).first()
+    if use_balance:
+        # Покупка с баланса; повторное нажатие на ту же карточку не списывает второй раз
+        idempotency_key = PurchaseIdempotency.key_for(callback)
+        previous = await PurchaseIdempotency.begin(idempotency_key)
+        if previous == PurchaseIdempotency.PENDING:
+            await callback.answer("⏳ Покупка уже обрабатывается")
+            return
+        if previous:
+            await callback.answer("✅ Товар уже куплен! Проверьте свои покупки.")
+            return
+        
+        try:
+            order_obj, product = await StockReservation.purchase_with_balance(
+                db, callback.from_user.id, product_id
+            )
+        except PurchaseError as e:
+            await PurchaseIdempotency.abort(idempotency_key)
+            await callback.answer(str(e))
+            return
+        except Exception:
+            await PurchaseIdempotency.abort(idempotency_key)
+            raise
+        await PurchaseIdempotency.finish(idempotency_key, order_obj.order_id)
+        
+        # Остаток и продажи в карточке изменились
+        await catalog_cache.invalidate_product(product.id, product.category, listing=False)
+        
+        # Доставка товара в фоне
+        try:
+            await delivery_queue.enqueue(order_obj.order_id)
+        except Exception as e:
+            logger.error(f"Failed to enqueue delivery, delivering inline: {e}")
+            await delivery_queue.process(order_obj.order_id)
+        
+        await callback.answer("✅ Товар успешно куплен! Проверьте свои покупки.")
+        await callback_main_menu(callback, state, await user_cache.get(db, callback.from_user.id))
+        
+    else:
+        product = await db.get(Product, product_id)
         
         if not product or not product.is_active:
             await callback.answer("Товар недоступен!")
@@ -787,162 +3479,104 @@ async def callback_buy_product(callback: CallbackQuery):
             await callback.answer("Товар закончился!")
             return
         
-        if use_balance:
-            # Покупка с баланса
-            if user.balance < product.price:
-                await callback.answer("Недостаточно средств на балансе!")
-                return
-            
-            # Создание заказа
-            order = await Utils.create_order_invoice(product, user.user_id)
-            order_obj = Order(
-                order_id=order["order_id"],
-                user_id=user.user_id,
-                product_id=product.id,
-                total_amount=product.price,
-                status="paid",
-                payment_method="balance",
-                is_auto=True
-            )
-            
-            # Списание средств
-            user.balance -= product.price
-            user.total_spent += product.price
-            user.orders_count += 1
-            
-            # Обновление статистики товара
-            product.sales_count += 1
-            product.total_revenue += product.price
-            if product.stock > 0:
-                product.stock -= 1
-            
-            db.add(order_obj)
-            await db.commit()
-            
-            # Доставка товара
-            await deliver_product(callback.from_user.id, order_obj, product)
-            
-            await callback.answer("✅ Товар успешно куплен! Проверьте свои покупки.")
-            await callback_main_menu(callback, None)
-            
-        else:
-            # Выбор способа оплаты
-            builder = InlineKeyboardBuilder()
-            
-            builder.row(
-                InlineKeyboardButton(text="💳 Картой", callback_data=f"pay_card_{product_id}"),
-                InlineKeyboardButton(text="🥝 ЮMoney", callback_data=f"pay_yoomoney_{product_id}"),
-            )
-            builder.row(
-                InlineKeyboardButton(text="🔶 ЮKassa", callback_data=f"pay_yookassa_{product_id}"),
-                InlineKeyboardButton(text="📱 QIWI", callback_data=f"pay_qiwi_{product_id}"),
-            )
-            builder.row(
-                InlineKeyboardButton(text="🔙 Назад", callback_data=f"product_{product_id}"),
-                InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
-            )
-            
-            await callback.message.edit_text(
-                f"🛒 <b>Покупка: {product.name}</b>\n\n"
-                f"💵 Сумма к оплате: {product.price:.2f} ₽\n\n"
-                f"Выберите способ оплаты:",
-                reply_markup=builder.as_markup()
-            )
-
-# ==================== ПРОФИЛЬ ====================
-@main_router.callback_query(F.data == "profile")
-async def callback_profile(callback: CallbackQuery):
-    """Личный кабинет"""
-    async with SessionLocal() as db:
-        user = db.query(User).filter(User.user_id == callback.from_user.id).first()
-        
-        if not user:
-            await callback.answer("Пользователь не найден!")
-            return
+        # Выбор способа оплаты
+        builder = InlineKeyboardBuilder()
         
-        # Статистика
-        total_orders = db.query(Order).filter(
-            Order.user_id == user.user_id,
-            Order.status == "paid"
-        ).count()
-        
-        total_spent = user.total_spent
-        
-        text = f"👤 <b>Личный кабинет</b>\n\n"
-        text += f"🆔 ID: {user.user_id}\n"
-        text += f"👤 Имя: {user.first_name}\n"
-        if user.username:
-            text += f"📱 Username: @{user.username}\n"
-        text += f"📅 Регистрация: {user.registration_date.strftime('%d.%m.%Y')}\n"
-        text += f"💰 Баланс: {user.balance:.2f} ₽\n"
-        text += f"🛒 Всего покупок: {total_orders}\n"
-        text += f"💳 Всего потрачено: {total_spent:.2f} ₽\n"
-        text += f"👥 Приглашено: {user.successful_refs} чел.\n"
-        text += f"🎁 Заработано: {user.total_earned:.2f} ₽\n\n"
-        
-        if user.referral_code:
-            text += f"🔗 Реферальный код: <code>{user.referral_code}</code>\n"
-            text += f"🔗 Реферальная ссылка: https://t.me/{callback.message.bot.username}?start={user.referral_code}"
+        builder.row(
+            InlineKeyboardButton(text="💳 Картой", callback_data=f"pay_card_{product_id}"),
+            InlineKeyboardButton(text="🥝 ЮMoney", callback_data=f"pay_yoomoney_{product_id}"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="🔶 ЮKassa", callback_data=f"pay_yookassa_{product_id}"),
+            InlineKeyboardButton(text="📱 QIWI", callback_data=f"pay_qiwi_{product_id}"),
+        )
+        builder.row(
+            InlineKeyboardButton(text="🔙 Назад", callback_data=f"product_{product_id}"),
+            InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")
+        )
         
         await callback.message.edit_text(
-            text,
-            reply_markup=Keyboards.profile_menu({
-                "balance": user.balance
-            })
+            f"🛒 <b>Покупка: {product.name}</b>\n\n"
+            f"💵 Сумма к оплате: {product.price:.2f} ₽\n\n"
+            f"Выберите способ оплаты:",
+            reply_markup=builder.as_markup()
         )
 
+# ==================== ПРОФИЛЬ ====================
+@main_router.callback_query(F.data == "profile", flags={"manual_answer": True})
+async def callback_profile(callback: CallbackQuery, user: Optional[CachedUser]):
+    """Личный кабинет"""
+    if not user:
+        await callback.answer("Пользователь не найден!")
+        return
+    
+    # Статистика (orders_count считает оплаченные заказы при покупке)
+    total_orders = user.orders_count
+    total_spent = user.total_spent
+    
+    text = f"👤 <b>Личный кабинет</b>\n\n"
+    text += f"🆔 ID: {user.user_id}\n"
+    text += f"👤 Имя: {user.first_name}\n"
+    if user.username:
+        text += f"📱 Username: @{user.username}\n"
+    text += f"📅 Регистрация: {user.registration_date.strftime('%d.%m.%Y')}\n"
+    text += f"💰 Баланс: {user.balance:.2f} ₽\n"
+    text += f"🛒 Всего покупок: {total_orders}\n"
+    text += f"💳 Всего потрачено: {total_spent:.2f} ₽\n"
+    text += f"👥 Приглашено: {user.successful_refs} чел.\n"
+    text += f"🎁 Заработано: {user.total_earned:.2f} ₽\n\n"
+    
+    if user.referral_code:
+        text += f"🔗 Реферальный код: <code>{user.referral_code}</code>\n"
+        text += f"🔗 Реферальная ссылка: https://t.me/{(await bot.me()).username}?start={user.referral_code}"
+    
+    await callback.message.edit_text(
+        text,
+        reply_markup=Keyboards.profile_menu({
+            "balance": user.balance
+        })
+    )
+
 # ==================== РЕФЕРАЛЬНАЯ СИСТЕМА ====================
-@main_router.callback_query(F.data == "referral")
-async def callback_referral(callback: CallbackQuery):
+@main_router.callback_query(F.data == "referral", flags={"manual_answer": True})
+async def callback_referral(callback: CallbackQuery, db: AsyncSession, user: Optional[CachedUser]):
     """Реферальная система"""
-    async with SessionLocal() as db:
-        user = db.query(User).filter(User.user_id == callback.from_user.id).first()
-        
-        if not user:
-            await callback.answer("Пользователь не найден!")
-            return
-        
-        # Статистика рефералов
-        referrals = db.query(Referral).filter(
-            Referral.referrer_id == user.user_id
-        ).all()
-        
-        # Расчет заработка по уровням
-        level_stats = {1: 0, 2: 0, 3: 0}
-        for ref in referrals:
-            if ref.level in level_stats:
-                level_stats[ref.level] += 1
-        
-        text = f"👥 <b>Реферальная система</b>\n\n"
-        text += f"🔗 Ваш реферальный код: <code>{user.referral_code}</code>\n"
-        text += f"🔗 Реферальная ссылка: https://t.me/{callback.message.bot.username}?start={user.referral_code}\n\n"
-        
-        text += f"📊 <b>Статистика:</b>\n"
-        text += f"• Всего рефералов: {len(referrals)}\n"
-        text += f"• Уровень 1: {level_stats[1]} чел.\n"
-        text += f"• Уровень 2: {level_stats[2]} чел.\n"
-        text += f"• Уровень 3: {level_stats[3]} чел.\n"
-        text += f"• Заработано: {user.total_earned:.2f} ₽\n\n"
-        
-        text += f"💰 <b>Условия:</b>\n"
-        text += f"• За каждого реферала 1 уровня: {Config.REFERRAL_PERCENT}% от его покупок\n"
-        text += f"• За каждого реферала 2 уровня: {Config.REFERRAL_PERCENT//2}% от его покупок\n"
-        text += f"• За каждого реферала 3 уровня: {Config.REFERRAL_PERCENT//4}% от его покупок\n\n"
-        
-        text += f"🎁 <b>Бонусы:</b>\n"
-        text += f"• За приглашение друга: 100 ₽ каждому\n"
-        text += f"• Минимальный вывод: {Config.MIN_WITHDRAW} ₽"
-        
-        await callback.message.edit_text(
-            text,
-            reply_markup=Keyboards.referral_menu(user.referral_code)
-        )
+    if not user:
+        await callback.answer("Пользователь не найден!")
+        return
+    
+    # Статистика рефералов по уровням
+    level_stats = await ReferralTree.level_stats(db, user.user_id)
+    
+    text = f"👥 <b>Реферальная система</b>\n\n"
+    text += f"🔗 Ваш реферальный код: <code>{user.referral_code}</code>\n"
+    text += f"🔗 Реферальная ссылка: https://t.me/{(await bot.me()).username}?start={user.referral_code}\n\n"
+    
+    text += f"📊 <b>Статистика:</b>\n"
+    text += f"• Всего рефералов: {sum(level_stats.values())}\n"
+    for level, count in level_stats.items():
+        text += f"• Уровень {level}: {count} чел.\n"
+    text += f"• Заработано: {user.total_earned:.2f} ₽\n\n"
+    
+    text += f"💰 <b>Условия:</b>\n"
+    for level, percent in enumerate(Config.REFERRAL_LEVEL_PERCENTS[:Config.REFERRAL_LEVELS], 1):
+        text += f"• За каждого реферала {level} уровня: {percent}% от его покупок\n"
+    text += "\n"
+    
+    text += f"🎁 <b>Бонусы:</b>\n"
+    text += f"• За приглашение друга: 100 ₽ каждому\n"
+    text += f"• Минимальный вывод: {Config.MIN_WITHDRAW} ₽"
+    
+    await callback.message.edit_text(
+        text,
+        reply_markup=Keyboards.referral_menu(user.referral_code)
+    )
 
-@main_router.callback_query(F.data.startswith("copy_ref_"))
+@main_router.callback_query(F.data.startswith("copy_ref_"), flags={"manual_answer": True})
 async def callback_copy_ref(callback: CallbackQuery):
     """Копирование реферальной ссылки"""
     ref_code = callback.data.split("_")[2]
-    ref_link = f"https://t.me/{callback.message.bot.username}?start={ref_code}"
+    ref_link = f"https://t.me/{(await bot.me()).username}?start={ref_code}"
     
     await callback.answer(
         f"Ссылка скопирована!\n\n{ref_link}",
@@ -951,34 +3585,35 @@ async def callback_copy_ref(callback: CallbackQuery):
 
 # ==================== ПОДДЕРЖКА ====================
 @main_router.callback_query(F.data == "support")
-async def callback_support(callback: CallbackQuery):
+async def callback_support(callback: CallbackQuery, db: AsyncSession):
     """Техническая поддержка"""
-    async with SessionLocal() as db:
-        # Получение открытых тикетов пользователя
-        tickets = db.query(SupportTicket).filter(
+    # Получение открытых тикетов пользователя
+    tickets = await db.scalar(
+        select(func.count()).select_from(SupportTicket).where(
             SupportTicket.user_id == callback.from_user.id,
             SupportTicket.status == "open"
-        ).count()
-        
-        text = f"🆘 <b>Техническая поддержка</b>\n\n"
-        text += f"Здесь вы можете получить помощь по работе с ботом.\n\n"
-        
-        if tickets > 0:
-            text += f"📨 У вас есть открытые тикеты: {tickets}\n"
-        
-        text += f"\n<b>Доступные опции:</b>\n"
-        text += f"• Создать новый тикет\n"
-        text += f"• Просмотреть мои тикеты\n"
-        text += f"• Связаться с менеджером\n"
-        text += f"• Читать FAQ\n\n"
-        
-        text += f"⏱ <b>Время ответа:</b> до 15 минут\n"
-        text += f"🕒 <b>Рабочие часы:</b> 24/7"
-        
-        await callback.message.edit_text(
-            text,
-            reply_markup=Keyboards.support_menu()
         )
+    )
+    
+    text = f"🆘 <b>Техническая поддержка</b>\n\n"
+    text += f"Здесь вы можете получить помощь по работе с ботом.\n\n"
+    
+    if tickets > 0:
+        text += f"📨 У вас есть открытые тикеты: {tickets}\n"
+    
+    text += f"\n<b>Доступные опции:</b>\n"
+    text += f"• Создать новый тикет\n"
+    text += f"• Просмотреть мои тикеты\n"
+    text += f"• Связаться с менеджером\n"
+    text += f"• Читать FAQ\n\n"
+    
+    text += f"⏱ <b>Время ответа:</b> до 15 минут\n"
+    text += f"🕒 <b>Рабочие часы:</b> 24/7"
+    
+    await callback.message.edit_text(
+        text,
+        reply_markup=Keyboards.support_menu()
+    )
 
 @main_router.callback_query(F.data == "create_ticket")
 async def callback_create_ticket(callback: CallbackQuery, state: FSMContext):
@@ -998,205 +3633,463 @@ async def callback_create_ticket(callback: CallbackQuery, state: FSMContext):
         ])
     )
 
-@main_router.message(Form.waiting_for_support_message)
-async def process_support_message(message: Message, state: FSMContext):
+@main_router.message(Form.waiting_for_support_message, flags={"rate_limit": "support"})
+async def process_support_message(message: Message, state: FSMContext, db: AsyncSession):
     """Обработка сообщения в поддержку"""
     if len(message.text) < 10:
         await message.answer("Сообщение слишком короткое. Опишите проблему подробнее.")
         return
     
-    async with SessionLocal() as db:
-        # Создание тикета
-        ticket_id = f"TICKET_{int(datetime.datetime.now().timestamp())}_{message.from_user.id}"
-        
-        ticket = SupportTicket(
-            ticket_id=ticket_id,
-            user_id=message.from_user.id,
-            subject="Проблема с ботом",
-            message=message.text,
-            status="open",
-            priority="normal",
-            messages=[{
-                "from": "user",
-                "text": message.text,
-                "time": datetime.datetime.utcnow().isoformat()
-            }]
-        )
-        
-        db.add(ticket)
-        await db.commit()
-        
-        # Уведомление админов
-        for admin_id in Config.ADMIN_IDS:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"🆘 <b>Новый тикет #{ticket_id}</b>\n\n"
-                    f"👤 Пользователь: @{message.from_user.username or 'нет'}\n"
-                    f"🆔 ID: {message.from_user.id}\n\n"
-                    f"📝 <b>Сообщение:</b>\n{message.text}\n\n"
-                    f"📅 Время: {datetime.datetime.now().strftime('%d.%m.%Y %H:%M')}",
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="📨 Ответить", callback_data=f"admin_reply_{ticket.id}")]
-                    ])
-                )
-            except:
-                pass
-        
-        await state.clear()
-        
-        await message.answer(
-            f"✅ <b>Тикет создан!</b>\n\n"
-            f"🆔 Номер тикета: <code>{ticket_id}</code>\n"
-            f"📅 Время: {datetime.datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
-            f"Мы ответим вам в течение 15 минут.\n"
-            f"Вы можете просмотреть статус тикета в разделе 'Мои тикеты'.",
+    # Создание тикета
+    ticket = await Tickets.create(db, message.from_user.id, message.text)
+    
+    # Уведомление админов параллельно, не задерживая ответ пользователю
+    asyncio.create_task(Tickets.notify(
+        Config.ADMIN_IDS,
+        f"🆘 <b>Новый тикет #{ticket.ticket_id}</b>\n\n"
+        f"👤 Пользователь: @{message.from_user.username or 'нет'}\n"
+        f"🆔 ID: {message.from_user.id}\n\n"
+        f"📝 <b>Сообщение:</b>\n{html.escape(message.text)}\n\n"
+        f"📅 Время: {datetime.datetime.now().strftime('%d.%m.%Y %H:%M')}",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📨 Ответить", callback_data=f"admin_reply_{ticket.id}")],
+            [InlineKeyboardButton(text="🙋 Взять", callback_data=f"admin_claim_{ticket.id}")]
+        ])
+    ))
+    
+    await state.clear()
+    
+    await message.answer(
+        f"✅ <b>Тикет создан!</b>\n\n"
+        f"🆔 Номер тикета: <code>{ticket.ticket_id}</code>\n"
+        f"📅 Время: {datetime.datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
+        f"Мы ответим вам в течение 15 минут.\n"
+        f"Вы можете просмотреть статус тикета в разделе 'Мои тикеты'.",
+        reply_markup=Keyboards.support_menu()
+    )
+
+@main_router.callback_query(F.data == "my_tickets")
+async def callback_my_tickets(callback: CallbackQuery, db: AsyncSession):
+    """Последние тикеты пользователя"""
+    tickets = (await db.execute(
+        select(SupportTicket.id, SupportTicket.ticket_id, SupportTicket.status, SupportTicket.messages_count)
+        .where(SupportTicket.user_id == callback.from_user.id)
+        .order_by(SupportTicket.updated_at.desc())
+        .limit(Config.TICKET_LIST_LIMIT)
+    )).all()
+    
+    if not tickets:
+        await callback.message.edit_text(
+            "📋 <b>Мои тикеты</b>\n\nУ вас пока нет обращений в поддержку.",
             reply_markup=Keyboards.support_menu()
         )
+        return
+    
+    icons = {Tickets.OPEN: "⏳", Tickets.ANSWERED: "💬", Tickets.CLOSED: "🔒"}
+    builder = InlineKeyboardBuilder()
+    for ticket in tickets:
+        builder.row(InlineKeyboardButton(
+            text=f"{icons.get(ticket.status, '📨')} #{ticket.ticket_id} ({ticket.messages_count})",
+            callback_data=f"thist_{ticket.id}_0"
+        ))
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="support"))
+    
+    await callback.message.edit_text(
+        "📋 <b>Мои тикеты</b>\n\n⏳ - ждет ответа, 💬 - есть ответ, 🔒 - закрыт",
+        reply_markup=builder.as_markup()
+    )
+
+@main_router.callback_query(F.data.startswith("thist_"), flags={"manual_answer": True})
+async def callback_ticket_history(callback: CallbackQuery, db: AsyncSession):
+    """Переписка по тикету: thist_<тикет>_<курсор>"""
+    _, ticket_id, cursor = callback.data.split("_")
+    ticket = await db.get(SupportTicket, int(ticket_id))
+    
+    if not ticket or ticket.user_id != callback.from_user.id:
+        await callback.answer("Тикет не найден!")
+        return
+    
+    page = await Tickets.history(db, ticket.id, Categories.decode_cursor(cursor))
+    await callback.message.edit_text(
+        Tickets.render_history(ticket, page),
+        reply_markup=Keyboards.ticket_menu(ticket.id, page["older"])
+    )
+
+@main_router.callback_query(F.data.startswith("treply_"))
+async def callback_ticket_reply(callback: CallbackQuery, state: FSMContext):
+    """Новое сообщение в тикет"""
+    await state.set_state(Form.waiting_for_ticket_reply)
+    await state.update_data(ticket_id=int(callback.data.split("_")[1]))
+    
+    await callback.message.edit_text(
+        "✍️ <b>Сообщение в тикет</b>\n\nНапишите, что хотите добавить.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data="my_tickets")]
+        ])
+    )
+
+@main_router.message(Form.waiting_for_ticket_reply, flags={"rate_limit": "support"})
+async def process_ticket_reply(message: Message, state: FSMContext, db: AsyncSession):
+    """Сообщение пользователя в существующий тикет"""
+    if not message.text:
+        await message.answer("Отправьте текстовое сообщение.")
+        return
+    
+    ticket_id = (await state.get_data()).get("ticket_id")
+    await state.clear()
+    
+    ticket = await Tickets.user_reply(db, ticket_id, message.from_user.id, message.text) if ticket_id else None
+    if ticket is None:
+        await message.answer("Тикет не найден!", reply_markup=Keyboards.support_menu())
+        return
+    
+    # Взятый тикет - его админу, свободный - всем
+    asyncio.create_task(Tickets.notify(
+        [ticket.admin_id] if ticket.admin_id else Config.ADMIN_IDS,
+        f"💬 <b>Сообщение в тикет #{ticket.ticket_id}</b>\n\n{html.escape(message.text)}",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📨 Ответить", callback_data=f"admin_reply_{ticket_id}")]
+        ])
+    ))
+    
+    await message.answer(
+        f"✅ Сообщение добавлено в тикет <code>{ticket.ticket_id}</code>.",
+        reply_markup=Keyboards.ticket_menu(ticket_id)
+    )
 
 # ==================== АДМИН ПАНЕЛЬ ====================
 @admin_router.message(Command("admin"))
-async def cmd_admin(message: Message):
+async def cmd_admin(message: Message, db: AsyncSession):
     """Админ панель"""
     if message.from_user.id not in Config.ADMIN_IDS:
         return
     
-    async with SessionLocal() as db:
-        # Статистика
-        total_users = db.query(User).count()
-        total_products = db.query(Product).count()
-        total_orders = db.query(Order).count()
-        
-        # Финансы
-        total_revenue = db.query(Order.total_amount).filter(
-            Order.status == "paid"
-        ).all()
-        total_revenue_sum = sum([r[0] for r in total_revenue]) if total_revenue else 0
-        
-        today = datetime.datetime.utcnow().date()
-        today_orders = db.query(Order).filter(
-            Order.status == "paid",
-            Order.created_at >= today
-        ).count()
-        
-        text = f"⚙️ <b>Админ панель</b>\n\n"
-        text += f"📊 <b>Статистика:</b>\n"
-        text += f"• Пользователей: {total_users}\n"
-        text += f"• Товаров: {total_products}\n"
-        text += f"• Заказов: {total_orders}\n"
-        text += f"• Заказов сегодня: {today_orders}\n"
-        text += f"• Общая выручка: {total_revenue_sum:.2f} ₽\n\n"
-        
-        # Последние заказы
-        recent_orders = db.query(Order).order_by(
-            Order.created_at.desc()
-        ).limit(5).all()
-        
-        if recent_orders:
-            text += f"🔄 <b>Последние заказы:</b>\n"
-            for order in recent_orders:
-                product = db.query(Product).filter(Product.id == order.product_id).first()
-                text += f"• {product.name if product else 'Товар'} - {order.total_amount} ₽\n"
-        
-        await message.answer(
-            text,
-            reply_markup=Keyboards.admin_menu()
-        )
+    # Статистика
+    data = await stats.snapshot()
+    total_products = await db.scalar(select(func.count()).select_from(Product))
+    
+    text = f"⚙️ <b>Админ панель</b>\n\n"
+    text += f"📊 <b>Статистика:</b>\n"
+    text += f"• Пользователей: {data['users']}\n"
+    text += f"• Товаров: {total_products}\n"
+    text += f"• Заказов: {data['orders']}\n"
+    text += f"• Заказов сегодня: {data['today']['paid_orders']:.0f}\n"
+    text += f"• Общая выручка: {data['revenue']:.2f} ₽\n\n"
+    
+    # Последние заказы
+    if data["recent"]:
+        text += f"🔄 <b>Последние заказы:</b>\n"
+        for order in data["recent"]:
+            text += f"• {order['name'] or 'Товар'} - {order['amount']} ₽\n"
+    
+    await message.answer(
+        text,
+        reply_markup=Keyboards.admin_menu()
+    )
 
 @admin_router.callback_query(F.data == "admin_stats")
-async def callback_admin_stats(callback: CallbackQuery):
+async def callback_admin_stats(callback: CallbackQuery, db: AsyncSession):
     """Статистика для админа"""
     if callback.from_user.id not in Config.ADMIN_IDS:
         return
     
-    async with SessionLocal() as db:
-        # Детальная статистика
-        today = datetime.datetime.utcnow().date()
-        week_ago = today - datetime.timedelta(days=7)
-        
-        # Пользователи
-        total_users = db.query(User).count()
-        new_users_today = db.query(User).filter(
-            User.registration_date >= today
-        ).count()
-        active_users = db.query(User).filter(
-            User.last_activity >= week_ago
-        ).count()
-        
-        # Заказы
-        total_orders = db.query(Order).count()
-        today_orders = db.query(Order).filter(
-            Order.created_at >= today
-        ).count()
-        week_orders = db.query(Order).filter(
-            Order.created_at >= week_ago
-        ).count()
-        
-        # Финансы
-        total_revenue = db.scalar(
-            db.query(db.func.sum(Order.total_amount)).filter(
-                Order.status == "paid"
-            )
-        ) or 0
-        
-        today_revenue = db.scalar(
-            db.query(db.func.sum(Order.total_amount)).filter(
-                Order.status == "paid",
-                Order.created_at >= today
-            )
-        ) or 0
-        
-        week_revenue = db.scalar(
-            db.query(db.func.sum(Order.total_amount)).filter(
-                Order.status == "paid",
-                Order.created_at >= week_ago
-            )
-        ) or 0
-        
-        text = f"📊 <b>Детальная статистика</b>\n\n"
-        
-        text += f"👥 <b>Пользователи:</b>\n"
-        text += f"• Всего: {total_users}\n"
-        text += f"• Новых сегодня: {new_users_today}\n"
-        text += f"• Активных за неделю: {active_users}\n\n"
-        
-        text += f"🛒 <b>Заказы:</b>\n"
-        text += f"• Всего: {total_orders}\n"
-        text += f"• Сегодня: {today_orders}\n"
-        text += f"• За неделю: {week_orders}\n\n"
-        
-        text += f"💰 <b>Финансы:</b>\n"
-        text += f"• Общая выручка: {total_revenue:.2f} ₽\n"
-        text += f"• Выручка сегодня: {today_revenue:.2f} ₽\n"
-        text += f"• Выручка за неделю: {week_revenue:.2f} ₽\n\n"
-        
-        # Топ товаров
-        top_products = db.query(
-            Product.name, Product.sales_count, Product.total_revenue
-        ).order_by(
-            Product.sales_count.desc()
-        ).limit(5).all()
-        
-        if top_products:
-            text += f"🏆 <b>Топ товаров:</b>\n"
-            for i, (name, sales, revenue) in enumerate(top_products, 1):
-                text += f"{i}. {name[:20]}... - {sales} шт. ({revenue:.0f} ₽)\n"
-        
-        await callback.message.edit_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📈 Графики", callback_data="admin_charts")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-            ])
-        )
+    # Детальная статистика
+    data = await stats.snapshot()
+    
+    text = f"📊 <b>Детальная статистика</b>\n\n"
+    
+    text += f"👥 <b>Пользователи:</b>\n"
+    text += f"• Всего: {data['users']}\n"
+    text += f"• Новых сегодня: {data['today']['new_users']:.0f}\n"
+    text += f"• Активных за неделю: {data['active_users']}\n\n"
+    
+    text += f"🛒 <b>Заказы:</b>\n"
+    text += f"• Всего: {data['orders']}\n"
+    text += f"• Сегодня: {data['today']['orders']:.0f}\n"
+    text += f"• За неделю: {data['week']['orders']:.0f}\n\n"
+    
+    text += f"💰 <b>Финансы:</b>\n"
+    text += f"• Общая выручка: {data['revenue']:.2f} ₽\n"
+    text += f"• Выручка сегодня: {data['today']['revenue']:.2f} ₽\n"
+    text += f"• Выручка за неделю: {data['week']['revenue']:.2f} ₽\n\n"
+    
+    # Топ товаров
+    if data["top"]:
+        text += f"🏆 <b>Топ товаров:</b>\n"
+        for i, (name, sales, revenue) in enumerate(data["top"], 1):
+            text += f"{i}. {name[:20]}... - {sales} шт. ({revenue:.0f} ₽)\n"
+    
+    await callback.message.edit_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📈 Графики", callback_data="admin_charts")],
+            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+        ])
+    )
+
+@admin_router.callback_query(F.data == "admin_broadcast")
+async def callback_admin_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Запуск рассылки"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    await state.set_state(Form.admin_waiting_broadcast)
+    
+    await callback.message.edit_text(
+        "📢 <b>Рассылка</b>\n\n"
+        "Отправьте текст сообщения для всех пользователей.\n"
+        "Форматирование сообщения сохранится.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data="admin_back")]
+        ])
+    )
+
+@admin_router.message(Form.admin_waiting_broadcast)
+async def process_admin_broadcast(message: Message, state: FSMContext):
+    """Текст рассылки получен"""
+    if message.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    if not message.text:
+        await message.answer("Отправьте текстовое сообщение.")
+        return
+    
+    await state.clear()
+    
+    status_message = await message.answer("📢 <b>Рассылка</b>\n\n⏳ Подготовка...")
+    job_id = await broadcaster.create(message.from_user.id, message.html_text, status_message.message_id)
+    
+    logger.info(f"Broadcast {job_id} started by {message.from_user.id}")
+
+@admin_router.callback_query(F.data.startswith("broadcast_cancel_"), flags={"manual_answer": True})
+async def callback_broadcast_cancel(callback: CallbackQuery):
+    """Остановка рассылки"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    await broadcaster.cancel(callback.data.split("_")[2])
+    await callback.answer("Рассылка будет остановлена")
+
+@admin_router.callback_query(F.data == "admin_support")
+async def callback_admin_support(callback: CallbackQuery, db: AsyncSession):
+    """Очередь тикетов"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    await show_ticket_queue(callback, db)
+
+@admin_router.callback_query(F.data.startswith("admq_"))
+async def callback_admin_queue(callback: CallbackQuery, db: AsyncSession):
+    """Листание очереди: admq_<f - свободные, m - мои>_<курсор>"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    _, mode, cursor = callback.data.split("_")
+    await show_ticket_queue(callback, db, mode, Categories.decode_cursor(cursor))
+
+async def show_ticket_queue(callback: CallbackQuery, db: AsyncSession, mode: str = "f", cursor: int = 0):
+    """Ждущие ответа тикеты: свободные или взятые админом"""
+    admin_id = callback.from_user.id if mode == "m" else None
+    page = await Tickets.queue(db, admin_id, cursor)
+    
+    text = f"🆘 <b>Поддержка: {'мои тикеты' if admin_id else 'свободные тикеты'}</b>\n\n"
+    if not page["items"]:
+        text += "Тикетов, ждущих ответа, нет."
+    
+    now = datetime.datetime.utcnow()
+    builder = InlineKeyboardBuilder()
+    for ticket in page["items"]:
+        waiting = int((now - ticket.updated_at).total_seconds() // 60)
+        builder.row(InlineKeyboardButton(
+            text=f"#{ticket.ticket_id} · {ticket.messages_count} сообщ. · ждет {waiting} мин",
+            callback_data=f"admin_thist_{ticket.id}_0"
+        ))
+    if page["next"]:
+        builder.row(InlineKeyboardButton(
+            text="Далее ➡️", callback_data=f"admq_{mode}_{Categories.encode_cursor(page['next'])}"
+        ))
+    builder.row(
+        InlineKeyboardButton(text="🆓 Свободные" if admin_id else "✅ Свободные", callback_data="admq_f_0"),
+        InlineKeyboardButton(text="✅ Мои" if admin_id else "🙋 Мои", callback_data="admq_m_0"),
+    )
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back"))
+    
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
+
+@admin_router.callback_query(F.data.startswith("admin_thist_"))
+async def callback_admin_ticket(callback: CallbackQuery, db: AsyncSession):
+    """Тикет в админке: admin_thist_<тикет>_<курсор>"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    _, _, ticket_id, cursor = callback.data.split("_")
+    await show_admin_ticket(callback, db, int(ticket_id), Categories.decode_cursor(cursor))
+
+async def show_admin_ticket(callback: CallbackQuery, db: AsyncSession, ticket_id: int, cursor: int = 0):
+    """Вывод тикета со страницей переписки"""
+    ticket = await db.get(SupportTicket, ticket_id, populate_existing=True)
+    if not ticket:
+        await callback.message.edit_text("Тикет не найден!", reply_markup=Keyboards.admin_menu())
+        return
+    
+    page = await Tickets.history(db, ticket.id, cursor)
+    await callback.message.edit_text(
+        Tickets.render_history(ticket, page, for_admin=True),
+        reply_markup=Keyboards.admin_ticket_menu(ticket.id, page["older"], ticket.admin_id is not None)
+    )
+
+@admin_router.callback_query(F.data.startswith("admin_claim_"), flags={"manual_answer": True})
+async def callback_admin_claim(callback: CallbackQuery, db: AsyncSession):
+    """Взять тикет: первый нажавший админ получает его, остальным - отказ"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    ticket_id = int(callback.data.split("_")[2])
+    if not await Tickets.assign(db, ticket_id, callback.from_user.id):
+        await callback.answer("Тикет уже взял другой админ или он закрыт", show_alert=True)
+        return
+    
+    await callback.answer("🙋 Тикет ваш")
+    await show_admin_ticket(callback, db, ticket_id)
+
+@admin_router.callback_query(F.data.startswith("admin_assign_"))
+async def callback_admin_assign(callback: CallbackQuery):
+    """Выбор админа, которому передать тикет"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    ticket_id = int(callback.data.split("_")[2])
+    builder = InlineKeyboardBuilder()
+    for admin_id in Config.ADMIN_IDS:
+        if admin_id != callback.from_user.id:
+            builder.row(InlineKeyboardButton(
+                text=f"👤 {admin_id}", callback_data=f"admin_assignto_{ticket_id}_{admin_id}"
+            ))
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data=f"admin_thist_{ticket_id}_0"))
+    
+    await callback.message.edit_text("👥 <b>Кому передать тикет?</b>", reply_markup=builder.as_markup())
+
+@admin_router.callback_query(F.data.startswith("admin_assignto_"), flags={"manual_answer": True})
+async def callback_admin_assign_to(callback: CallbackQuery, db: AsyncSession):
+    """Передача тикета: admin_assignto_<тикет>_<админ>"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    _, _, ticket_id, to_admin_id = callback.data.split("_")
+    ticket_id, to_admin_id = int(ticket_id), int(to_admin_id)
+    if to_admin_id not in Config.ADMIN_IDS or not await Tickets.assign(db, ticket_id, callback.from_user.id, to_admin_id):
+        await callback.answer("Тикет взял другой админ или он закрыт", show_alert=True)
+        return
+    
+    await callback.answer("👥 Тикет передан")
+    asyncio.create_task(Tickets.notify(
+        [to_admin_id],
+        f"👥 Вам передан тикет от админа {callback.from_user.id}",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📨 Открыть", callback_data=f"admin_thist_{ticket_id}_0")]
+        ])
+    ))
+    await show_admin_ticket(callback, db, ticket_id)
+
+@admin_router.callback_query(F.data.startswith("admin_close_"), flags={"manual_answer": True})
+async def callback_admin_close(callback: CallbackQuery, db: AsyncSession):
+    """Закрытие тикета"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    ticket_id = int(callback.data.split("_")[2])
+    ticket = await Tickets.close(db, ticket_id, callback.from_user.id)
+    if ticket is None:
+        await callback.answer("Тикет взял другой админ или он уже закрыт", show_alert=True)
+        return
+    
+    await callback.answer("🔒 Тикет закрыт")
+    notifications.push(
+        ticket.user_id,
+        "Тикет закрыт",
+        f"Обращение #{ticket.ticket_id} закрыто. Если вопрос остался, напишите в тикет - он откроется снова."
+    )
+    await show_admin_ticket(callback, db, ticket_id)
+
+@admin_router.callback_query(F.data.startswith("admin_reply_"))
+async def callback_admin_reply(callback: CallbackQuery, state: FSMContext):
+    """Ответ на тикет"""
+    if callback.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    ticket_id = int(callback.data.split("_")[2])
+    await state.set_state(Form.admin_waiting_ticket_reply)
+    await state.update_data(ticket_id=ticket_id)
+    
+    await callback.message.answer(
+        "📨 <b>Ответ на тикет</b>\n\nОтправьте текст ответа пользователю.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"admin_thist_{ticket_id}_0")]
+        ])
+    )
+
+@admin_router.message(Form.admin_waiting_ticket_reply)
+async def process_admin_ticket_reply(message: Message, state: FSMContext, db: AsyncSession):
+    """Текст ответа получен: сообщение в тикет и пользователю"""
+    if message.from_user.id not in Config.ADMIN_IDS:
+        return
+    
+    if not message.text:
+        await message.answer("Отправьте текстовое сообщение.")
+        return
+    
+    ticket_id = (await state.get_data()).get("ticket_id")
+    await state.clear()
+    
+    ticket = await Tickets.admin_reply(db, ticket_id, message.from_user.id, message.text) if ticket_id else None
+    if ticket is None:
+        await message.answer("❌ Тикет закрыт или его ведет другой админ.", reply_markup=Keyboards.admin_menu())
+        return
+    
+    asyncio.create_task(Tickets.notify(
+        [ticket.user_id],
+        f"💬 <b>Ответ поддержки по тикету #{ticket.ticket_id}</b>\n\n{html.escape(message.text)}",
+        reply_markup=Keyboards.ticket_menu(ticket_id)
+    ))
+    
+    await message.answer(
+        f"✅ Ответ отправлен в тикет <code>{ticket.ticket_id}</code>.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📨 К тикету", callback_data=f"admin_thist_{ticket_id}_0")],
+            [InlineKeyboardButton(text="🆘 Очередь", callback_data="admin_support")]
+        ])
+    )
 
 # ==================== ДОСТАВКА ТОВАРОВ ====================
+def prepare_delivery_data(product: Product) -> dict:
+    """Данные выдачи заказа (ключ, логин и пароль) без отправки"""
+    if product.file_url:
+        return {"type": "file", "file_url": product.file_url}
+    
+    delivery_data = {"type": "text"}
+    if product.attributes.get("type") == "license_key":
+        delivery_data["key"] = generate_license_key()
+    elif product.attributes.get("type") == "account":
+        delivery_data["login"] = generate_account_login()
+        delivery_data["password"] = generate_password()
+    return delivery_data
+
 async def deliver_product(user_id: int, order: Order, product: Product):
     """Автоматическая доставка товара"""
     
     try:
+        # Данные выдачи сохраняются до отправки: повтор после сбоя отправит те же ключ/логин
+        delivery_data = dict(order.delivery_data or {})
+        if "type" not in delivery_data:
+            delivery_data = prepare_delivery_data(product)
+            async with SessionLocal() as db:
+                await db.execute(update(Order).where(Order.id == order.id).values(delivery_data=delivery_data))
+                await db.commit()
+        
         # Для цифровых товаров
-        if product.file_url:
+        if delivery_data["type"] == "file":
+            file_url = delivery_data["file_url"]
+            
             # Если есть файл - отправляем
             delivery_message = (
                 f"✅ <b>Ваш заказ #{order.order_id} доставлен!</b>\n\n"
@@ -1211,79 +4104,45 @@ async def deliver_product(user_id: int, order: Order, product: Product):
             delivery_message += "⬇️ <b>Ссылка для скачивания:</b>\n"
             
             # Отправка сообщения с файлом
-            try:
+            await bot.send_message(
+                user_id,
+                delivery_message,
+                disable_web_page_preview=False
+            )
+            
+            # Отправка файла или ссылки
+            if file_url.startswith(('http', 'https')):
                 await bot.send_message(
                     user_id,
-                    delivery_message,
-                    disable_web_page_preview=False
+                    f"🔗 <a href='{file_url}'>Скачать товар</a>\n\n"
+                    f"<i>Если ссылка не работает, обратитесь в поддержку.</i>"
                 )
-                
-                # Отправка файла или ссылки
-                if product.file_url.startswith(('http', 'https')):
-                    await bot.send_message(
-                        user_id,
-                        f"🔗 <a href='{product.file_url}'>Скачать товар</a>\n\n"
-                        f"<i>Если ссылка не работает, обратитесь в поддержку.</i>"
-                    )
-                else:
-                    # Локальный файл
-                    await bot.send_document(
-                        user_id,
-                        FSInputFile(product.file_url),
-                        caption="📎 Ваш файл"
-                    )
-                    
-            except Exception as e:
-                logger.error(f"Failed to send file: {e}")
-                
-                # Если не удалось отправить файл, сохраняем данные в заказ
-                async with SessionLocal() as db:
-                    order.delivery_data = {
-                        "file_url": product.file_url,
-                        "password": product.file_password,
-                        "delivery_attempts": 1
-                    }
-                    await db.commit()
-                
-                await bot.send_message(
-                    user_id,
-                    f"📦 <b>Товар готов к выдаче!</b>\n\n"
-                    f"Обратитесь в поддержку для получения файла.\n"
-                    f"🆔 Номер заказа: <code>{order.order_id}</code>"
+            else:
+                # Локальный файл: загружается один раз, дальше отправляется по file_id
+                await media_cache.send(
+                    product.id, "file", MediaCache.file_source(file_url),
+                    lambda document: bot.send_document(user_id, document, caption="📎 Ваш файл"),
+                    FSInputFile(file_url)
                 )
         
         else:
             # Для товаров без файла (ключи, аккаунты и т.д.)
-            delivery_data = {
-                "type": "text",
-                "delivered_at": datetime.datetime.now().isoformat()
-            }
-            
-            # Генерация данных товара (например, ключа)
-            if product.attributes.get("type") == "license_key":
-                key = generate_license_key()
-                delivery_data["key"] = key
-                
+            if "key" in delivery_data:
                 delivery_message = (
                     f"✅ <b>Ваш заказ #{order.order_id} доставлен!</b>\n\n"
                     f"🎁 <b>Товар:</b> {product.name}\n"
-                    f"🔑 <b>Ключ:</b> <code>{key}</code>\n\n"
+                    f"🔑 <b>Ключ:</b> <code>{delivery_data['key']}</code>\n\n"
                     f"💵 <b>Сумма:</b> {order.total_amount:.2f} ₽\n"
                     f"📅 <b>Время:</b> {datetime.datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
                     f"<i>Сохраните ключ в надежном месте!</i>"
                 )
                 
-            elif product.attributes.get("type") == "account":
-                login = generate_account_login()
-                password = generate_password()
-                delivery_data["login"] = login
-                delivery_data["password"] = password
-                
+            elif "login" in delivery_data:
                 delivery_message = (
                     f"✅ <b>Ваш заказ #{order.order_id} доставлен!</b>\n\n"
                     f"🎁 <b>Товар:</b> {product.name}\n"
-                    f"👤 <b>Логин:</b> <code>{login}</code>\n"
-                    f"🔐 <b>Пароль:</b> <code>{password}</code>\n\n"
+                    f"👤 <b>Логин:</b> <code>{delivery_data['login']}</code>\n"
+                    f"🔐 <b>Пароль:</b> <code>{delivery_data['password']}</code>\n\n"
                     f"💵 <b>Сумма:</b> {order.total_amount:.2f} ₽\n"
                     f"📅 <b>Время:</b> {datetime.datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
                     f"<i>Рекомендуем сменить пароль после входа!</i>"
@@ -1298,16 +4157,19 @@ async def deliver_product(user_id: int, order: Order, product: Product):
                     f"<i>Для получения товара обратитесь в поддержку.</i>"
                 )
             
-            # Сохранение данных доставки
-            async with SessionLocal() as db:
-                order.delivery_data = delivery_data
-                order.delivered_at = datetime.datetime.utcnow()
-                await db.commit()
-            
             await bot.send_message(user_id, delivery_message)
         
-        # Начисление реферального бонуса
-        await process_referral_bonus(order)
+        # Отметка доставки: после этого повторная доставка не выполняется
+        order.delivery_data = {**delivery_data, "delivered_at": datetime.datetime.now().isoformat()}
+        order.delivered_at = datetime.datetime.utcnow()
+        async with SessionLocal() as db:
+            await db.execute(
+                update(Order).where(Order.id == order.id).values(
+                    delivery_data=order.delivery_data,
+                    delivered_at=order.delivered_at
+                )
+            )
+            await db.commit()
         
         # Отправка уведомления о доставке
         await Utils.send_notification(
@@ -1318,12 +4180,9 @@ async def deliver_product(user_id: int, order: Order, product: Product):
         )
         
     except Exception as e:
+        # Повтор с задержкой выполняет DeliveryQueue
         logger.error(f"Delivery error: {e}")
-        await bot.send_message(
-            user_id,
-            f"⚠️ <b>Ошибка при доставке заказа #{order.order_id}</b>\n\n"
-            f"Пожалуйста, обратитесь в поддержку для решения проблемы."
-        )
+        raise
 
 def generate_license_key() -> str:
     """Генерация лицензионного ключа"""
@@ -1358,129 +4217,894 @@ def generate_password() -> str:
     return ''.join(random.choices(chars, k=length))
 
 # ==================== РЕФЕРАЛЬНЫЕ ВЫПЛАТЫ ====================
+class ReferralTree:
+    """Цепочки предков хранятся при регистрации, выплата и статистика не обходят дерево"""
+    
+    @staticmethod
+    async def link(db: AsyncSession, referrer_id: int, user_id: int):
+        """Строки нового пользователя: пригласивший (уровень 1) и его предки со сдвигом уровня"""
+        now = datetime.datetime.utcnow()
+        await db.execute(insert(Referral).values(
+            referrer_id=referrer_id, referred_id=user_id, level=1, earned=0.0, status="active", registered_at=now
+        ))
+        await db.execute(insert(Referral).from_select(
+            ["referrer_id", "referred_id", "level", "earned", "status", "registered_at"],
+            select(
+                Referral.referrer_id, literal(user_id, BigInteger), Referral.level + 1,
+                literal(0.0), literal("active"), literal(now, DateTime)
+            ).where(Referral.referred_id == referrer_id, Referral.level < Config.REFERRAL_LEVELS)
+        ))
+    
+    @staticmethod
+    def ancestors_query(user_id: int):
+        return (
+            select(Referral.referrer_id, Referral.level)
+            .where(Referral.referred_id == user_id, Referral.level <= Config.REFERRAL_LEVELS)
+            .order_by(Referral.level)
+        )
+    
+    @staticmethod
+    async def ancestors(db: AsyncSession, user_id: int) -> list:
+        """[(referrer_id, level)] от ближайшего предка"""
+        return (await db.execute(ReferralTree.ancestors_query(user_id))).all()
+    
+    @staticmethod
+    def level_stats_query(user_id: int):
+        return (
+            select(Referral.level, func.count())
+            .where(Referral.referrer_id == user_id)
+            .group_by(Referral.level)
+        )
+    
+    @staticmethod
+    async def level_stats(db: AsyncSession, user_id: int) -> Dict[int, int]:
+        """Количество рефералов на каждом уровне"""
+        counts = dict((await db.execute(ReferralTree.level_stats_query(user_id))).all())
+        return {level: counts.get(level, 0) for level in range(1, Config.REFERRAL_LEVELS + 1)}
+    
+    @staticmethod
+    def earned(referrer_id):
+        """Подзапрос: всего заработано на рефералах всех уровней"""
+        return (
+            select(func.coalesce(func.sum(Referral.earned), 0))
+            .where(Referral.referrer_id == referrer_id)
+            .scalar_subquery()
+        )
+
 async def process_referral_bonus(order: Order):
-    """Начисление реферального бонуса"""
+    """Начисление реферальных бонусов всем уровням одной транзакцией"""
     async with SessionLocal() as db:
-        # Находим пользователя
-        user = db.query(User).filter(User.user_id == order.user_id).first()
-        if not user or not user.referred_by:
+        chain = await ReferralTree.ancestors(db, order.user_id)
+        if not chain:
             return
         
-        # Получаем реферера
-        referrer = db.query(User).filter(User.user_id == user.referred_by).first()
-        if not referrer:
+        # Отметка в заказе в той же транзакции: повторная обработка заказа не начислит бонус дважды
+        claimed = await db.execute(
+            update(Order)
+            .where(Order.id == order.id, Order.referral_bonus_paid == False)
+            .values(referral_bonus_paid=True, referral_user_id=chain[0].referrer_id)
+        )
+        if claimed.rowcount != 1:
             return
         
-        # Расчет бонуса
-        bonus_percent = Config.REFERRAL_PERCENT
-        bonus_amount = (order.total_amount * bonus_percent) / 100
-        
-        # Начисление бонуса рефереру
-        referrer.balance += bonus_amount
-        referrer.total_earned += bonus_amount
-        
-        # Обновление реферальной записи
-        referral = db.query(Referral).filter(
-            Referral.referred_id == user.user_id
-        ).first()
-        
-        if referral:
-            referral.earned += bonus_amount
-        
-        # Создание транзакции
-        transaction = Transaction(
-            transaction_id=f"REF_{int(datetime.datetime.now().timestamp())}",
-            user_id=referrer.user_id,
-            amount=bonus_amount,
-            type="referral",
-            status="completed",
-            description=f"Реферальный бонус от заказа #{order.order_id}",
-            metadata={
-                "order_id": order.order_id,
-                "referred_user_id": user.user_id,
-                "percent": bonus_percent,
-                "purchase_amount": order.total_amount
-            }
-        )
+        order.referral_bonus_paid = True
+        order.referral_user_id = chain[0].referrer_id
         
-        db.add(transaction)
+        payouts = []
+        for referrer_id, level in chain:
+            percent = Config.REFERRAL_LEVEL_PERCENTS[level - 1]
+            amount = Ledger.money(Decimal(str(order.total_amount)) * percent / 100)
+            if amount > 0:
+                payouts.append({"uid": referrer_id, "lvl": level, "percent": percent, "amount": amount})
+        if not payouts:
+            await db.commit()
+            return
         
-        # Обновление заказа
-        order.referral_bonus_paid = True
-        order.referral_user_id = referrer.user_id
+        # Балансы - одной записью в леджере (строки users реферов не блокируются),
+        # заработок по каждой строке цепочки - одним executemany
+        postings = await ledger.post(
+            db, f"REF_{order.order_id}", "referral", Ledger.REFERRAL,
+            [(Ledger.account(payout["uid"]), payout["amount"]) for payout in payouts]
+        )
+        referrals = Referral.__table__
+        conn = await db.connection()
+        await conn.execute(
+            update(referrals)
+            .where(
+                referrals.c.referrer_id == bindparam("uid"),
+                referrals.c.referred_id == order.user_id,
+                referrals.c.level == bindparam("lvl")
+            )
+            .values(earned=referrals.c.earned + bindparam("amount")),
+            payouts
+        )
         
+        # transaction_id из заказа и уровня: повтор упрется в уникальный ключ, а не создаст дубль
+        await db.execute(insert(Transaction), [
+            {
+                "transaction_id": f"REF_{order.order_id}_{payout['lvl']}",
+                "user_id": payout["uid"],
+                "amount": payout["amount"],
+                "type": "referral",
+                "status": "completed",
+                "description": f"Реферальный бонус {payout['lvl']} уровня от заказа #{order.order_id}",
+                "meta": {
+                    "order_id": order.order_id,
+                    "referred_user_id": order.user_id,
+                    "level": payout["lvl"],
+                    "percent": payout["percent"],
+                    "purchase_amount": float(order.total_amount)
+                }
+            }
+            for payout in payouts
+        ])
         await db.commit()
+        await ledger.applied(postings)
         
-        # Уведомление рефереру
+        balances = {payout["uid"]: await ledger.balance(db, payout["uid"]) for payout in payouts}
+    
+    await user_cache.invalidate(*(payout["uid"] for payout in payouts))
+    
+    # Уведомления реферерам
+    for payout in payouts:
         await Utils.send_notification(
-            referrer.user_id,
+            payout["uid"],
             "💰 Получен реферальный бонус!",
-            f"За покупку вашего реферала вам начислен бонус {bonus_amount:.2f} ₽\n"
+            f"За покупку вашего реферала {payout['lvl']} уровня вам начислен бонус {payout['amount']:.2f} ₽\n"
             f"Заказ: #{order.order_id}\n"
-            f"Ваш баланс: {referrer.balance:.2f} ₽"
+            f"Ваш баланс: {balances.get(payout['uid'], 0):.2f} ₽"
+        )
+
+# ==================== ОЧЕРЕДЬ ДОСТАВКИ ====================
+class DeliveryQueue:
+    """Фоновая доставка заказов через Redis Stream с повторами и идемпотентностью по order_id"""
+    
+    STREAM_KEY = "delivery:stream"
+    GROUP = "delivery"
+    RETRY_KEY = "delivery:retry"  # ZSET: задача -> время следующей попытки
+    DEAD_KEY = "delivery:dead"
+    LOCK_KEY = "delivery:lock:{order_id}"
+    
+    def __init__(self):
+        self.consumer_prefix = f"{socket.gethostname()}-{os.getpid()}"
+        self._tasks: List[asyncio.Task] = []
+    
+    async def enqueue(self, order_id: str, attempt: int = 0):
+        """Постановка заказа в очередь доставки"""
+        await redis_client.xadd(self.STREAM_KEY, {"order_id": order_id, "attempt": attempt})
+    
+    async def start(self, workers: int = Config.DELIVERY_WORKERS):
+        """Запуск воркеров"""
+        try:
+            await redis_client.xgroup_create(self.STREAM_KEY, self.GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        
+        for i in range(workers):
+            self._tasks.append(asyncio.create_task(self._worker(f"{self.consumer_prefix}-{i}")))
+        self._tasks.append(asyncio.create_task(self._scheduler()))
+    
+    async def stop(self):
+        """Остановка воркеров (недоставленные задачи остаются в Redis)"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+    
+    async def depth(self) -> int:
+        """Количество задач в очереди и ожидающих повтора"""
+        return await redis_client.xlen(self.STREAM_KEY) + await redis_client.zcard(self.RETRY_KEY)
+    
+    async def _worker(self, consumer: str):
+        """Чтение задач из consumer group"""
+        while True:
+            try:
+                response = await redis_client.xreadgroup(
+                    self.GROUP, consumer, {self.STREAM_KEY: ">"}, count=10, block=5000
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Delivery queue read failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            
+            for _, messages in response or []:
+                for message_id, fields in messages:
+                    await self._handle(message_id, fields)
+    
+    async def _handle(self, message_id, fields: dict):
+        """Обработка одной задачи с планированием повтора при ошибке"""
+        order_id = fields[b"order_id"].decode()
+        attempt = int(fields.get(b"attempt", 0))
+        
+        try:
+            await self.process(order_id)
+        except Exception as e:
+            logger.error(f"Delivery of {order_id} failed (attempt {attempt + 1}): {e}")
+            await self._retry_or_give_up(order_id, attempt + 1, str(e))
+        
+        await redis_client.xack(self.STREAM_KEY, self.GROUP, message_id)
+        await redis_client.xdel(self.STREAM_KEY, message_id)
+    
+    async def process(self, order_id: str):
+        """Идемпотентная доставка: повторный вызов для доставленного заказа ничего не делает"""
+        lock_key = self.LOCK_KEY.format(order_id=order_id)
+        if not await redis_client.set(lock_key, self.consumer_prefix, nx=True, ex=300):
+            return  # Заказ прямо сейчас доставляет другой воркер
+        
+        try:
+            async with SessionLocal() as db:
+                order = await db.scalar(select(Order).where(Order.order_id == order_id))
+                if not order or order.status != "paid":
+                    return
+                product = await db.get(Product, order.product_id)
+            
+            if order.delivered_at is None:
+                await deliver_product(order.user_id, order, product)
+            
+            # Начисление реферального бонуса (повторно не начисляется)
+            if not order.referral_bonus_paid:
+                await process_referral_bonus(order)
+        finally:
+            await redis_client.delete(lock_key)
+    
+    async def _retry_or_give_up(self, order_id: str, attempt: int, error: str):
+        """Повтор с экспоненциальной задержкой или передача в поддержку"""
+        if attempt < Config.DELIVERY_MAX_ATTEMPTS:
+            due = time.time() + Config.DELIVERY_RETRY_DELAY * 2 ** (attempt - 1)
+            await redis_client.zadd(self.RETRY_KEY, {json.dumps({"order_id": order_id, "attempt": attempt}): due})
+            return
+        
+        await redis_client.xadd(self.DEAD_KEY, {"order_id": order_id, "error": error[:500]})
+        
+        async with SessionLocal() as db:
+            order = await db.scalar(select(Order).where(Order.order_id == order_id))
+            if not order:
+                return
+            
+            # Заказ переходит на ручную выдачу; уже выданные ключ/логин остаются для поддержки
+            await db.execute(
+                update(Order).where(Order.id == order.id).values(
+                    is_auto=False,
+                    delivery_data={**(order.delivery_data or {}), "error": error[:500], "delivery_attempts": attempt}
+                )
+            )
+            await db.commit()
+        
+        try:
+            await bot.send_message(
+                order.user_id,
+                f"📦 <b>Товар готов к выдаче!</b>\n\n"
+                f"Обратитесь в поддержку для получения товара.\n"
+                f"🆔 Номер заказа: <code>{order_id}</code>"
+            )
+        except Exception as e:
+            logger.error(f"Failed to notify user about delivery failure: {e}")
+    
+    async def _scheduler(self):
+        """Перенос повторов в поток, возврат зависших задач и потерянных заказов"""
+        last_recovery = 0.0
+        while True:
+            try:
+                due = await redis_client.zrangebyscore(self.RETRY_KEY, 0, time.time(), start=0, num=100)
+                for item in due:
+                    # ZREM - атомарный захват задачи одним процессом
+                    if await redis_client.zrem(self.RETRY_KEY, item):
+                        task = json.loads(item)
+                        await self.enqueue(task["order_id"], task["attempt"])
+                
+                if time.monotonic() - last_recovery > Config.DELIVERY_CLAIM_IDLE:
+                    last_recovery = time.monotonic()
+                    await self._recover()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Delivery scheduler failed: {e}")
+            
+            await asyncio.sleep(1)
+    
+    async def _recover(self):
+        """Восстановление после падений"""
+        # Задачи, прочитанные упавшим воркером и не подтвержденные
+        _, claimed, *_ = await redis_client.xautoclaim(
+            self.STREAM_KEY, self.GROUP, f"{self.consumer_prefix}-recovery",
+            min_idle_time=Config.DELIVERY_CLAIM_IDLE * 1000, count=100
         )
+        for message_id, fields in claimed:
+            if fields:
+                await self._handle(message_id, fields)
+        
+        # Заказы, оплаченные до падения, но не попавшие в поток
+        now = datetime.datetime.utcnow()
+        async with SessionLocal() as db:
+            order_ids = (await db.scalars(
+                select(Order.order_id).where(
+                    Order.status == "paid",
+                    Order.is_auto == True,
+                    Order.delivered_at.is_(None),
+                    Order.created_at < now - datetime.timedelta(seconds=Config.DELIVERY_RECOVERY_AGE),
+                    Order.created_at > now - datetime.timedelta(seconds=Config.DELIVERY_RECOVERY_WINDOW)
+                ).limit(100)
+            )).all()
+        
+        for order_id in order_ids:
+            await self.enqueue(order_id)
+
+delivery_queue = DeliveryQueue()
+
+# ==================== ОТПРАВКА СООБЩЕНИЙ ====================
+class TokenBucket:
+    """Token bucket для асинхронного ограничения скорости"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self, tokens: float = 1):
+        """Ожидание токенов (токены резервируются сразу, ожидающие встают в очередь)"""
+        self._refill()
+        self.tokens -= tokens
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+    
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Токены без ожидания: 0 - получены, иначе сколько ждать до них, сек"""
+        self._refill()
+        if self.tokens < tokens:
+            return (tokens - self.tokens) / self.rate
+        self.tokens -= tokens
+        return 0.0
+
+class TelegramSender:
+    """Отправка исходящих сообщений с учетом глобального и поштучного по чатам лимитов Telegram"""
+    
+    # Лимит на бота: общий счет процессов (GCRA в Redis при RATE_LIMIT_SHARED), а не доля на процесс -
+    # иначе всплеск рассылки в одном процессе упирается в 1/WORKERS лимита, пока остальная часть простаивает
+    GLOBAL_SCOPE = "telegram"
+    
+    def __init__(self):
+        # Без TTL, как RateLimiter.buckets: истекший бакет чата с очередью отправок начинался бы с полного
+        self.chat_buckets = LRUCache(maxsize=10000, ttl=None)
+        self.paused_until = 0.0
+        self.retry_after_count = 0
+    
+    async def send_message(self, chat_id: int, text: str, max_retries: int = 3, **kwargs) -> Message:
+        """Отправка с ожиданием лимитов и повтором после RetryAfter"""
+        for attempt in range(max_retries + 1):
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(Config.TELEGRAM_CHAT_RATE, capacity=1)
+                self.chat_buckets.set(chat_id, bucket)
+            
+            await bucket.acquire()
+            await self._acquire_global()
+            
+            # Пауза после флуд-контроля действует на все отправки процесса
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            
+            try:
+                return await bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                self.retry_after_count += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                if attempt == max_retries:
+                    raise
+    
+    async def _acquire_global(self):
+        """Ожидание места в глобальном лимите бота"""
+        while True:
+            delay = await rate_limiter.acquire(self.GLOBAL_SCOPE, 0, (Config.TELEGRAM_GLOBAL_RATE, 1))
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+telegram_sender = TelegramSender()
+
+# ==================== УВЕДОМЛЕНИЯ ====================
+class NotificationService:
+    """Буфер уведомлений: пакетная запись в БД и одно сообщение на пользователя за окно"""
+    
+    def __init__(self):
+        self._buffer: Dict[int, List[dict]] = {}
+        self._task: Optional[asyncio.Task] = None
+    
+    def push(self, user_id: int, title: str, message: str, notification_type: str = "system"):
+        """Добавление уведомления в буфер"""
+        self._buffer.setdefault(user_id, []).append({
+            "user_id": user_id,
+            "type": notification_type,
+            "title": title,
+            "message": message,
+            "created_at": datetime.datetime.utcnow()
+        })
+        
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+    
+    async def _flush_later(self):
+        """Сброс буфера по окончании окна объединения"""
+        await asyncio.sleep(Config.NOTIFICATION_FLUSH_INTERVAL)
+        await self.flush()
+    
+    async def flush(self):
+        """Запись всех уведомлений одним INSERT и отправка объединенных сообщений"""
+        buffer, self._buffer = self._buffer, {}
+        if not buffer:
+            return
+        
+        rows = [item for items in buffer.values() for item in items]
+        
+        try:
+            async with SessionLocal() as db:
+                await db.execute(insert(Notification), rows)
+                settings = dict((await db.execute(
+                    select(User.user_id, User.settings).where(User.user_id.in_(list(buffer)))
+                )).all())
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Failed to save notifications: {e}")
+            settings = {}
+        
+        await asyncio.gather(*(
+            self._send(user_id, items)
+            for user_id, items in buffer.items()
+            if (settings.get(user_id) or {}).get("notifications", True)
+        ))
+    
+    async def _send(self, user_id: int, items: List[dict]):
+        """Одно сообщение со всеми уведомлениями пользователя за окно"""
+        if len(items) == 1:
+            text = f"🔔 <b>{items[0]['title']}</b>\n\n{items[0]['message']}"
+        else:
+            text = f"🔔 <b>Уведомления ({len(items)})</b>\n\n"
+            text += "\n\n".join(f"<b>{item['title']}</b>\n{item['message']}" for item in items)
+        
+        try:
+            await telegram_sender.send_message(user_id, text, disable_notification=False)
+        except Exception as e:
+            logger.error(f"Failed to send notification: {e}")
+    
+    async def stop(self):
+        """Сброс буфера при остановке"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+        await self.flush()
+
+notifications = NotificationService()
+
+# ==================== РАССЫЛКА ====================
+class Broadcaster:
+    """Рассылка по всем пользователям: батчи по keyset, ограничение скорости, продолжение после рестарта"""
+    
+    JOB_KEY = "broadcast:{job_id}"
+    ACTIVE_KEY = "broadcast:active"
+    LOCK_KEY = "broadcast:lock:{job_id}"
+    
+    def __init__(self):
+        self.bucket = TokenBucket(Config.BROADCAST_RATE)
+        self._tasks: Dict[str, asyncio.Task] = {}
+    
+    async def create(self, admin_id: int, text: str, status_message_id: int) -> str:
+        """Создание задания рассылки"""
+        job_id = uuid.uuid4().hex[:8]
+        
+        async with SessionLocal() as db:
+            total = await db.scalar(
+                select(func.count()).select_from(User).where(
+                    User.is_banned == False, User.bot_blocked == False
+                )
+            )
+        
+        await redis_client.hset(self.JOB_KEY.format(job_id=job_id), mapping={
+            "admin_id": admin_id,
+            "text": text,
+            "status": "running",
+            "cursor": 0,
+            "total": total,
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "started_at": time.time(),
+            "status_message_id": status_message_id,
+        })
+        await redis_client.sadd(self.ACTIVE_KEY, job_id)
+        self.start(job_id)
+        return job_id
+    
+    def start(self, job_id: str):
+        """Запуск задания в фоне"""
+        if job_id not in self._tasks or self._tasks[job_id].done():
+            self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+    
+    async def resume_all(self):
+        """Продолжение прерванных рестартом рассылок"""
+        for job_id in await redis_client.smembers(self.ACTIVE_KEY):
+            self.start(job_id.decode())
+    
+    async def cancel(self, job_id: str):
+        """Отмена рассылки"""
+        await redis_client.hset(self.JOB_KEY.format(job_id=job_id), "status", "cancelled")
+    
+    async def stop(self):
+        """Остановка заданий процесса (состояние остается в Redis)"""
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+    
+    async def _job(self, job_id: str) -> dict:
+        raw = await redis_client.hgetall(self.JOB_KEY.format(job_id=job_id))
+        return {key.decode(): value.decode() for key, value in raw.items()}
+    
+    async def _send_one(self, user_id: int, text: str) -> str:
+        """Отправка одному получателю: sent / blocked / failed"""
+        await self.bucket.acquire()
+        try:
+            await telegram_sender.send_message(user_id, text)
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            return "blocked" if "chat not found" in str(e).lower() else "failed"
+        except Exception as e:
+            logger.warning(f"Broadcast to {user_id} failed: {e}")
+            return "failed"
+    
+    async def _run(self, job_id: str):
+        """Цикл рассылки; курсор сохраняется после каждого батча"""
+        job_key = self.JOB_KEY.format(job_id=job_id)
+        lock_key = self.LOCK_KEY.format(job_id=job_id)
+        
+        # Задание выполняет только один процесс
+        if not await redis_client.set(lock_key, os.getpid(), nx=True, ex=120):
+            return
+        
+        try:
+            job = await self._job(job_id)
+            if not job:
+                await redis_client.srem(self.ACTIVE_KEY, job_id)
+                return
+            last_progress = 0.0
+            
+            while job.get("status") == "running":
+                async with SessionLocal() as db:
+                    recipients = (await db.execute(
+                        select(User.id, User.user_id)
+                        .where(
+                            User.id > int(job["cursor"]),
+                            User.is_banned == False,
+                            User.bot_blocked == False
+                        )
+                        .order_by(User.id)
+                        .limit(Config.BROADCAST_BATCH_SIZE)
+                    )).all()
+                
+                if not recipients:
+                    await redis_client.hset(job_key, "status", "done")
+                    break
+                
+                results = await asyncio.gather(
+                    *(self._send_one(user_id, job["text"]) for _, user_id in recipients)
+                )
+                
+                blocked = [user_id for (_, user_id), result in zip(recipients, results) if result == "blocked"]
+                if blocked:
+                    async with SessionLocal() as db:
+                        await db.execute(
+                            update(User).where(User.user_id.in_(blocked)).values(bot_blocked=True)
+                        )
+                        await db.commit()
+                
+                pipe = redis_client.pipeline()
+                pipe.hset(job_key, "cursor", recipients[-1][0])
+                pipe.hincrby(job_key, "sent", results.count("sent"))
+                pipe.hincrby(job_key, "blocked", len(blocked))
+                pipe.hincrby(job_key, "failed", results.count("failed"))
+                pipe.expire(lock_key, 120)
+                await pipe.execute()
+                
+                job = await self._job(job_id)
+                if time.monotonic() - last_progress > Config.BROADCAST_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await self._report(job_id, job)
+            
+            job = await self._job(job_id)
+            await redis_client.srem(self.ACTIVE_KEY, job_id)
+            await self._report(job_id, job)
+        finally:
+            await redis_client.delete(lock_key)
+    
+    async def _report(self, job_id: str, job: dict):
+        """Прогресс рассылки в сообщении у админа"""
+        processed = int(job["sent"]) + int(job["blocked"]) + int(job["failed"])
+        elapsed = max(time.time() - float(job["started_at"]), 1)
+        titles = {"running": "⏳ Идет", "done": "✅ Завершена", "cancelled": "⛔ Отменена"}
+        
+        text = f"📢 <b>Рассылка #{job_id}</b>\n\n"
+        text += f"Статус: {titles.get(job['status'], job['status'])}\n"
+        text += f"• Обработано: {processed} из ~{job['total']}\n"
+        text += f"• Доставлено: {job['sent']}\n"
+        text += f"• Заблокировали бота: {job['blocked']}\n"
+        text += f"• Ошибок: {job['failed']}\n"
+        text += f"• Скорость: {processed / elapsed:.1f} сообщ./сек"
+        
+        reply_markup = None
+        if job["status"] == "running":
+            reply_markup = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⛔ Остановить", callback_data=f"broadcast_cancel_{job_id}")]
+            ])
+        
+        try:
+            await bot.edit_message_text(
+                text,
+                chat_id=int(job["admin_id"]),
+                message_id=int(job["status_message_id"]),
+                reply_markup=reply_markup
+            )
+        except TelegramBadRequest:
+            pass  # Текст не изменился или сообщение удалено
+
+broadcaster = Broadcaster()
+
+# ==================== ПРИЕМ АПДЕЙТОВ ====================
+class UpdateProcessor:
+    """Обработка апдейтов задачами: не больше Config.HANDLER_CONCURRENCY одновременно, дожидание при остановке"""
+    
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(Config.HANDLER_CONCURRENCY)
+        self.tasks: set = set()
+        self.offset: Optional[int] = None
+    
+    async def submit(self, update: Update):
+        """Запуск обработки; ждет свободного места, этим притормаживая прием новых апдейтов"""
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def _process(self, update: Update):
+        """Обработка с повтором: Telegram апдейт уже не переотправит, а дедупликация пропустит повтор упавшего"""
+        Metrics.UPDATES_IN_FLIGHT.inc()
+        try:
+            for attempt in range(Config.UPDATE_RETRIES + 1):
+                try:
+                    await dp.feed_update(bot, update)
+                    return
+                except (TelegramBadRequest, TelegramForbiddenError) as e:
+                    # Повтор дал бы тот же ответ
+                    logger.warning(f"Update {update.update_id} failed: {e}")
+                    return
+                except Exception as e:
+                    if attempt == Config.UPDATE_RETRIES:
+                        logger.exception(f"Update {update.update_id} failed: {e}")
+                        return
+                    logger.warning(f"Update {update.update_id} failed: {e}, retrying")
+                    await asyncio.sleep(Config.UPDATE_RETRY_DELAY * 2 ** attempt)
+        finally:
+            Metrics.UPDATES_IN_FLIGHT.dec()
+            self.semaphore.release()
+    
+    async def drain(self, timeout: float = Config.SHUTDOWN_TIMEOUT):
+        """Дожидание начатых апдейтов, не успевшие за timeout отменяются"""
+        if not self.tasks:
+            return
+        
+        logger.info(f"Waiting for {len(self.tasks)} updates to finish")
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        if pending:
+            logger.warning(f"Cancelling {len(pending)} updates after {timeout}s")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+    
+    async def webhook_handler(self, request: web.Request) -> web.Response:
+        """Апдейт от Telegram; ответ сразу после постановки в обработку"""
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(secret, Config.WEBHOOK_SECRET):
+            return web.Response(status=401, text="Unauthorized")
+        
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+        await self.submit(update)
+        return web.json_response({})
+    
+    async def run_polling(self):
+        """Long polling для запуска без webhook; накопленные апдейты не сбрасываются"""
+        await bot.delete_webhook(drop_pending_updates=Config.DROP_PENDING_UPDATES)
+        allowed_updates = dp.resolve_used_update_types()
+        delay = 1
+        
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=self.offset,
+                    limit=Config.POLLING_LIMIT,
+                    timeout=Config.POLLING_TIMEOUT,
+                    allowed_updates=allowed_updates,
+                    request_timeout=int(bot.session.timeout + Config.POLLING_TIMEOUT)
+                )
+            except Exception as e:
+                logger.warning(f"getUpdates failed: {e}, retry in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            
+            delay = 1
+            for update in updates:
+                await self.submit(update)
+                self.offset = update.update_id + 1
+    
+    async def confirm_offset(self):
+        """Подтверждение полученных апдейтов, чтобы после перезапуска они не пришли повторно"""
+        if self.offset is None:
+            return
+        try:
+            await bot.get_updates(offset=self.offset, limit=1, timeout=0)
+        except Exception as e:
+            logger.warning(f"Failed to confirm polling offset: {e}")
+
+update_processor = UpdateProcessor()
+
+background_tasks: List[asyncio.Task] = []  # Фоновые задачи процесса
 
-# ==================== WEBHOOK ====================
 async def on_startup(dispatcher: Dispatcher):
     """Действия при запуске"""
     logger.info("Bot starting...")
     
-    # Установка webhook
-    webhook_url = Config.WEBHOOK_URL + Config.WEBHOOK_PATH
-    await bot.set_webhook(
-        url=webhook_url,
-        drop_pending_updates=True,
-        secret_token="YOUR_SECRET_TOKEN"
-    )
+    # Фоновые задачи каждого процесса
+    background_tasks.append(asyncio.create_task(cache_bus.run_listener_loop()))
+    background_tasks.append(asyncio.create_task(user_cache.run_flush_loop()))
+    background_tasks.append(asyncio.create_task(search_index.run_rebuild_loop()))
+    background_tasks.append(asyncio.create_task(Metrics.run_queue_loop()))
+    await delivery_queue.start()
+    
+    # Общие задачи и webhook - только в первом процессе
+    if Config.WORKER_ID != 0:
+        return
+    
+    background_tasks.append(asyncio.create_task(stats.run_rollup_loop()))
+    background_tasks.append(asyncio.create_task(ledger.run_snapshot_loop()))
+    await broadcaster.resume_all()
     
-    logger.info(f"Webhook set to {webhook_url}")
+    # Установка webhook (в режиме polling webhook снимается при запуске опроса)
+    if Config.RUN_MODE == "webhook":
+        webhook_url = Config.WEBHOOK_URL + Config.WEBHOOK_PATH
+        await bot.set_webhook(
+            url=webhook_url,
+            drop_pending_updates=Config.DROP_PENDING_UPDATES,
+            secret_token=Config.WEBHOOK_SECRET,
+            max_connections=Config.WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        
+        logger.info(f"Webhook set to {webhook_url}")
 
 async def on_shutdown(dispatcher: Dispatcher):
     """Действия при выключении"""
     logger.info("Bot shutting down...")
+    await delivery_queue.stop()
+    await broadcaster.stop()
+    await notifications.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await user_cache.flush_activity()
+    
     await bot.session.close()
     await dispatcher.storage.close()
+    await engine.dispose()
 
 # ==================== ЗАПУСК БОТА ====================
 async def main():
     """Основная функция запуска"""
     
-    # Запуск через webhook (для VPS)
+    # HTTP-сервер нужен в обоих режимах: в polling на нем остаются метрики
     app = web.Application()
-    
-    # Настройка webhook
-    webhook_requests_handler = SimpleRequestHandler(
-        dispatcher=dp,
-        bot=bot,
-        secret_token="YOUR_SECRET_TOKEN"
-    )
-    
-    webhook_requests_handler.register(app, path=Config.WEBHOOK_PATH)
-    setup_application(app, dp, bot=bot)
+    if Config.RUN_MODE == "webhook":
+        app.router.add_post(Config.WEBHOOK_PATH, update_processor.webhook_handler)
+    app.router.add_get(Config.METRICS_PATH, metrics_handler)
     
     # Запуск
     await on_startup(dp)
     
+    runner = web.AppRunner(app, shutdown_timeout=Config.SHUTDOWN_TIMEOUT)
+    polling = None
     try:
-        # Для локального тестирования можно использовать polling
-        # await dp.start_polling(bot)
-        
-        # Для продакшена - webhook
-        runner = web.AppRunner(app)
         await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', 8080)
+        # reuse_port: ядро распределяет соединения между процессами на одном порту
+        site = web.TCPSite(runner, Config.WEB_HOST, Config.WEB_PORT, reuse_port=Config.WORKERS > 1)
         await site.start()
         
-        logger.info("Bot started successfully!")
+        if Config.RUN_MODE == "polling":
+            polling = asyncio.create_task(update_processor.run_polling())
+        
+        logger.info(f"Bot started successfully! ({Config.RUN_MODE}, worker {Config.WORKER_ID})")
         
-        # Бесконечный цикл
-        await asyncio.Event().wait()
+        # Работа до SIGTERM/SIGINT
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop_event.set)
+        await stop_event.wait()
         
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped")
     finally:
+        # Сначала прекращаем прием апдейтов, затем дожидаемся начатых
+        if polling:
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+        await runner.cleanup()
+        await update_processor.drain()
+        await update_processor.confirm_offset()
         await on_shutdown(dp)
 
-if __name__ == "__main__":
-
+def run_worker(worker_id: int):
+    """Точка входа процесса-воркера"""
+    Config.WORKER_ID = worker_id
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
     asyncio.run(main())
+
+def serve_workers():
+    """Супервизор: Config.WORKERS процессов на одном порту, упавшие перезапускаются"""
+    context = multiprocessing.get_context("fork")
+    processes: Dict[int, multiprocessing.Process] = {}
+    stopping = False
+    
+    def spawn(worker_id: int):
+        process = context.Process(target=run_worker, args=(worker_id,), name=f"worker-{worker_id}")
+        process.start()
+        processes[worker_id] = process
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    for worker_id in range(Config.WORKERS):
+        spawn(worker_id)
+    logger.info(f"Started {Config.WORKERS} workers on port {Config.WEB_PORT}")
+    
+    while not stopping:
+        time.sleep(Config.WORKER_RESTART_DELAY)
+        for worker_id, process in list(processes.items()):
+            if process.is_alive() or stopping:
+                continue
+            logger.error(f"Worker {worker_id} exited with code {process.exitcode}, restarting")
+            if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+                multiprocess.mark_process_dead(process.pid)
+            spawn(worker_id)
+    
+    for process in processes.values():
+        process.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Telegram shop bot")
+    parser.add_argument("--mode", choices=("webhook", "polling"), default=Config.RUN_MODE,
+                        help="Прием апдейтов (по умолчанию RUN_MODE)")
+    args = parser.parse_args()
+    Config.RUN_MODE = args.mode
+    if Config.RUN_MODE == "polling" and Config.WORKERS > 1:
+        parser.error("polling runs in a single process, unset WORKERS")
+    
+    if Config.WORKERS > 1:
+        serve_workers()
+    else:
+        asyncio.run(main())
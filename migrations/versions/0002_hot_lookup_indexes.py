@@ -0,0 +1,47 @@
+"""Индексы под запросы хэндлеров
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 02:43:09.245796
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (имя индекса, таблица, колонки)
+INDEXES = [
+    ('ix_users_last_activity', 'users', ['last_activity']),
+    ('ix_users_registration_date', 'users', ['registration_date']),
+    ('ix_users_referred_by', 'users', ['referred_by']),
+    ('ix_products_category_active_created', 'products', ['category', 'is_active', 'created_at']),
+    ('ix_orders_user_status_created', 'orders', ['user_id', 'status', 'created_at']),
+    ('ix_orders_created_at', 'orders', ['created_at']),
+    ('ix_orders_status_reserved_until', 'orders', ['status', 'reserved_until']),
+    ('ix_orders_status_created', 'orders', ['status', 'created_at']),
+    ('ix_transactions_user_created', 'transactions', ['user_id', 'created_at']),
+    ('ix_referrals_referrer_id', 'referrals', ['referrer_id']),
+    ('ix_support_tickets_user_status', 'support_tickets', ['user_id', 'status']),
+    ('ix_notifications_user_created', 'notifications', ['user_id', 'created_at']),
+]
+
+
+def upgrade() -> None:
+    # CONCURRENTLY не блокирует запись в большие таблицы, но не работает внутри транзакции
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,43 @@
+"""Индексы для постраничного вывода категорий по каждому режиму сортировки
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 03:05:12.417305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (имя индекса, колонки); id в конце - ключ курсора при равных значениях сортировки
+INDEXES = [
+    ('ix_products_category_new', ['category', 'is_active', 'created_at', 'id']),
+    ('ix_products_category_popular', ['category', 'is_active', 'sales_count', 'id']),
+    ('ix_products_category_price', ['category', 'is_active', 'price', 'id']),
+    ('ix_products_category_rating', ['category', 'is_active', 'rating', 'id']),
+]
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES:
+            op.create_index(name, 'products', columns, postgresql_concurrently=True, if_not_exists=True)
+        # ix_products_category_new покрывает старый индекс целиком
+        op.drop_index('ix_products_category_active_created', table_name='products',
+                      postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_products_category_active_created', 'products', ['category', 'is_active', 'created_at'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        for name, _ in reversed(INDEXES):
+            op.drop_index(name, table_name='products', postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,71 @@
+"""Реферальные цепочки: строка на каждого предка до 3 уровня
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 03:31:47.902114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+LEVELS = 3
+
+# Имя, которое PostgreSQL дал безымянному UNIQUE (referred_id) из 0001
+POSTGRES_UNIQUE = 'referrals_referred_id_key'
+SQLITE_CONVENTION = {'uq': 'uq_%(table_name)s_%(column_0_name)s'}
+
+# Предки уровня N+1 - предки уровня N их пригласившего
+BACKFILL = sa.text("""
+    INSERT INTO referrals (referrer_id, referred_id, level, earned, status, registered_at)
+    SELECT parent.referrer_id, child.referred_id, child.level + 1, 0, 'active', child.registered_at
+    FROM referrals child
+    JOIN referrals parent ON parent.referred_id = child.referrer_id AND parent.level = 1
+    WHERE child.level = :level
+""")
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == 'sqlite':
+        with op.batch_alter_table('referrals', naming_convention=SQLITE_CONVENTION) as batch_op:
+            batch_op.drop_constraint('uq_referrals_referred_id', type_='unique')
+    else:
+        op.drop_constraint(POSTGRES_UNIQUE, 'referrals', type_='unique')
+
+    for level in range(1, LEVELS):
+        op.execute(BACKFILL.bindparams(level=level))
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_referrals_referred_level', 'referrals', ['referred_id', 'level'], unique=True,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_referrals_referrer_level', 'referrals', ['referrer_id', 'level'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        # ix_referrals_referrer_level покрывает старый индекс целиком
+        op.drop_index('ix_referrals_referrer_id', table_name='referrals',
+                      postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_referrals_referrer_id', 'referrals', ['referrer_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_referrals_referrer_level', table_name='referrals',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_referrals_referred_level', table_name='referrals',
+                      postgresql_concurrently=True, if_exists=True)
+
+    op.execute("DELETE FROM referrals WHERE level > 1")
+
+    if op.get_bind().dialect.name == 'sqlite':
+        with op.batch_alter_table('referrals', naming_convention=SQLITE_CONVENTION) as batch_op:
+            batch_op.create_unique_constraint('uq_referrals_referred_id', ['referred_id'])
+    else:
+        op.create_unique_constraint(POSTGRES_UNIQUE, 'referrals', ['referred_id'])
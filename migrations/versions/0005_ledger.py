@@ -0,0 +1,105 @@
+"""Леджер: проводки и снимки балансов, денежные колонки в Numeric
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 05:12:09.417730
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MONEY = sa.Numeric(14, 2)
+
+# (таблица, колонка, nullable)
+MONEY_COLUMNS = (
+    ('users', 'total_spent', True),
+    ('orders', 'total_amount', False),
+    ('transactions', 'amount', False),
+    ('referrals', 'earned', True),
+)
+
+# Текущие балансы переносятся в леджер записью OPENING_<user_id>: приход на счет
+# пользователя и уравновешивающий расход с system:opening
+OPENING = sa.text("""
+    INSERT INTO ledger_postings (entry_id, account, amount, kind, created_at)
+    SELECT 'OPENING_' || user_id, 'user:' || user_id, ROUND(CAST(balance AS NUMERIC), 2), 'opening', CURRENT_TIMESTAMP
+    FROM users WHERE balance <> 0
+    UNION ALL
+    SELECT 'OPENING_' || user_id, 'system:opening', -ROUND(CAST(balance AS NUMERIC), 2), 'opening', CURRENT_TIMESTAMP
+    FROM users WHERE balance <> 0
+""")
+
+
+def alter_money(table: str, column: str, nullable: bool, type_: sa.types.TypeEngine, using: str):
+    if op.get_bind().dialect.name == 'sqlite':
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, type_=type_, existing_nullable=nullable)
+    else:
+        op.alter_column(table, column, type_=type_, existing_nullable=nullable,
+                        postgresql_using=using.format(column=column))
+
+
+def upgrade() -> None:
+    op.create_table(
+        'ledger_postings',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('entry_id', sa.String(length=64), nullable=False),
+        sa.Column('account', sa.String(length=64), nullable=False),
+        sa.Column('amount', MONEY, nullable=False),
+        sa.Column('kind', sa.String(length=30), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_ledger_postings_entry_account', 'ledger_postings', ['entry_id', 'account'], unique=True)
+    op.create_index('ix_ledger_postings_account_id', 'ledger_postings', ['account', 'id'])
+    op.create_table(
+        'balance_snapshots',
+        sa.Column('account', sa.String(length=64), nullable=False),
+        sa.Column('balance', MONEY, nullable=False),
+        sa.Column('last_posting_id', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('account'),
+    )
+
+    op.execute(OPENING)
+
+    for table, column, nullable in MONEY_COLUMNS:
+        alter_money(table, column, nullable, MONEY, 'round({column}::numeric, 2)')
+
+    # Баланс теперь - свертка проводок, заработок - сумма referrals.earned
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('balance')
+        batch_op.drop_column('total_earned')
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('balance', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('total_earned', sa.Float(), nullable=True))
+
+    op.execute("""
+        UPDATE users SET
+            balance = COALESCE((
+                SELECT SUM(amount) FROM ledger_postings WHERE account = 'user:' || users.user_id
+            ), 0),
+            total_earned = COALESCE((
+                SELECT SUM(earned) FROM referrals WHERE referrer_id = users.user_id
+            ), 0)
+    """)
+
+    for table, column, nullable in MONEY_COLUMNS:
+        alter_money(table, column, nullable, sa.Float(), '{column}::double precision')
+
+    op.drop_table('balance_snapshots')
+    op.drop_index('ix_ledger_postings_account_id', table_name='ledger_postings')
+    op.drop_index('ix_ledger_postings_entry_account', table_name='ledger_postings')
+    op.drop_table('ledger_postings')
@@ -0,0 +1,119 @@
+"""Сообщения тикетов отдельными строками вместо JSON-массива support_tickets.messages
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 08:46:21.530914
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Элементы массива messages ({"from", "text", "time"}) в порядке массива; не-массивы пропускаются
+BACKFILL = {
+    'postgresql': sa.text("""
+        INSERT INTO ticket_messages (ticket_id, author, sender_id, text, created_at)
+        SELECT t.id,
+               COALESCE(m.value->>'from', 'user'),
+               CASE WHEN m.value->>'from' = 'admin' THEN COALESCE(t.admin_id, 0) ELSE t.user_id END,
+               COALESCE(m.value->>'text', ''),
+               COALESCE(CAST(m.value->>'time' AS TIMESTAMP), t.created_at)
+        FROM support_tickets t
+        CROSS JOIN LATERAL json_array_elements(
+            CASE WHEN json_typeof(t.messages::json) = 'array' THEN t.messages::json ELSE '[]'::json END
+        ) WITH ORDINALITY AS m(value, n)
+        ORDER BY t.id, m.n
+    """),
+    'sqlite': sa.text("""
+        INSERT INTO ticket_messages (ticket_id, author, sender_id, text, created_at)
+        SELECT t.id,
+               COALESCE(json_extract(m.value, '$.from'), 'user'),
+               CASE WHEN json_extract(m.value, '$.from') = 'admin' THEN COALESCE(t.admin_id, 0) ELSE t.user_id END,
+               COALESCE(json_extract(m.value, '$.text'), ''),
+               COALESCE(REPLACE(json_extract(m.value, '$.time'), 'T', ' '), t.created_at)
+        FROM support_tickets t,
+             json_each(CASE WHEN json_type(t.messages) = 'array' THEN t.messages ELSE '[]' END) m
+        ORDER BY t.id, m.key
+    """),
+}
+
+COUNT = sa.text("""
+    UPDATE support_tickets SET messages_count = (
+        SELECT COUNT(*) FROM ticket_messages WHERE ticket_messages.ticket_id = support_tickets.id
+    )
+""")
+
+# Обратно: массив в порядке (created_at, id)
+REBUILD = {
+    'postgresql': sa.text("""
+        UPDATE support_tickets SET messages = (
+            SELECT COALESCE(json_agg(json_build_object(
+                'from', m.author, 'text', m.text, 'time', REPLACE(CAST(m.created_at AS TEXT), ' ', 'T')
+            ) ORDER BY m.created_at, m.id), '[]'::json)
+            FROM ticket_messages m WHERE m.ticket_id = support_tickets.id
+        )
+    """),
+    'sqlite': sa.text("""
+        UPDATE support_tickets SET messages = (
+            SELECT json_group_array(json_object(
+                'from', m.author, 'text', m.text, 'time', REPLACE(m.created_at, ' ', 'T')
+            ))
+            FROM (
+                SELECT * FROM ticket_messages
+                WHERE ticket_id = support_tickets.id
+                ORDER BY created_at, id
+            ) m
+        )
+    """),
+}
+
+
+def upgrade() -> None:
+    op.create_table(
+        'ticket_messages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('ticket_id', sa.Integer(), nullable=False),
+        sa.Column('author', sa.String(length=10), nullable=False),
+        sa.Column('sender_id', sa.BigInteger(), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.add_column('support_tickets', sa.Column('messages_count', sa.Integer(), nullable=True))
+
+    op.execute(BACKFILL[op.get_bind().dialect.name])
+    op.create_index('ix_ticket_messages_ticket_created', 'ticket_messages', ['ticket_id', 'created_at', 'id'])
+    op.execute(COUNT)
+
+    with op.batch_alter_table('support_tickets') as batch_op:
+        batch_op.drop_column('messages')
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_support_tickets_status_admin_updated', 'support_tickets',
+                        ['status', 'admin_id', 'updated_at'],
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_support_tickets_status_admin_updated', table_name='support_tickets',
+                      postgresql_concurrently=True, if_exists=True)
+
+    with op.batch_alter_table('support_tickets') as batch_op:
+        batch_op.add_column(sa.Column('messages', sa.JSON(), nullable=True))
+
+    op.execute(REBUILD[op.get_bind().dialect.name])
+
+    with op.batch_alter_table('support_tickets') as batch_op:
+        batch_op.drop_column('messages_count')
+
+    op.drop_index('ix_ticket_messages_ticket_created', table_name='ticket_messages')
+    op.drop_table('ticket_messages')
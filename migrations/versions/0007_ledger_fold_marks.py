@@ -0,0 +1,65 @@
+"""Отметка свертки на проводках леджера вместо границы по id
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 11:20:37.164508
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Условие частичных индексов в том виде, в котором его пишут запросы (folded == False)
+UNFOLDED = {'postgresql_where': sa.text('folded = false'), 'sqlite_where': sa.text('folded = 0')}
+
+# Снимок пересчитывается по всем проводкам до его границы: проводки, закоммиченные после свертки
+# с меньшим id, прежде выпадали из баланса
+RECOUNT = sa.text("""
+    UPDATE balance_snapshots SET balance = COALESCE((
+        SELECT SUM(amount) FROM ledger_postings
+        WHERE ledger_postings.account = balance_snapshots.account
+          AND ledger_postings.id <= balance_snapshots.last_posting_id
+    ), 0)
+""")
+MARK = sa.text("""
+    UPDATE ledger_postings SET folded = :folded
+    WHERE id <= COALESCE((
+        SELECT last_posting_id FROM balance_snapshots WHERE balance_snapshots.account = ledger_postings.account
+    ), 0)
+""")
+
+
+def upgrade() -> None:
+    op.add_column('ledger_postings', sa.Column('folded', sa.Boolean(), nullable=False, server_default=sa.false()))
+    op.execute(RECOUNT)
+    op.execute(MARK.bindparams(folded=True))
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_ledger_postings_unfolded_account', 'ledger_postings', ['account'],
+                        **UNFOLDED,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_ledger_postings_unfolded_id', 'ledger_postings', ['id'],
+                        **UNFOLDED,
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_ledger_postings_unfolded_id', table_name='ledger_postings',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_ledger_postings_unfolded_account', table_name='ledger_postings',
+                      postgresql_concurrently=True, if_exists=True)
+
+    # Граница по id не знает о несвернутых проводках ниже нее: снимки начинаются заново
+    op.execute("UPDATE balance_snapshots SET balance = 0, last_posting_id = 0")
+
+    with op.batch_alter_table('ledger_postings') as batch_op:
+        batch_op.drop_column('folded')
@@ -0,0 +1,36 @@
+"""Удаление резерва товара под неоплаченные заказы (orders.reserved_until)
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 13:42:09.518230
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0008'
+down_revision: Union[str, None] = '0007'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_orders_status_reserved_until', table_name='orders',
+                      postgresql_concurrently=True, if_exists=True)
+
+    with op.batch_alter_table('orders') as batch_op:
+        batch_op.drop_column('reserved_until')
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('orders') as batch_op:
+        batch_op.add_column(sa.Column('reserved_until', sa.DateTime(), nullable=True))
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_orders_status_reserved_until', 'orders', ['status', 'reserved_until'],
+                        postgresql_concurrently=True, if_not_exists=True)
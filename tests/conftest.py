@@ -0,0 +1,78 @@
+"""
+Общие фикстуры тестов: main поверх fakeredis и временной SQLite.
+
+Запуск из корня репозитория:
+    pip install -r requirements-test.txt
+    python -m pytest
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="shop_bot_tests_"), "test.db")
+os.environ["BOT_TOKEN"] = "123456:TEST-TOKEN"
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+
+# Клиент Redis создается при импорте main, поэтому подменяем фабрику до импорта
+import fakeredis.aioredis
+import redis.asyncio
+
+FAKE_REDIS = fakeredis.aioredis.FakeRedis()
+redis.asyncio.from_url = lambda *args, **kwargs: FAKE_REDIS
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+# Один цикл на весь прогон: пул соединений SQLAlchemy и клиент Redis привязаны к циклу
+LOOP = asyncio.new_event_loop()
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """async def тесты выполняются в общем цикле"""
+    if not asyncio.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    kwargs = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    LOOP.run_until_complete(pyfuncitem.obj(**kwargs))
+    return True
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    async def create():
+        async with main.engine.begin() as conn:
+            await conn.run_sync(main.Base.metadata.create_all)
+
+    LOOP.run_until_complete(create())
+    yield
+    LOOP.run_until_complete(main.engine.dispose())
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    """Пустые таблицы, Redis и локальные кэши перед каждым тестом"""
+    async def clean():
+        async with main.engine.begin() as conn:
+            for table in reversed(main.Base.metadata.sorted_tables):
+                await conn.execute(table.delete())
+        await FAKE_REDIS.flushall()
+
+    LOOP.run_until_complete(clean())
+    main.user_cache.local.clear()
+    main.catalog_cache.local.clear()
+    yield
+
+
+@pytest.fixture
+def run():
+    """Выполнение корутины из синхронной фикстуры"""
+    return LOOP.run_until_complete
+
+
+@pytest.fixture
+def redis_client():
+    return FAKE_REDIS
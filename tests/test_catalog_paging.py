@@ -0,0 +1,83 @@
+import asyncio
+import datetime
+
+import pytest
+
+from main import CatalogCache, Categories, Config, Product, SessionLocal, catalog_cache
+
+
+@pytest.fixture
+def products(run):
+    """25 активных товаров категории с повторяющимися значениями сортировки и шум вокруг"""
+    start = datetime.datetime(2024, 1, 1)
+    rows = [
+        Product(
+            id=i, name=f"Game {i}", price=float(100 + (i * 7) % 5), category="Games", is_active=True,
+            sales_count=(i * 3) % 4, rating=float(i % 3), created_at=start + datetime.timedelta(hours=i // 2)
+        )
+        for i in range(1, 26)
+    ]
+    rows += [
+        Product(id=26, name="Hidden", price=1.0, category="Games", is_active=False),
+        Product(id=27, name="Other", price=1.0, category="Soft", is_active=True),
+    ]
+    async def create():
+        async with SessionLocal() as db:
+            db.add_all(rows)
+            await db.commit()
+
+    run(create())
+    return rows[:25]
+
+
+def expected_order(products, sort: str) -> list:
+    column, descending, _ = Categories.SORTS[sort]
+    key = lambda product: (getattr(product, column.key), product.id)
+    return [product.id for product in sorted(products, key=key, reverse=descending)]
+
+
+async def load_page(direction: str, cursor: int, sort: str) -> dict:
+    async with SessionLocal() as db:
+        return await Categories.load_page(db, "Games", sort, direction, cursor)
+
+
+@pytest.mark.parametrize("sort", list(Categories.SORTS))
+async def test_pages_walk_forward_and_back(sort, products):
+    pages = [await load_page("f", 0, sort)]
+    assert not pages[0]["has_prev"]
+    while pages[-1]["has_next"]:
+        pages.append(await load_page("n", pages[-1]["items"][-1]["id"], sort))
+        assert pages[-1]["has_prev"]
+
+    ids = [item["id"] for page in pages for item in page["items"]]
+    assert ids == expected_order(products, sort)
+    assert [len(page["items"]) for page in pages] == [Config.CATEGORY_PAGE_SIZE] * 2 + [5]
+
+    # Назад от последней страницы - те же страницы в обратном порядке
+    page = pages[-1]
+    for previous in reversed(pages[:-1]):
+        page = await load_page("p", page["items"][0]["id"], sort)
+        assert page["items"] == previous["items"]
+        assert page["has_next"]
+    assert not page["has_prev"]
+
+
+async def test_cursor_roundtrip():
+    for product_id in (0, 1, 35, 36, 123456789):
+        assert Categories.decode_cursor(Categories.encode_cursor(product_id)) == product_id
+    assert Categories.encode_cursor(36) == "10"
+
+
+async def test_next_page_is_prefetched(products):
+    async with SessionLocal() as db:
+        page = await catalog_cache.category_page(db, "Games", "c")
+    assert catalog_cache._tasks
+
+    await asyncio.gather(*catalog_cache._tasks)
+    assert not catalog_cache._tasks
+
+    cursor = page["items"][-1]["id"]
+    key = CatalogCache.CATEGORY_PAGE_KEY.format(
+        category_id=Categories.make_id("Games"), version=0, sort="c", direction="n", cursor=cursor
+    )
+    assert catalog_cache.local.get(key) == await load_page("n", cursor, "c")
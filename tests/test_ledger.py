@@ -0,0 +1,140 @@
+from decimal import Decimal
+
+from sqlalchemy import func, insert, select
+
+from main import BalanceSnapshot, Config, Ledger, LedgerPosting, SessionLocal, ledger
+
+
+async def post_bonus(entry_id: str, *credits):
+    """Запись с зачислениями пользователям из системного счета бонусов"""
+    async with SessionLocal() as db:
+        rows = await ledger.post(db, entry_id, "bonus", Ledger.BONUS, list(credits))
+        await db.commit()
+    await ledger.applied(rows)
+    return rows
+
+
+async def balance(user_id: int) -> Decimal:
+    async with SessionLocal() as db:
+        return await ledger.balance(db, user_id)
+
+
+async def test_entry_legs_sum_to_zero():
+    rows = Ledger.entry("E1", "bonus", Ledger.BONUS, [(Ledger.account(1), 10), (Ledger.account(2), "0.105")])
+
+    assert [row["amount"] for row in rows] == [Decimal("10.00"), Decimal("0.11"), Decimal("-10.11")]
+    assert rows[-1]["account"] == Ledger.BONUS
+    assert sum(row["amount"] for row in rows) == 0
+
+
+async def test_balance_is_snapshot_plus_unfolded_tail():
+    await post_bonus("E1", (Ledger.account(1), 100), (Ledger.account(2), 50))
+    await post_bonus("E2", (Ledger.account(1), 25))
+
+    assert await balance(1) == Decimal("125.00")
+    assert await balance(2) == Decimal("50.00")
+
+    assert await ledger.snapshot() == 5
+    assert await ledger.snapshot() == 0
+
+    async with SessionLocal() as db:
+        snapshots = dict((await db.execute(select(BalanceSnapshot.account, BalanceSnapshot.balance))).all())
+        unfolded = await db.scalar(select(func.count()).where(LedgerPosting.folded == False))
+    assert snapshots[Ledger.account(1)] == Decimal("125.00")
+    assert snapshots[Ledger.BONUS] == Decimal("-175.00")
+    assert unfolded == 0
+
+    # После свертки баланс тот же, а новые проводки идут в хвост
+    await post_bonus("E3", (Ledger.account(1), 5))
+    assert await balance(1) == Decimal("130.00")
+
+
+async def test_late_posting_is_folded_by_next_snapshot():
+    """Проводка с меньшим id, закоммиченная после свертки, не теряется и не учитывается дважды"""
+    async with SessionLocal() as db:
+        await db.execute(insert(LedgerPosting), [
+            {"id": 100, "entry_id": "LATE2", "account": Ledger.account(1), "amount": 30, "kind": "bonus"},
+            {"id": 101, "entry_id": "LATE2", "account": Ledger.BONUS, "amount": -30, "kind": "bonus"},
+        ])
+        await db.commit()
+    assert await ledger.snapshot() == 2
+
+    async with SessionLocal() as db:
+        await db.execute(insert(LedgerPosting), [
+            {"id": 50, "entry_id": "LATE1", "account": Ledger.account(1), "amount": 20, "kind": "bonus"},
+            {"id": 51, "entry_id": "LATE1", "account": Ledger.BONUS, "amount": -20, "kind": "bonus"},
+        ])
+        await db.commit()
+    await ledger.applied([{"account": Ledger.account(1)}])
+
+    assert await balance(1) == Decimal("50.00")
+    assert await ledger.snapshot() == 2
+    assert await balance(1) == Decimal("50.00")
+
+    async with SessionLocal() as db:
+        snapshot = await db.get(BalanceSnapshot, Ledger.account(1))
+    assert snapshot.balance == Decimal("50.00")
+    assert snapshot.last_posting_id == 100
+
+
+async def test_charge_checks_funds():
+    await post_bonus("E1", (Ledger.account(1), 40))
+
+    async with SessionLocal() as db:
+        assert await ledger.charge(db, 1, 50, "ORDER1", "purchase", Ledger.SALES) is None
+        await db.rollback()
+
+    async with SessionLocal() as db:
+        rows = await ledger.charge(db, 1, "39.99", "ORDER2", "purchase", Ledger.SALES)
+        await db.commit()
+    await ledger.applied(rows)
+
+    assert await balance(1) == Decimal("0.01")
+
+
+async def test_cached_balance_is_dropped_after_posting(redis_client):
+    await post_bonus("E1", (Ledger.account(1), 10))
+    assert await balance(1) == Decimal("10.00")
+    assert await redis_client.get(Ledger.BALANCE_KEY.format(account=Ledger.account(1))) == b"1000"
+
+    await post_bonus("E2", (Ledger.account(1), 5))
+    assert await redis_client.get(Ledger.BALANCE_KEY.format(account=Ledger.account(1))) is None
+    assert await balance(1) == Decimal("15.00")
+
+
+async def test_stale_read_does_not_fill_cache(redis_client, monkeypatch):
+    """Баланс, прочитанный до коммита чужой проводки, не попадает в кэш"""
+    await post_bonus("E1", (Ledger.account(1), 10))
+    load = Ledger._load
+
+    async def load_then_post(db, account):
+        value = await load(db, account)
+        await post_bonus("E2", (Ledger.account(1), 5))
+        return value
+
+    monkeypatch.setattr(Ledger, "_load", staticmethod(load_then_post))
+    assert await balance(1) == Decimal("10.00")
+    monkeypatch.setattr(Ledger, "_load", staticmethod(load))
+
+    assert await redis_client.get(Ledger.BALANCE_KEY.format(account=Ledger.account(1))) is None
+    assert await balance(1) == Decimal("15.00")
+
+
+async def test_lock_row_and_snapshot_share_account():
+    """Строку снимка создает первое списание; свертка и повторные списания ее переиспользуют"""
+    await post_bonus("E1", (Ledger.account(1), 20))
+
+    async with SessionLocal() as db:
+        rows = await ledger.charge(db, 1, 5, "ORDER1", "purchase", Ledger.SALES)
+        await db.commit()
+    await ledger.applied(rows)
+    assert await ledger.snapshot() == 4
+
+    async with SessionLocal() as db:
+        rows = await ledger.charge(db, 1, 5, "ORDER2", "purchase", Ledger.SALES)
+        await db.commit()
+        count = await db.scalar(select(func.count()).select_from(BalanceSnapshot))
+    await ledger.applied(rows)
+
+    assert count == 3  # user:1, system:bonus, system:sales
+    assert await balance(1) == Decimal("10.00")
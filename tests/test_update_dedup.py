@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from main import UpdateDedupMiddleware
+
+UPDATE_ID = UpdateDedupMiddleware.BUCKET_SIZE + 5  # Второй бакет битовой карты
+
+
+@pytest.fixture
+def middleware():
+    return UpdateDedupMiddleware()
+
+
+def update(update_id: int = UPDATE_ID):
+    return SimpleNamespace(update_id=update_id)
+
+
+async def test_processed_update_is_skipped(middleware, redis_client):
+    calls = []
+
+    async def handler(event, data):
+        calls.append(event.update_id)
+        return "ok"
+
+    assert await middleware(handler, update(), {}) == "ok"
+    assert await middleware(handler, update(), {}) is None
+    assert await middleware(handler, update(UPDATE_ID + 1), {}) == "ok"
+
+    assert calls == [UPDATE_ID, UPDATE_ID + 1]
+    assert await redis_client.getbit(UpdateDedupMiddleware.KEY.format(bucket=1), 5) == 1
+    assert not await redis_client.exists(UpdateDedupMiddleware.PENDING_KEY.format(update_id=UPDATE_ID))
+
+
+async def test_duplicate_in_flight_is_skipped(middleware):
+    started, release = asyncio.Event(), asyncio.Event()
+    calls = []
+
+    async def handler(event, data):
+        calls.append(event.update_id)
+        started.set()
+        await release.wait()
+        return "ok"
+
+    first = asyncio.ensure_future(middleware(handler, update(), {}))
+    await started.wait()
+    assert await middleware(handler, update(), {}) is None
+
+    release.set()
+    assert await first == "ok"
+    assert calls == [UPDATE_ID]
+
+
+async def test_failed_update_is_processed_again(middleware, redis_client):
+    calls = []
+
+    async def handler(event, data):
+        calls.append(event.update_id)
+        if len(calls) == 1:
+            raise RuntimeError("handler failed")
+        return "ok"
+
+    with pytest.raises(RuntimeError):
+        await middleware(handler, update(), {})
+    assert not await redis_client.exists(UpdateDedupMiddleware.PENDING_KEY.format(update_id=UPDATE_ID))
+    assert await redis_client.getbit(UpdateDedupMiddleware.KEY.format(bucket=1), 5) == 0
+
+    assert await middleware(handler, update(), {}) == "ok"
+    assert await middleware(handler, update(), {}) is None
+    assert len(calls) == 2